@@ -0,0 +1,45 @@
+"""
+Compare the sequential and the concurrent metric computation of `COCOEvalCap`.
+
+Example:
+    python benchmarks/bench_concurrent_metrics.py --num-images 100000
+"""
+import argparse
+import time
+
+from multicaptioneval.eval import COCOEvalCap
+from multicaptioneval.loader import CaptionIndex
+
+from synthetic import CaptionGenerator
+
+
+def time_metrics(coco_eval: COCOEvalCap, references, results, workers: int, executor: str) -> float:
+    start = time.perf_counter()
+    coco_eval.compute_metrics(references, results, workers=workers, executor=executor)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-images", type=int, default=100_000)
+    parser.add_argument("--num-references", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generator = CaptionGenerator("en", seed=args.seed)
+    references, results = generator.tokenized(args.num_images, args.num_references)
+    empty = CaptionIndex([], [])
+
+    runs = [("sequential", 1, "process"), ("threads", 2, "thread"), ("processes", 2, "process")]
+    timings = {}
+    scores = {}
+    for name, workers, executor in runs:
+        coco_eval = COCOEvalCap(empty, empty)
+        timings[name] = time_metrics(coco_eval, references, results, workers, executor)
+        scores[name] = coco_eval.eval
+        print(f"{name:>10}: {timings[name]:8.2f}s (speedup {timings['sequential'] / timings[name]:0.2f}x)")
+    assert all(score == scores["sequential"] for score in scores.values()), "scores differ across runs"
+
+
+if __name__ == "__main__":
+    main()
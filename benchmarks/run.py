@@ -0,0 +1,310 @@
+"""
+Benchmark suite for the preprocessing and metric hot paths.
+
+Each benchmark is run on synthetic captions (5 references per image by default) for every requested language
+and size, and reports the throughput and the peak Python memory. The results can be saved as a baseline and
+later runs can be compared against it to catch regressions. Everything runs offline on CPU.
+
+Examples:
+    python benchmarks/run.py --sizes 1k 10k --languages en ja --output baseline.json
+    python benchmarks/run.py --sizes 1k 10k --languages en ja --baseline baseline.json --tolerance 0.2
+"""
+import argparse
+import json
+import math
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Optional
+
+from multicaptioneval.eval import COCOEvalCap
+from multicaptioneval.loader import CaptionIndex
+from multicaptioneval.mbr import MBRUtility
+from multicaptioneval.metrics.bleu.bleu import Bleu
+from multicaptioneval.metrics.bleu.bleu_scorer import BleuScorer
+from multicaptioneval.metrics.bleu.data import BleuData
+from multicaptioneval.metrics.cider.cider import Cider
+from multicaptioneval.metrics.cider.cider_scorer import CiderMetric
+from multicaptioneval.metrics.cider.data import CiderData
+from multicaptioneval.parallel import ParallelScorer
+from multicaptioneval.processing.normalization import normalize_unicode
+from multicaptioneval.processing.pipeline import TOKENIZERS, CharacterPipeline
+
+from synthetic import LANGUAGES, CaptionGenerator
+
+
+# Tokenizer configurations to benchmark for each entry of `TOKENIZERS`
+TOKENIZER_CONFIGS = {
+    "ja": [{"word_segmenter": "sudachi"}, {"word_segmenter": "mecab"}],
+    "ko": [{"word_segmenter": "mecab"}, {"word_segmenter": "rule-based"}],
+    "th": [{"word_segmenter": "spacy"}, {"word_segmenter": "char"}],
+    "zh": [{"word_segmenter": "char"}, {"word_segmenter": "jieba"}, {"word_segmenter": "pkuseg"}],
+    "ptb": [{}],
+    "none": [{}],
+}
+LANGUAGE_TOKENIZERS = {"ja", "ko", "th", "zh"}
+# Language of the synthetic captions used for the tokenizers that are not language-specific
+DEFAULT_TOKENIZER_LANGUAGE = "en"
+
+# A benchmark prepares its inputs and returns the number of processed items and the function to time
+BenchmarkType = Callable[[CaptionGenerator, int], tuple[int, Callable[[], Any]]]
+
+
+def parse_size(size: str) -> int:
+    multipliers = {"k": 1_000, "m": 1_000_000}
+    size = size.lower()
+    if size[-1] in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1]])
+    return int(size)
+
+
+def bench_normalize_unicode(generator: CaptionGenerator, num_images: int):
+    dataset, _ = generator.dataset(num_images)
+    captions = [annotation["caption"] for annotation in dataset["annotations"]]
+
+    def run() -> None:
+        normalize_unicode.cache_clear()
+        for caption in captions:
+            normalize_unicode(caption)
+
+    return len(captions), run
+
+
+def bench_tokenizer(name: str, cfg: dict[str, Any]) -> BenchmarkType:
+    def bench(generator: CaptionGenerator, num_images: int):
+        tokenizer = TOKENIZERS[name](**cfg)
+        dataset, _ = generator.dataset(num_images)
+        index = CaptionIndex.from_dataset(dataset)
+        captions = {image_id: index.imgToAnns[image_id] for image_id in index.getImgIds()}
+        return len(dataset["annotations"]), lambda: tokenizer(captions)
+
+    return bench
+
+
+def bench_character_pipeline(generator: CaptionGenerator, num_images: int):
+    dataset, _ = generator.dataset(num_images)
+    index = CaptionIndex.from_dataset(dataset)
+    captions = {image_id: index.imgToAnns[image_id] for image_id in index.getImgIds()}
+    pipeline = CharacterPipeline()
+    return len(dataset["annotations"]), lambda: pipeline(captions)
+
+
+def bench_bleu_data(generator: CaptionGenerator, num_images: int):
+    references, results = generator.tokenized(num_images)
+    hypotheses = [captions[0] for captions in results.values()]
+
+    def run() -> None:
+        BleuData().add_data(hypotheses, list(references.values()))
+
+    return num_images, run
+
+
+def bench_bleu_scorer(generator: CaptionGenerator, num_images: int):
+    references, results = generator.tokenized(num_images)
+    scorer = BleuScorer()
+    scorer.update([captions[0] for captions in results.values()], list(references.values()))
+
+    def run() -> None:
+        scorer._score = None
+        scorer.compute(option="closest")
+
+    return num_images, run
+
+
+def bench_cider_data(generator: CaptionGenerator, num_images: int):
+    references, results = generator.tokenized(num_images)
+    hypotheses = [captions[0] for captions in results.values()]
+
+    def run() -> None:
+        CiderData().add_data(hypotheses, list(references.values()))
+
+    return num_images, run
+
+
+def bench_cider_metric(generator: CaptionGenerator, num_images: int):
+    references, results = generator.tokenized(num_images)
+    data = CiderData()
+    data.add_data([captions[0] for captions in results.values()], list(references.values()))
+    metric = CiderMetric(ngram_n=4, sigma=6.0)
+    return num_images, lambda: metric(crefs=data.references, ctest=data.hypotheses)
+
+
+def bench_mbr_utility(generator: CaptionGenerator, num_images: int):
+    # The references of each image stand for its sampled candidates
+    references, _ = generator.tokenized(num_images)
+    utility = MBRUtility()
+    return num_images, lambda: (utility.bleu(references), utility.cider(references))
+
+
+def bench_parallel_scorer(generator: CaptionGenerator, num_images: int):
+    references, results = generator.tokenized(num_images)
+    scorer = ParallelScorer()
+    return num_images, lambda: scorer.compute_scores([Bleu(), Cider()], references, results)
+
+
+def bench_evaluate(generator: CaptionGenerator, num_images: int, unit: str = "word"):
+    dataset, results = generator.dataset(num_images)
+    tokenizer_cfg = TOKENIZER_CONFIGS.get(generator.language, [{}])[0]
+    # The evaluation only reads the indexes, so they are built once outside of the timed runs
+    coco = CaptionIndex.from_dataset(dataset)
+    coco_result = coco.loadRes(results)
+
+    def run() -> None:
+        coco_eval = COCOEvalCap(
+            coco, coco_result, language=generator.language, tokenizer_cfg=tokenizer_cfg, unit=unit
+        )
+        coco_eval.evaluate()
+
+    return num_images, run
+
+
+def bench_evaluate_characters(generator: CaptionGenerator, num_images: int):
+    return bench_evaluate(generator, num_images, unit="char")
+
+
+def get_benchmarks(language: str) -> dict[str, BenchmarkType]:
+    benchmarks = {"normalize_unicode": bench_normalize_unicode}
+    for name, configs in TOKENIZER_CONFIGS.items():
+        if name == language or (name not in LANGUAGE_TOKENIZERS and language == DEFAULT_TOKENIZER_LANGUAGE):
+            for cfg in configs:
+                segmenter = cfg.get("word_segmenter", "default")
+                benchmarks[f"tokenizer[{name}:{segmenter}]"] = bench_tokenizer(name, cfg)
+    if language in LANGUAGE_TOKENIZERS:
+        benchmarks["CharacterPipeline"] = bench_character_pipeline
+    benchmarks.update(
+        {
+            "BleuData": bench_bleu_data,
+            "BleuScorer": bench_bleu_scorer,
+            "CiderData": bench_cider_data,
+            "CiderMetric": bench_cider_metric,
+            "ParallelScorer": bench_parallel_scorer,
+            "MBRUtility": bench_mbr_utility,
+            "COCOEvalCap.evaluate": bench_evaluate,
+        }
+    )
+    if language in LANGUAGE_TOKENIZERS:
+        benchmarks["COCOEvalCap.evaluate[char]"] = bench_evaluate_characters
+    return benchmarks
+
+
+def measure(
+    benchmark: BenchmarkType, generator: CaptionGenerator, num_images: int, memory: bool, repeat: int = 1
+) -> dict[str, Any]:
+    num_items, run = benchmark(generator, num_images)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    seconds = min(timings)
+    result = {"items": num_items, "seconds": seconds, "throughput": num_items / seconds}
+    if memory:
+        # Trace a second run, since tracing slows down the execution
+        tracemalloc.start()
+        run()
+        result["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return result
+
+
+def run_suite(
+    languages: list[str],
+    sizes: list[int],
+    filters: Optional[list[str]],
+    memory: bool,
+    seed: int,
+    repeat: int = 1,
+) -> list[dict[str, Any]]:
+    records = []
+    for language in languages:
+        for name, benchmark in get_benchmarks(language).items():
+            if filters and not any(pattern in name for pattern in filters):
+                continue
+            for num_images in sizes:
+                generator = CaptionGenerator(language, seed=seed)
+                try:
+                    result = measure(benchmark, generator, num_images, memory, repeat)
+                except Exception as e:  # e.g. a segmenter model that is not installed
+                    print(f"[skip] {language} {name} {num_images}: {type(e).__name__}: {e}", file=sys.stderr)
+                    continue
+                record = {"language": language, "benchmark": name, "num_images": num_images, **result}
+                records.append(record)
+                memory_info = f", peak {record['peak_memory_mb']:.1f} MB" if memory else ""
+                print(
+                    f"{language:>3} {name:<32} {num_images:>9} images: "
+                    f"{record['throughput']:>12.1f} items/s ({record['seconds']:.3f}s{memory_info})"
+                )
+    return records
+
+
+def print_scaling(records: list[dict[str, Any]]) -> None:
+    """Print the empirical scaling exponent of the run time with the number of images (1.0 is linear)."""
+    grouped = {}
+    for record in records:
+        grouped.setdefault((record["language"], record["benchmark"]), []).append(record)
+    print("\nScaling (time ~ images^k):")
+    for (language, name), group in grouped.items():
+        group = sorted(group, key=lambda record: record["num_images"])
+        if len(group) < 2:
+            continue
+        exponents = [
+            math.log(after["seconds"] / before["seconds"]) / math.log(after["num_images"] / before["num_images"])
+            for before, after in zip(group[:-1], group[1:])
+        ]
+        curve = " ".join(f"{record['num_images']}:{record['throughput']:.0f}/s" for record in group)
+        print(f"{language:>3} {name:<32} k={' '.join(f'{k:.2f}' for k in exponents)}  [{curve}]")
+
+
+def compare_to_baseline(records: list[dict[str, Any]], baseline: list[dict[str, Any]], tolerance: float) -> bool:
+    """Compare the throughput against the baseline, returning False if any benchmark regressed."""
+    baseline = {(record["language"], record["benchmark"], record["num_images"]): record for record in baseline}
+    passed = True
+    print(f"\nComparison against the baseline (tolerance {tolerance:.0%}):")
+    for record in records:
+        key = (record["language"], record["benchmark"], record["num_images"])
+        if key not in baseline:
+            continue
+        ratio = record["throughput"] / baseline[key]["throughput"]
+        regressed = ratio < 1 - tolerance
+        passed = passed and not regressed
+        status = "REGRESSION" if regressed else "ok"
+        print(f"{key[0]:>3} {key[1]:<32} {key[2]:>9} images: {ratio:6.2f}x baseline throughput  {status}")
+    return passed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=["1k"], help="number of images, e.g. 1k 10k 100k 1M")
+    parser.add_argument("--languages", nargs="+", default=LANGUAGES, choices=LANGUAGES)
+    parser.add_argument("--benchmarks", nargs="+", help="only run the benchmarks whose name contains these")
+    parser.add_argument("--skip-memory", action="store_true", help="do not measure the peak memory")
+    parser.add_argument("--repeat", type=int, default=1, help="report the fastest of several runs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="save the results as JSON, e.g. to use as a baseline")
+    parser.add_argument("--baseline", help="compare against the results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative throughput drop")
+    args = parser.parse_args()
+
+    sizes = [parse_size(size) for size in args.sizes]
+    records = run_suite(
+        args.languages,
+        sizes,
+        args.benchmarks,
+        memory=not args.skip_memory,
+        seed=args.seed,
+        repeat=args.repeat,
+    )
+    print_scaling(records)
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(records, fp, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        if not compare_to_baseline(records, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Synthetic COCO-style captions for benchmarking.
+
+The captions are sampled from a Zipf-distributed vocabulary of random words written in the script of each
+language. The results are noisy copies of one of the references, so that the n-gram overlap is realistic.
+"""
+import random
+from typing import Any
+
+# Characters used to build the words of each language, and whether the language separates words with spaces
+SCRIPTS = {
+    "en": ("abcdefghijklmnopqrstuvwxyz", True),
+    "fr": ("abcdefghijklmnopqrstuvwxyzéèàç", True),
+    "el": ("".join(chr(c) for c in range(0x03B1, 0x03CA)), True),
+    "ar": ("".join(chr(c) for c in range(0x0627, 0x064B)), True),
+    "ko": ("".join(chr(c) for c in range(0xAC00, 0xAC00 + 400)), True),
+    "ja": (
+        "".join(chr(c) for c in range(0x3041, 0x3097)) + "".join(chr(c) for c in range(0x4E00, 0x4E00 + 300)),
+        False,
+    ),
+    "zh": ("".join(chr(c) for c in range(0x4E00, 0x4E00 + 1000)), False),
+    "th": ("".join(chr(c) for c in range(0x0E01, 0x0E2F)), False),
+}
+LANGUAGES = list(SCRIPTS)
+
+
+class CaptionGenerator:
+    """Generate synthetic captions for a language."""
+
+    def __init__(self, language: str = "en", vocab_size: int = 5000, seed: int = 0) -> None:
+        if language not in SCRIPTS:
+            raise ValueError(f"Unknown language: {language}")
+        self.language = language
+        self._alphabet, self._spaces = SCRIPTS[language]
+        self._random = random.Random(seed)
+        max_length = 6 if self._spaces else 3
+        self.vocabulary = list(
+            {
+                "".join(self._random.choices(self._alphabet, k=self._random.randint(1, max_length)))
+                for _ in range(vocab_size)
+            }
+        )
+        # Zipf-like word frequencies
+        self._weights = [1.0 / (rank + 1) for rank in range(len(self.vocabulary))]
+
+    def words(self, min_length: int = 8, max_length: int = 15) -> list[str]:
+        length = self._random.randint(min_length, max_length)
+        return self._random.choices(self.vocabulary, weights=self._weights, k=length)
+
+    def join(self, words: list[str]) -> str:
+        return (" " if self._spaces else "").join(words) + ("." if self._spaces else "")
+
+    def perturb(self, words: list[str], noise: float = 0.3) -> list[str]:
+        """Replace or drop a fraction of the words."""
+        perturbed = []
+        for word in words:
+            draw = self._random.random()
+            if draw < noise / 2:
+                perturbed.append(self._random.choices(self.vocabulary, weights=self._weights)[0])
+            elif draw >= noise:
+                perturbed.append(word)
+        return perturbed or words[:1]
+
+    def dataset(self, num_images: int, num_references: int = 5) -> tuple[dict[str, Any], list[dict[str, Any]]]:
+        """Generate a COCO-style annotation dataset and the corresponding results."""
+        images = []
+        annotations = []
+        results = []
+        for image_id in range(num_images):
+            images.append({"id": image_id})
+            references = [self.words() for _ in range(num_references)]
+            for words in references:
+                annotations.append({"image_id": image_id, "id": len(annotations), "caption": self.join(words)})
+            hypothesis = self.perturb(self._random.choice(references))
+            results.append({"image_id": image_id, "caption": self.join(hypothesis)})
+        return {"images": images, "annotations": annotations}, results
+
+    def tokenized(self, num_images: int, num_references: int = 5) -> tuple[dict[int, list[str]], dict[int, list[str]]]:
+        """Generate tokenized references and results, i.e. the input of the metrics."""
+        references = {}
+        results = {}
+        for image_id in range(num_images):
+            captions = [self.words() for _ in range(num_references)]
+            references[image_id] = [" ".join(words) for words in captions]
+            results[image_id] = [" ".join(self.perturb(self._random.choice(captions)))]
+        return references, results
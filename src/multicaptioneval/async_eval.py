@@ -0,0 +1,119 @@
+"""
+asyncio evaluation API.
+
+`AsyncCOCOEvalCap` runs the preprocessing and the metrics of `COCOEvalCap` in an executor, one chunk of images at a
+time, so the event loop is never blocked for long. Progress is reported after every chunk, cancelling the task
+stops the evaluation at the next chunk boundary, and several evaluations can run concurrently, e.g. with
+`asyncio.gather`.
+"""
+import asyncio
+import functools
+import logging
+from concurrent.futures import Executor
+from typing import Any, AsyncIterator, Callable, Optional
+
+import numpy as np
+from pydantic import BaseModel
+
+from multicaptioneval.eval import COCOEvalCap
+from multicaptioneval.metrics.bleu.bleu import Bleu
+from multicaptioneval.metrics.cider.cider import Cider
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+class EvaluationProgress(BaseModel):
+    # "preprocessing", the method of a metric (counting and scoring), or "done"
+    stage: str
+    completed: int
+    total: int
+
+    @property
+    def fraction(self) -> float:
+        return self.completed / self.total if self.total else 1.0
+
+
+class AsyncCOCOEvalCap(COCOEvalCap):
+    """COCOEvalCap with an asyncio API.
+
+    The work runs in `executor`, by default the event loop's thread pool. The preprocessing pipeline is only used
+    by one chunk at a time, so each evaluation should have its own `AsyncCOCOEvalCap`.
+    """
+
+    async def evaluate_async(self, chunk_size: int = DEFAULT_CHUNK_SIZE, executor: Optional[Executor] = None) -> None:
+        """Evaluate the captions without blocking the event loop."""
+        async for _ in self.iter_evaluate(chunk_size=chunk_size, executor=executor):
+            pass
+
+    async def iter_evaluate(
+        self, chunk_size: int = DEFAULT_CHUNK_SIZE, executor: Optional[Executor] = None
+    ) -> AsyncIterator[EvaluationProgress]:
+        """Evaluate the captions, yielding the progress after every chunk.
+
+        The scores are set (`self.eval`, `self.imgToEval`) when the "done" progress is yielded.
+        """
+        if chunk_size <= 0:
+            raise ValueError(f"chunk_size must be positive: {chunk_size}")
+        image_ids = list(self.params["image_id"])
+        chunks = [image_ids[start : start + chunk_size] for start in range(0, len(image_ids), chunk_size)]
+        metrics = self._initializa_chunked_metrics("Asynchronous")
+
+        ground_truths, results = {}, {}
+        for done, chunk in enumerate(chunks, start=1):
+            chunk_ground_truths, chunk_results = await self._run(executor, self._prepare_chunk, chunk)
+            ground_truths.update(chunk_ground_truths)
+            results.update(chunk_results)
+            yield EvaluationProgress(stage="preprocessing", completed=done, total=len(chunks))
+
+        for metric in metrics:
+            logging.info(f"Computing {metric.method} score...")
+            # Counting and scoring chunks for CIDEr, with the document frequency computed in between
+            total = 2 * len(chunks) + 1 if isinstance(metric, Cider) else len(chunks) + 1
+
+            scorer = metric.new_scorer()
+            for done, chunk in enumerate(chunks, start=1):
+                chunk_ground_truths = {image_id: ground_truths[image_id] for image_id in chunk}
+                chunk_results = {image_id: results[image_id] for image_id in chunk}
+                await self._run(executor, self._count_chunk, [metric], [scorer], chunk_ground_truths, chunk_results)
+                yield EvaluationProgress(stage=metric.method, completed=done, total=total)
+
+            if isinstance(metric, Bleu):
+                score, scores = await self._run(executor, metric.compute_scores, scorer)
+                yield EvaluationProgress(stage=metric.method, completed=total, total=total)
+            else:
+                await self._run(executor, self._compute_document_frequency, scorer.cider, scorer.data.references)
+                yield EvaluationProgress(stage=metric.method, completed=len(chunks) + 1, total=total)
+                scores = []
+                for done, start in enumerate(range(0, len(image_ids), chunk_size), start=len(chunks) + 2):
+                    end = start + chunk_size
+                    scores += await self._run(
+                        executor,
+                        scorer.cider.score_images,
+                        scorer.data.references[start:end],
+                        scorer.data.hypotheses[start:end],
+                    )
+                    yield EvaluationProgress(stage=metric.method, completed=done, total=total)
+                if scorer.cider.sketch is not None and scorer.cider.sketch.sample_size > 0:
+                    deviation = await self._run(
+                        executor,
+                        scorer.cider.measure_sketch_deviation,
+                        scorer.data.references,
+                        scorer.data.hypotheses,
+                        scores,
+                    )
+                    logging.info(f"Deviation of the CIDEr scores from the exact document frequency: {deviation}")
+                    metric.sketch_deviation = self.sketch_deviation = deviation
+                scores = np.array(scores)
+                score = np.mean(scores)
+            self.print_scores(metric.score_names, score, scores, image_ids)
+
+        self.set_eval_per_image()
+        yield EvaluationProgress(stage="done", completed=len(image_ids), total=len(image_ids))
+
+    async def _run(self, executor: Optional[Executor], function: Callable[..., Any], *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(function, *args))
+
+    def _compute_document_frequency(self, metric, references) -> None:
+        metric.compute_doc_freq(references)
+        metric.ref_len = np.log(float(len(references)))
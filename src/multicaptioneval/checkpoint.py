@@ -0,0 +1,120 @@
+"""
+Checkpointed evaluation that can resume after an interruption.
+
+The images are processed in chunks. For every chunk the tokenized captions, the metric statistics
+(`BleuData`, `CiderData`) and the images truncated by the caption guard are written to the checkpoint directory.
+A restarted evaluation checks that the inputs and the configuration match the checkpoint and continues from the
+first chunk that was not completed.
+"""
+import json
+import logging
+import os
+import pickle
+from pathlib import Path
+from typing import Any, Union
+
+from multicaptioneval.eval import COCOEvalCap
+from multicaptioneval.processing import GuardReport, ImageCaptionsType
+
+DEFAULT_CHUNK_SIZE = 10_000
+MANIFEST_FILE = "manifest.json"
+
+
+def write_pickle(path: Path, obj: Any) -> None:
+    """Write atomically, so an interrupted write never leaves a partial chunk."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as fp:
+        pickle.dump(obj, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def read_pickle(path: Path) -> Any:
+    with open(path, "rb") as fp:
+        return pickle.load(fp)
+
+
+class CheckpointedCOCOEvalCap(COCOEvalCap):
+    """COCOEvalCap that saves its progress in a checkpoint directory and resumes from it."""
+
+    def evaluate(
+        self, checkpoint_dir: Union[str, Path], chunk_size: int = DEFAULT_CHUNK_SIZE, overwrite: bool = False
+    ) -> None:
+        """Evaluate the captions, resuming from the completed chunks in `checkpoint_dir`.
+
+        :param checkpoint_dir: directory of the checkpoint, created if needed
+        :param chunk_size: number of images per chunk
+        :param overwrite: start from scratch if the checkpoint is for other inputs or another configuration,
+            otherwise this raises a ValueError
+        """
+        if chunk_size <= 0:
+            raise ValueError(f"chunk_size must be positive: {chunk_size}")
+        image_ids = list(self.params["image_id"])
+        if not image_ids:
+            raise ValueError("No images to evaluate")
+        # Before anything is preprocessed or written to the checkpoint
+        metrics = self._initializa_chunked_metrics("Checkpointed")
+        checkpoint_dir = Path(checkpoint_dir)
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        chunks = [image_ids[start : start + chunk_size] for start in range(0, len(image_ids), chunk_size)]
+        self._check_manifest(checkpoint_dir, self._manifest(image_ids, chunk_size), overwrite)
+
+        scorers = [metric.new_scorer() for metric in metrics]
+        for index, chunk in enumerate(chunks):
+            stats_path = checkpoint_dir / f"stats-{index:06d}.pkl"
+            if stats_path.exists():
+                chunk_data, guard_report = read_pickle(stats_path)
+            else:
+                logging.info(f"Evaluating chunk {index + 1} of {len(chunks)} ({len(chunk)} images)...")
+                ground_truths, results, guard_report = self._prepare_guarded_chunk(chunk)
+                write_pickle(checkpoint_dir / f"captions-{index:06d}.pkl", (ground_truths, results))
+                chunk_data = [metric.build_scorer(ground_truths, results).data for metric in metrics]
+                write_pickle(stats_path, (chunk_data, guard_report))
+            self.preprocessing.guard_report.update(guard_report)
+            for scorer, data in zip(scorers, chunk_data):
+                scorer.data += data
+        self._set_chunked_scores(metrics, scorers, image_ids)
+
+    def load_captions(self, checkpoint_dir: Union[str, Path]) -> tuple[ImageCaptionsType, ImageCaptionsType]:
+        """Load the tokenized references and results of the completed chunks."""
+        ground_truths, results = {}, {}
+        for path in sorted(Path(checkpoint_dir).glob("captions-*.pkl")):
+            chunk_ground_truths, chunk_results = read_pickle(path)
+            ground_truths.update(chunk_ground_truths)
+            results.update(chunk_results)
+        return ground_truths, results
+
+    def _prepare_guarded_chunk(self, image_ids: list[Any]) -> tuple[ImageCaptionsType, ImageCaptionsType, GuardReport]:
+        """Preprocess a chunk, also returning the images of the chunk truncated by the caption guard."""
+        report = self.preprocessing.guard_report
+        self.preprocessing.guard_report = GuardReport()
+        try:
+            ground_truths, results = self._prepare_chunk(image_ids)
+            return ground_truths, results, self.preprocessing.guard_report
+        finally:
+            self.preprocessing.guard_report = report
+
+    def _manifest(self, image_ids: list[Any], chunk_size: int) -> dict[str, Any]:
+        """Identify the inputs (image ids and raw captions) and the configuration of the evaluation."""
+        return {
+            **self.signature,
+            "inputs": self.get_inputs_digest(image_ids),
+            "num_images": len(image_ids),
+            "chunk_size": chunk_size,
+        }
+
+    def _check_manifest(self, checkpoint_dir: Path, manifest: dict[str, Any], overwrite: bool) -> None:
+        manifest_path = checkpoint_dir / MANIFEST_FILE
+        if manifest_path.exists():
+            with open(manifest_path) as fp:
+                previous = json.load(fp)
+            if previous == manifest:
+                logging.info(f"Resuming from the checkpoint in {checkpoint_dir}")
+                return
+            mismatch = [key for key in manifest if previous.get(key) != manifest[key]]
+            if not overwrite:
+                raise ValueError(f"The checkpoint in {checkpoint_dir} does not match the evaluation: {mismatch}")
+            logging.info(f"Discarding the checkpoint in {checkpoint_dir}, mismatch: {mismatch}")
+        for path in [*checkpoint_dir.glob("captions-*.pkl"), *checkpoint_dir.glob("stats-*.pkl")]:
+            path.unlink()
+        with open(manifest_path, "w") as fp:
+            json.dump(manifest, fp, indent=2)
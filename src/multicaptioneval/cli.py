@@ -0,0 +1,282 @@
+"""
+Command line interface: `multicaptioneval <command>`.
+"""
+import argparse
+import cProfile
+import json
+import logging
+import sys
+import time
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+
+@contextmanager
+def timer(timings: dict[str, float], name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    yield
+    timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def add_evaluate_parser(subparsers) -> None:
+    parser = subparsers.add_parser(
+        "evaluate",
+        help="evaluate a results file",
+        description="Evaluate a results file, printing the scores as JSON unless --output is given.",
+    )
+    parser.add_argument("annotations", help="COCO-style annotation file")
+    parser.add_argument("results", help="results file (JSON, or JSON Lines with a .jsonl suffix), - for stdin")
+    parser.add_argument("--language", default="default")
+    parser.add_argument("--tokenizer-cfg", type=json.loads, help="tokenizer config as JSON")
+    parser.add_argument("--metrics", nargs="+", help="metrics to compute (default: bleu cider)")
+    parser.add_argument(
+        "--unit", choices=["word", "char"], default="word", help="n-grams of words, or of characters (no segmenter)"
+    )
+    parser.add_argument("--max-ngram", type=int, default=4, help="highest n-gram order")
+    parser.add_argument("--max-caption-chars", type=int, help="truncate the raw captions to this many characters")
+    parser.add_argument(
+        "--max-caption-tokens", type=int, help="truncate the tokenized captions to this many tokens (or characters)"
+    )
+
+    performance = parser.add_argument_group("performance")
+    performance.add_argument("--workers", type=int, default=1, help="number of workers to compute the metrics")
+    performance.add_argument("--executor", choices=["process", "thread", "shared_memory"], default="process")
+    performance.add_argument("--batch-size", type=int, help="number of images per tokenizer call or checkpoint chunk")
+    performance.add_argument("--cache-dir", help="directory of the tokenization cache")
+    performance.add_argument(
+        "--reference-cache",
+        help="evaluation state file: reuse the preprocessed references and statistics of a previous run, then "
+        "update it",
+    )
+    performance.add_argument("--checkpoint-dir", help="save the progress in chunks and resume from it")
+    performance.add_argument(
+        "--pipelined",
+        action="store_true",
+        help="tokenize the next chunks of --batch-size images in a --executor worker while counting the n-grams",
+    )
+    performance.add_argument(
+        "--df-sketch-width",
+        type=int,
+        help="count the CIDEr document frequency in a sketch of this many counters per row, reporting the deviation",
+    )
+    performance.add_argument(
+        "--mapped-references",
+        help="directory of the memory-mapped reference statistics shared by the evaluations of the host, built once",
+    )
+    performance.add_argument(
+        "--streaming",
+        action="store_true",
+        help="read the results as JSON Lines a chunk of --batch-size images at a time, evaluating them pipelined",
+    )
+    performance.add_argument("--result-store", help="directory of the store of evaluation results, reused on a hit")
+    performance.add_argument(
+        "--verify-stored", action="store_true", help="recompute a stored result and fail if the scores differ"
+    )
+
+    output = parser.add_argument_group("output")
+    output.add_argument("--output", help="write the scores as JSON")
+    output.add_argument("--image-scores", help="write the per-image scores (.npz, .csv or .parquet)")
+    output.add_argument("--timings", action="store_true", help="report the time spent in each stage")
+    output.add_argument("--profile", help="write cProfile statistics of the evaluation, e.g. for snakeviz")
+    parser.set_defaults(func=run_evaluate)
+
+
+def run_evaluate(args: argparse.Namespace) -> None:
+    from multicaptioneval.checkpoint import CheckpointedCOCOEvalCap
+    from multicaptioneval.eval import COCOEvalCap
+    from multicaptioneval.incremental import EvaluationState, IncrementalCOCOEvalCap
+    from multicaptioneval.loader import CaptionIndex, iter_json_lines, load_json_lines
+    from multicaptioneval.mapped_references import MappedCOCOEvalCap
+    from multicaptioneval.metrics.cider.sketch import SketchConfig
+    from multicaptioneval.pipelined import PipelinedCOCOEvalCap
+    from multicaptioneval.processing import CaptionGuard, TokenizationCache
+    from multicaptioneval.result_store import ResultStore
+
+    if sum(map(bool, (args.reference_cache, args.checkpoint_dir, args.pipelined))) > 1:
+        raise SystemExit("--reference-cache, --checkpoint-dir and --pipelined cannot be used together")
+    if args.result_store and (args.reference_cache or args.checkpoint_dir or args.pipelined):
+        raise SystemExit("--result-store cannot be used with --reference-cache, --checkpoint-dir or --pipelined")
+    if args.streaming and (args.reference_cache or args.checkpoint_dir or args.result_store):
+        raise SystemExit("--streaming cannot be used with --reference-cache, --checkpoint-dir or --result-store")
+    if (args.pipelined or args.streaming) and args.executor == "shared_memory":
+        raise SystemExit("--pipelined and --streaming preprocess in a process or a thread executor")
+    if (args.reference_cache or args.checkpoint_dir or args.mapped_references) and (
+        args.workers != 1 or args.executor != "process"
+    ):
+        raise SystemExit(
+            "--workers and --executor cannot be used with --reference-cache, --checkpoint-dir or --mapped-references"
+        )
+    if args.df_sketch_width and (args.reference_cache or args.checkpoint_dir or args.executor == "shared_memory"):
+        raise SystemExit("--df-sketch-width cannot be used with --reference-cache, --checkpoint-dir or shared_memory")
+    if args.mapped_references and (
+        args.reference_cache
+        or args.checkpoint_dir
+        or args.pipelined
+        or args.streaming
+        or args.result_store
+        or args.df_sketch_width
+    ):
+        raise SystemExit(
+            "--mapped-references cannot be used with --reference-cache, --checkpoint-dir, --pipelined, --streaming, "
+            "--result-store or --df-sketch-width"
+        )
+    # The caches are closed when the evaluation ends or fails
+    with ExitStack() as resources:
+        result_store = resources.enter_context(ResultStore(args.result_store)) if args.result_store else None
+        tokenization_cache = resources.enter_context(TokenizationCache(args.cache_dir)) if args.cache_dir else None
+        caption_guard = None
+        if args.max_caption_chars or args.max_caption_tokens:
+            caption_guard = CaptionGuard(max_chars=args.max_caption_chars, max_tokens=args.max_caption_tokens)
+        timings = {}
+        profiler = cProfile.Profile() if args.profile else None
+        if profiler is not None:
+            profiler.enable()
+
+        with timer(timings, "load"):
+            coco = CaptionIndex.from_file(args.annotations)
+            source = sys.stdin if args.results == "-" else args.results
+            if args.streaming:
+                # The results are read while evaluating
+                results = iter_json_lines(source)
+                coco_result = CaptionIndex([], [])
+            else:
+                coco_result = coco.loadRes(load_json_lines(source) if args.results == "-" else source)
+
+        if args.reference_cache:
+            evaluator_cls = IncrementalCOCOEvalCap
+        elif args.checkpoint_dir:
+            evaluator_cls = CheckpointedCOCOEvalCap
+        elif args.pipelined or args.streaming:
+            evaluator_cls = PipelinedCOCOEvalCap
+        elif args.mapped_references:
+            evaluator_cls = MappedCOCOEvalCap
+        else:
+            evaluator_cls = COCOEvalCap
+        with timer(timings, "setup"):
+            coco_eval = evaluator_cls(
+                coco,
+                coco_result,
+                metrics=args.metrics,
+                language=args.language,
+                tokenizer_cfg=args.tokenizer_cfg,
+                tokenization_cache=tokenization_cache,
+                unit=args.unit,
+                max_ngram=args.max_ngram,
+                document_frequency_sketch=SketchConfig(width=args.df_sketch_width) if args.df_sketch_width else None,
+                caption_guard=caption_guard,
+            )
+            coco_eval.params["image_id"] = coco_result.getImgIds()
+
+        with timer(timings, "evaluate"):
+            if args.reference_cache:
+                state = EvaluationState.load(args.reference_cache) if Path(args.reference_cache).exists() else None
+                coco_eval.evaluate(state=state)
+                coco_eval.state.save(args.reference_cache)
+            elif args.checkpoint_dir:
+                coco_eval.evaluate(args.checkpoint_dir, **({"chunk_size": args.batch_size} if args.batch_size else {}))
+            elif args.pipelined or args.streaming:
+                chunking = {"chunk_size": args.batch_size} if args.batch_size else {}
+                if args.streaming:
+                    coco_eval.evaluate_stream(results, executor=args.executor, **chunking)
+                else:
+                    coco_eval.evaluate(executor=args.executor, **chunking)
+                pipeline_timings = coco_eval.timings.model_dump()
+                timings.update({f"pipeline.{name}": seconds for name, seconds in pipeline_timings.items()})
+            elif args.mapped_references:
+                coco_eval.preprocessing.batch_size = args.batch_size
+                coco_eval.evaluate(coco_eval.get_mapped_references(args.mapped_references))
+            else:
+                coco_eval.preprocessing.batch_size = args.batch_size
+                coco_eval.evaluate(
+                    workers=args.workers, executor=args.executor, result_store=result_store, verify=args.verify_stored
+                )
+
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if args.image_scores:
+            with timer(timings, "export"):
+                coco_eval.export_image_scores(args.image_scores)
+
+        report = {
+            "annotations": args.annotations,
+            "results": args.results,
+            "language": args.language,
+            "tokenizer": coco_eval.preprocessing.signature,
+            "num_images": len(coco_eval.params["image_id"]),
+            "scores": {name: float(score) for name, score in coco_eval.eval.items()},
+        }
+        if caption_guard is not None:
+            report["guard_report"] = coco_eval.guard_report.model_dump()
+        if coco_eval.sketch_deviation is not None:
+            report["sketch_deviation"] = coco_eval.sketch_deviation.model_dump()
+        if coco_eval.preprocessing.cache is not None:
+            report["tokenization_cache"] = coco_eval.preprocessing.cache.stats.model_dump()
+        if result_store is not None:
+            report["result_store"] = result_store.stats.model_dump()
+        if args.timings:
+            report["timings"] = timings
+            for name, seconds in timings.items():
+                logging.info(f"{name}: {seconds:0.3f}s")
+        write_report(report, args.output)
+
+
+def write_report(report: dict[str, Any], path: Optional[str]) -> None:
+    if path is None:
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        sys.stdout.write("\n")
+    else:
+        with open(path, "w") as fp:
+            json.dump(report, fp, indent=2, ensure_ascii=False)
+
+
+def add_serve_parser(subparsers) -> None:
+    parser = subparsers.add_parser("serve", help="run the local scoring service")
+    parser.add_argument("--host", default="127.0.0.1", help="loopback address to bind to")
+    parser.add_argument("--port", type=int, default=8642)
+    parser.add_argument(
+        "--reference-set",
+        nargs=2,
+        action="append",
+        default=[],
+        metavar=("NAME", "ANNOTATIONS"),
+        help="reference set to load at startup, can be repeated",
+    )
+    parser.add_argument("--language", default="default", help="language of the reference sets loaded at startup")
+    parser.add_argument("--tokenizer-cfg", type=json.loads, help="tokenizer config as JSON")
+    parser.add_argument("--tokenization-cache", help="directory of the tokenization cache")
+    parser.add_argument("--max-caption-chars", type=int, help="truncate the raw captions to this many characters")
+    parser.add_argument("--max-caption-tokens", type=int, help="truncate the tokenized captions to this many tokens")
+    parser.set_defaults(func=run_serve)
+
+
+def run_serve(args: argparse.Namespace) -> None:
+    from multicaptioneval.processing import CaptionGuard, TokenizationCache
+    from multicaptioneval.server import ScoringService, serve
+
+    caption_guard = None
+    if args.max_caption_chars or args.max_caption_tokens:
+        caption_guard = CaptionGuard(max_chars=args.max_caption_chars, max_tokens=args.max_caption_tokens)
+    # The cache is closed when the server stops or fails
+    with ExitStack() as resources:
+        cache = resources.enter_context(TokenizationCache(args.tokenization_cache)) if args.tokenization_cache else None
+        service = ScoringService(tokenization_cache=cache, caption_guard=caption_guard)
+        for name, annotations in args.reference_set:
+            service.add_reference_set(name, annotations, language=args.language, tokenizer_cfg=args.tokenizer_cfg)
+        serve(service, host=args.host, port=args.port)
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="multicaptioneval", description=__doc__)
+    parser.add_argument("--log-level", default="INFO")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    add_evaluate_parser(subparsers)
+    add_serve_parser(subparsers)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(message)s")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
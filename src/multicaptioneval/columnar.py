@@ -0,0 +1,240 @@
+import json
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Iterator, Literal, Optional, Union
+
+import numpy as np
+
+
+# Same as `multicaptioneval.processing.ImageCaptionsType`, redefined to keep the metrics free of tokenizer imports
+ImageCaptionsType = dict[str, list[str]]
+TokenIdsType = list[int]
+CaptionsType = Union[list[str], list[TokenIdsType]]
+# The n-grams of the metrics are made of words (split on whitespace) or characters (ignoring whitespace)
+NgramUnitType = Literal["word", "char"]
+NGRAM_UNITS = ("word", "char")
+
+
+def is_caption(value: Any) -> bool:
+    """Check if the value is a single caption, i.e. a string or a list of token ids."""
+    return isinstance(value, str) or (isinstance(value, list) and (not value or isinstance(value[0], int)))
+
+
+def split_caption(text: Union[str, TokenIdsType], unit: NgramUnitType = "word") -> Union[str, list[Any]]:
+    """Split a caption into the units of its n-grams.
+
+    Characters are returned as a string without whitespace, so that character n-grams are plain substrings.
+    Token ids are used as is.
+    """
+    if not isinstance(text, str):
+        return text
+    if unit == "char":
+        return "".join(text.split())
+    return text.split()
+
+
+# Captions with at least this many units are counted by runs of repeated units, see `count_ngrams`
+RUN_MIN_LENGTH = 64
+
+
+def count_ngrams(units: Union[str, list[Any]], max_ngram: int) -> defaultdict[Any, int]:
+    """Count the n-grams of orders 1 to `max_ngram` of a split caption, as tuples (or substrings of a string).
+
+    Long captions are counted by runs of identical units: the n-grams inside a run of r units are one n-gram
+    occurring r - n + 1 times, so a unit repeated thousands of times only materializes the n-grams that cross the
+    boundaries of its run. The counts and their insertion order are the same as with a sliding window.
+    """
+    counts = defaultdict(int)
+    is_string = isinstance(units, str)
+    if len(units) < RUN_MIN_LENGTH:
+        for ngram_n in range(1, max_ngram + 1):
+            for ngram_start_index in range(len(units) - ngram_n + 1):
+                ngram = units[ngram_start_index : ngram_start_index + ngram_n]
+                counts[ngram if is_string else tuple(ngram)] += 1
+        return counts
+
+    starts = [0, *[index for index in range(1, len(units)) if units[index] != units[index - 1]]]
+    ends = [*starts[1:], len(units)]
+    for ngram_n in range(1, max_ngram + 1):
+        for start, end in zip(starts, ends):
+            if end - start >= ngram_n:
+                ngram = units[start : start + ngram_n]
+                counts[ngram if is_string else tuple(ngram)] += end - start - ngram_n + 1
+            # n-grams starting in the run and ending after it
+            for ngram_start_index in range(max(start, end - ngram_n + 1), min(end, len(units) - ngram_n + 1)):
+                ngram = units[ngram_start_index : ngram_start_index + ngram_n]
+                counts[ngram if is_string else tuple(ngram)] += 1
+    return counts
+
+
+def check_ngram_unit(unit: str) -> None:
+    if unit not in NGRAM_UNITS:
+        raise ValueError(f"Unknown n-gram unit: {unit}, expected one of {NGRAM_UNITS}")
+
+
+class Vocabulary:
+    """Mapping between tokens and integer ids."""
+
+    def __init__(self, tokens: Optional[list[str]] = None) -> None:
+        self.tokens: list[str] = []
+        self._index: dict[str, int] = {}
+        for token in tokens or []:
+            self.add(token)
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def add(self, token: str) -> int:
+        token_id = self._index.get(token)
+        if token_id is None:
+            token_id = self._index[token] = len(self.tokens)
+            self.tokens.append(token)
+        return token_id
+
+    def encode(self, text: str) -> TokenIdsType:
+        return [self.add(token) for token in text.split()]
+
+    def decode(self, token_ids: TokenIdsType) -> str:
+        return " ".join([self.tokens[token_id] for token_id in token_ids])
+
+    def is_compatible(self, other: "Vocabulary") -> bool:
+        """Check if the token ids of the two vocabularies agree, i.e. one extends the other."""
+        if self is other:
+            return True
+        shortest = min(len(self), len(other))
+        return self.tokens[:shortest] == other.tokens[:shortest]
+
+
+class TokenizedCorpus:
+    """Columnar storage of tokenized captions.
+
+    The tokens of all captions are stored in a single `token_ids` array. The i-th image owns the captions
+    `image_offsets[i]` up to (excluding) `image_offsets[i + 1]`, and the tokens of the j-th caption are
+    `token_ids[caption_offsets[j] : caption_offsets[j + 1]]`.
+    """
+
+    def __init__(
+        self,
+        image_ids: list[Any],
+        token_ids: np.ndarray,
+        caption_offsets: np.ndarray,
+        image_offsets: np.ndarray,
+        vocabulary: Vocabulary,
+    ) -> None:
+        if len(image_offsets) != len(image_ids) + 1:
+            raise ValueError(f"image offsets/ids mismatch! {len(image_offsets)}<>{len(image_ids) + 1}")
+        self.image_ids = image_ids
+        self.token_ids = token_ids
+        self.caption_offsets = caption_offsets
+        self.image_offsets = image_offsets
+        self.vocabulary = vocabulary
+
+    @classmethod
+    def from_captions(
+        cls, image_captions: ImageCaptionsType, vocabulary: Optional[Vocabulary] = None
+    ) -> "TokenizedCorpus":
+        """Build the corpus from tokenized captions.
+
+        Pass the same vocabulary when building the references and the results so that the token ids match.
+        """
+        if vocabulary is None:
+            vocabulary = Vocabulary()
+        token_ids = []
+        caption_offsets = [0]
+        image_offsets = [0]
+        for captions in image_captions.values():
+            for caption in captions:
+                token_ids.extend(vocabulary.encode(caption))
+                caption_offsets.append(len(token_ids))
+            image_offsets.append(len(caption_offsets) - 1)
+        return cls(
+            image_ids=list(image_captions.keys()),
+            token_ids=np.array(token_ids, dtype=np.int32),
+            caption_offsets=np.array(caption_offsets, dtype=np.int64),
+            image_offsets=np.array(image_offsets, dtype=np.int64),
+            vocabulary=vocabulary,
+        )
+
+    def __len__(self) -> int:
+        return len(self.image_ids)
+
+    @property
+    def num_captions(self) -> int:
+        return len(self.caption_offsets) - 1
+
+    def keys(self) -> list[Any]:
+        return self.image_ids
+
+    def token_lists(self, image_index: int) -> list[TokenIdsType]:
+        """Get the token ids of each caption of an image."""
+        start, end = self.image_offsets[image_index], self.image_offsets[image_index + 1]
+        offsets = self.caption_offsets[start : end + 1].tolist()
+        tokens = self.token_ids[offsets[0] : offsets[-1]].tolist()
+        base = offsets[0]
+        return [tokens[begin - base : finish - base] for begin, finish in zip(offsets[:-1], offsets[1:])]
+
+    def items(self) -> Iterator[tuple[Any, list[TokenIdsType]]]:
+        for image_index, image_id in enumerate(self.image_ids):
+            yield image_id, self.token_lists(image_index)
+
+    def to_captions(self) -> ImageCaptionsType:
+        """Convert back to the space-separated captions."""
+        return {
+            image_id: [self.vocabulary.decode(tokens) for tokens in captions] for image_id, captions in self.items()
+        }
+
+    def save(self, directory: Union[str, Path]) -> None:
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        np.save(directory / "token_ids.npy", self.token_ids)
+        np.save(directory / "caption_offsets.npy", self.caption_offsets)
+        np.save(directory / "image_offsets.npy", self.image_offsets)
+        with open(directory / "metadata.json", "w") as fp:
+            json.dump({"image_ids": self.image_ids, "vocabulary": self.vocabulary.tokens}, fp, ensure_ascii=False)
+
+    @classmethod
+    def load(
+        cls, directory: Union[str, Path], vocabulary: Optional[Vocabulary] = None, mmap: bool = True
+    ) -> "TokenizedCorpus":
+        """Load a saved corpus, memory-mapping the arrays by default.
+
+        If a vocabulary is given, it is reused so that corpora loaded separately share the same token ids.
+        """
+        directory = Path(directory)
+        mmap_mode = "r" if mmap else None
+        with open(directory / "metadata.json") as fp:
+            metadata = json.load(fp)
+        saved_vocabulary = Vocabulary(metadata["vocabulary"])
+        if vocabulary is None:
+            vocabulary = saved_vocabulary
+        elif not vocabulary.is_compatible(saved_vocabulary):
+            raise ValueError(f"Incompatible vocabulary for the corpus in {directory}")
+        else:
+            for token in saved_vocabulary.tokens[len(vocabulary) :]:
+                vocabulary.add(token)
+        return cls(
+            image_ids=metadata["image_ids"],
+            token_ids=np.load(directory / "token_ids.npy", mmap_mode=mmap_mode),
+            caption_offsets=np.load(directory / "caption_offsets.npy", mmap_mode=mmap_mode),
+            image_offsets=np.load(directory / "image_offsets.npy", mmap_mode=mmap_mode),
+            vocabulary=vocabulary,
+        )
+
+
+def iter_image_captions(
+    ground_truths: Union[ImageCaptionsType, TokenizedCorpus],
+    results: Union[ImageCaptionsType, TokenizedCorpus],
+) -> Iterator[tuple[Any, CaptionsType, CaptionsType]]:
+    """Iterate over (image_id, hypotheses, references) for captions or tokenized corpora."""
+    if isinstance(ground_truths, TokenizedCorpus) or isinstance(results, TokenizedCorpus):
+        if not (isinstance(ground_truths, TokenizedCorpus) and isinstance(results, TokenizedCorpus)):
+            raise TypeError("ground truths and results must both be TokenizedCorpus")
+        if not ground_truths.vocabulary.is_compatible(results.vocabulary):
+            raise ValueError("ground truths and results must share the same vocabulary")
+        assert list(ground_truths.image_ids) == list(results.image_ids)
+        for image_index, image_id in enumerate(ground_truths.image_ids):
+            yield image_id, results.token_lists(image_index), ground_truths.token_lists(image_index)
+    else:
+        assert ground_truths.keys() == results.keys()
+        for image_id in ground_truths.keys():
+            yield image_id, results[image_id], ground_truths[image_id]
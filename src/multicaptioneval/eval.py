@@ -1,11 +1,28 @@
 """
 Following the pycocoevalcap implementation, we implement the evaluation for multilingual captions.
 """
+from multicaptioneval.loader import CaptionIndex
 from multicaptioneval.metrics.bleu.bleu import Bleu
 from multicaptioneval.metrics.cider.cider import Cider
-from multicaptioneval.processing import ImageCaptionsType, ProcessingPipeline
+from multicaptioneval.metrics.cider.sketch import SketchConfig, SketchDeviation
+from multicaptioneval.columnar import NgramUnitType, check_ngram_unit
+from multicaptioneval.processing import (
+    CaptionGuard,
+    CharacterPipeline,
+    GuardReport,
+    ImageCaptionsType,
+    ProcessingPipeline,
+    TokenizationCache,
+)
+from multicaptioneval.parallel import ParallelScorer
+from multicaptioneval.result_store import ResultStore, StoredResult, get_result_key
+from multicaptioneval.scores import ImageScores
+import hashlib
+import json
 import logging
-from typing import Any, Optional, Union
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Literal, Optional, Union
+import numpy as np
 from pycocotools.coco import COCO
 
 
@@ -17,45 +34,208 @@ METRICS = {
 
 MAX_NGRAM_N = 4
 
+# "thread" and "process" compute the metrics concurrently, "shared_memory" splits the images of each metric
+ExecutorType = Literal["thread", "process", "shared_memory"]
+
+# Data shared with the worker processes, set once per worker by the pool initializer
+_WORKER_DATA: tuple[ImageCaptionsType, ImageCaptionsType] = ({}, {})
+
+
+def _set_worker_data(ground_truths: ImageCaptionsType, results: ImageCaptionsType) -> None:
+    global _WORKER_DATA
+    _WORKER_DATA = (ground_truths, results)
+
+
+def _compute_score_in_worker(metric):
+    return metric.compute_score(*_WORKER_DATA)
+
+
+def get_preprocessing(
+    unit: NgramUnitType,
+    language: str,
+    tokenizer_cfg: Optional[dict[str, Any]] = None,
+    tokenization_cache: Optional[TokenizationCache] = None,
+    guard: Optional[CaptionGuard] = None,
+) -> Union[ProcessingPipeline, CharacterPipeline]:
+    """Get the preprocessing of the captions for the n-gram unit of the metrics."""
+    if unit == "char":
+        return CharacterPipeline(guard=guard)
+    return ProcessingPipeline(language=language, tokenizer_cfg=tokenizer_cfg, cache=tokenization_cache, guard=guard)
+
 
 class COCOEvalCap:
     def __init__(
         self,
-        coco: COCO,
-        cocoRes: COCO,
+        coco: Union[COCO, CaptionIndex],
+        cocoRes: Union[COCO, CaptionIndex],
         metrics: Optional[list[str]] = None,
         language: str = "default",
         tokenizer_cfg: Optional[dict[str, Any]] = None,
+        tokenization_cache: Optional[TokenizationCache] = None,
+        unit: NgramUnitType = "word",
+        max_ngram: int = MAX_NGRAM_N,
+        document_frequency_sketch: Optional[SketchConfig] = None,
+        caption_guard: Optional[CaptionGuard] = None,
     ) -> None:
-        # image ids to evaluate
-        self.evalImgs = []
+        """
+        :param unit: count the n-grams of words (tokenized for the language), or of characters ("char", skipping
+            the word segmentation, e.g. for high-volume zh/ja/ko/th evaluation)
+        :param max_ngram: highest n-gram order of the metrics
+        :param document_frequency_sketch: count the CIDEr document frequency in a bounded-memory sketch, the
+            deviation of the scores from the exact document frequency is measured on a sample of the images
+        :param caption_guard: truncate the captions longer than its limits, e.g. degenerate model outputs, the
+            truncated images are listed in `guard_report`
+        """
+        check_ngram_unit(unit)
+        self.unit = unit
+        self.max_ngram = max_ngram
+        self.document_frequency_sketch = document_frequency_sketch
+        # set by `compute_metrics` with the sketch, except in worker processes where it is only logged
+        self.sketch_deviation: Optional[SketchDeviation] = None
         # overall evaluation metrics
         self.eval = {}
-        # evaluation metrics per image
-        self.imgToEval = {}
+        # evaluation metrics per image, stored as one array per metric
+        self.image_scores = ImageScores()
+        self._imgToEval = None
+        self._evalImgs = None
         self.coco = coco
         self.cocoRes = cocoRes
         self.params = {"image_id": coco.getImgIds()}
 
         self.language = language
+        self.caption_guard = caption_guard
         self._setup_metrics(metrics)
-        self._setup_preprocessing(tokenizer_cfg)
+        self._setup_preprocessing(tokenizer_cfg, tokenization_cache)
+
+    def evaluate(
+        self,
+        workers: int = 1,
+        executor: ExecutorType = "process",
+        result_store: Optional[ResultStore] = None,
+        verify: bool = False,
+    ) -> None:
+        """Evaluate the captions.
+
+        :param workers: number of workers to compute the metrics concurrently, 1 computes them one after another
+        :param executor: run the concurrent metrics in worker processes or threads, or split the images of each
+            metric across worker processes reading the captions from shared memory ("shared_memory")
+        :param result_store: return the stored scores of the same inputs and configuration, and store the new ones
+        :param verify: recompute the scores of a stored result and raise a ValueError if they differ
+        """
+        key = None
+        if result_store is not None:
+            key = get_result_key(self.get_inputs_digest(), self.signature)
+            stored = result_store.get(key)
+            if stored is not None and not verify:
+                logging.info(f"Using the stored result {key}")
+                self.eval = dict(stored.eval)
+                self.image_scores = stored.image_scores
+                self.set_eval_per_image()
+                return
+        else:
+            stored = None
 
-    def evaluate(self) -> None:
-        """Evaluate the captions."""
         ground_truths, results = self._prepare_data()
+        self.compute_metrics(ground_truths, results, workers=workers, executor=executor)
+        self.set_eval_per_image()
+        if stored is not None:
+            self._verify_stored_result(stored)
+        elif result_store is not None:
+            result_store.put(key, self.signature, self.eval, self.image_scores)
+
+    def _verify_stored_result(self, stored: StoredResult) -> None:
+        mismatch = [name for name in {**self.eval, **stored.eval} if stored.eval.get(name) != self.eval.get(name)]
+        if stored.image_scores.image_ids != self.image_scores.image_ids:
+            mismatch.append("image_id")
+        for name, column in self.image_scores.scores.items():
+            stored_column = stored.image_scores.scores.get(name)
+            if stored_column is None or not np.array_equal(column, stored_column, equal_nan=True):
+                mismatch.append(f"{name} per image")
+        if mismatch:
+            raise ValueError(f"The stored result {stored.key} does not match the evaluation: {mismatch}")
+        logging.info(f"Verified the stored result {stored.key}")
+
+    @property
+    def signature(self) -> dict[str, Any]:
+        """Identify the configuration of the evaluation (the tokenizer signature includes the package version)."""
+        signature = {
+            "tokenizer": self.preprocessing.signature,
+            "metrics": self.metric_names,
+            "max_ngram": self.max_ngram,
+        }
+        if self.document_frequency_sketch is not None:
+            signature["sketch"] = self.document_frequency_sketch.model_dump()
+        if self.caption_guard is not None:
+            signature["caption_guard"] = self.caption_guard.model_dump()
+        return signature
+
+    @property
+    def guard_report(self) -> GuardReport:
+        """Images with a caption truncated by the caption guard."""
+        return self.preprocessing.guard_report
+
+    def get_inputs_digest(self, image_ids: Optional[list[Any]] = None) -> str:
+        """Hash the inputs of the evaluation: the image ids with their raw reference and result captions."""
+        digest = hashlib.sha256()
+        for image_id in self.params["image_id"] if image_ids is None else image_ids:
+            references = [ann["caption"] for ann in self.coco.imgToAnns[image_id]]
+            results = [ann["caption"] for ann in self.cocoRes.imgToAnns[image_id]]
+            digest.update(json.dumps([image_id, references, results], ensure_ascii=False, default=str).encode())
+        return digest.hexdigest()
+
+    def compute_metrics(
+        self,
+        ground_truths: ImageCaptionsType,
+        results: ImageCaptionsType,
+        workers: int = 1,
+        executor: ExecutorType = "process",
+    ) -> None:
+        """Compute the metrics on the preprocessed captions.
+
+        The scores are stored in the order of the metrics, regardless of the order in which the workers finish.
+        """
         metrics = self._initializa_metrics()
-        # Compute scores
+        if executor == "shared_memory" and workers > 1:
+            metric_scores = ParallelScorer(workers).compute_scores(metrics, ground_truths, results)
+        elif min(workers, len(metrics)) <= 1:
+            metric_scores = []
+            for metric in metrics:
+                logging.info(f"Computing {metric.method} score...")
+                metric_scores.append(metric.compute_score(ground_truths, results))
+        else:
+            workers = min(workers, len(metrics))
+            logging.info(f"Computing {', '.join(metric.method for metric in metrics)} scores with {workers} workers...")
+            with self._get_executor(ground_truths, results, workers, executor) as pool:
+                if executor == "process":
+                    futures = [pool.submit(_compute_score_in_worker, metric) for metric in metrics]
+                else:
+                    futures = [pool.submit(metric.compute_score, ground_truths, results) for metric in metrics]
+                metric_scores = [future.result() for future in futures]
+
         for metric in metrics:
-            logging.info(f"Computing {metric.method} score...")
-            score, scores = metric.compute_score(ground_truths, results)
+            if isinstance(metric, Cider) and metric.sketch_deviation is not None:
+                self.sketch_deviation = metric.sketch_deviation
+        for metric, (score, scores) in zip(metrics, metric_scores):
             self.print_scores(
                 score_names=metric.score_names,
                 overall_score=score,
                 image_scores=scores,
                 image_ids=list(ground_truths.keys()),
             )
-        self.set_eval_per_image()
+
+    def _get_executor(
+        self, ground_truths: ImageCaptionsType, results: ImageCaptionsType, workers: int, executor: ExecutorType
+    ) -> Executor:
+        if executor == "thread":
+            return ThreadPoolExecutor(max_workers=workers)
+        elif executor == "process":
+            # The data are passed once per worker; with the fork start method they are inherited without copying
+            return ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_set_worker_data,
+                initargs=(ground_truths, results),
+            )
+        raise ValueError(f"Unknown executor: {executor}")
 
     def get_scores(self):
         return self.eval
@@ -65,14 +245,42 @@ class COCOEvalCap:
         self.eval[method] = score
 
     def set_image_to_eval(self, scores: list[float], imgIds: list[str], method: str) -> None:
-        for imgId, score in zip(imgIds, scores):
-            if imgId not in self.imgToEval:
-                self.imgToEval[imgId] = {}
-                self.imgToEval[imgId]["image_id"] = imgId
-            self.imgToEval[imgId][method] = score
+        self.image_scores.set(method, imgIds, scores)
+        self._imgToEval = self._evalImgs = None
+
+    @property
+    def imgToEval(self) -> dict[Any, dict[str, Any]]:
+        """Evaluation metrics per image, built from `image_scores` on first access."""
+        if self._imgToEval is None:
+            self._imgToEval = self.image_scores.to_dict()
+        return self._imgToEval
+
+    @imgToEval.setter
+    def imgToEval(self, value: dict[Any, dict[str, Any]]) -> None:
+        # Kept until the scores change, as with pycocoevalcap code that assigns it
+        self._imgToEval = value
+
+    @property
+    def evalImgs(self) -> list[dict[str, Any]]:
+        if self._evalImgs is None:
+            return list(self.imgToEval.values())
+        return self._evalImgs
+
+    @evalImgs.setter
+    def evalImgs(self, value: list[dict[str, Any]]) -> None:
+        self._evalImgs = value
 
     def set_eval_per_image(self) -> None:
-        self.evalImgs = [eval for _, eval in self.imgToEval.items()]
+        # The per-image evaluation is built lazily, see `imgToEval`
+        self._imgToEval = self._evalImgs = None
+
+    def get_image_scores(self) -> np.ndarray:
+        """Get the per-image scores as a structured array with the image_id and a field per metric."""
+        return self.image_scores.to_structured()
+
+    def export_image_scores(self, path: str, file_format: Optional[str] = None) -> None:
+        """Save the per-image scores as .npz, .csv or .parquet."""
+        self.image_scores.save(path, file_format=file_format)
 
     def print_scores(
         self,
@@ -98,20 +306,55 @@ class COCOEvalCap:
         else:
             self.metric_names = []
             for metric in metrics:
-                metric = metric.lower
+                metric = metric.lower()
                 if metric not in METRICS:
                     raise ValueError(f"Unknown metric: {metric}")
                 self.metric_names.append(metric)
 
-    def _setup_preprocessing(self, tokenizer_cfg) -> None:
-        self.preprocessing = ProcessingPipeline(
-            language=self.language,
-            tokenizer_cfg=tokenizer_cfg,
+    def _setup_preprocessing(self, tokenizer_cfg, tokenization_cache: Optional[TokenizationCache] = None) -> None:
+        self.preprocessing = get_preprocessing(
+            self.unit, self.language, tokenizer_cfg, tokenization_cache, guard=self.caption_guard
         )
 
     def _initializa_metrics(self):
         logging.info("Initializa the metrics...")
-        return [METRICS[metric](MAX_NGRAM_N) for metric in self.metric_names]
+        metrics = [METRICS[metric](self.max_ngram, unit=self.unit) for metric in self.metric_names]
+        for metric in metrics:
+            if isinstance(metric, Cider):
+                metric.sketch = self.document_frequency_sketch
+        return metrics
+
+    def _initializa_chunked_metrics(self, mode: str) -> list[Union[Bleu, Cider]]:
+        """Initialize the metrics of an evaluation that counts the n-grams chunk by chunk, i.e. BLEU and CIDEr.
+
+        :param mode: name of the evaluation in the error raised for the other metrics, before any work is done
+        """
+        metrics = self._initializa_metrics()
+        for metric in metrics:
+            if not isinstance(metric, (Bleu, Cider)):
+                raise ValueError(f"{mode} evaluation is not supported for {metric.method}")
+        return metrics
+
+    def _count_chunk(
+        self,
+        metrics: list[Union[Bleu, Cider]],
+        scorers: list[Any],
+        ground_truths: ImageCaptionsType,
+        results: ImageCaptionsType,
+    ) -> None:
+        """Add the n-gram statistics of a chunk of preprocessed images to the scorers (see `Bleu.new_scorer`)."""
+        for metric, scorer in zip(metrics, scorers):
+            metric.build_scorer(ground_truths, results, scorer)
+
+    def _set_chunked_scores(self, metrics: list[Union[Bleu, Cider]], scorers: list[Any], image_ids: list[Any]) -> None:
+        """Compute the scores from the statistics of all the chunks and set them for the images."""
+        for metric, scorer in zip(metrics, scorers):
+            logging.info(f"Computing {metric.method} score...")
+            score, scores = metric.compute_scores(scorer)
+            if isinstance(metric, Cider) and metric.sketch_deviation is not None:
+                self.sketch_deviation = metric.sketch_deviation
+            self.print_scores(metric.score_names, score, scores, image_ids)
+        self.set_eval_per_image()
 
     def _prepare_data(self) -> tuple[ImageCaptionsType, ImageCaptionsType]:
         """Prepare the data for evaluation."""
@@ -126,3 +369,9 @@ class COCOEvalCap:
         gts = self.preprocessing(gts)
         res = self.preprocessing(res)
         return gts, res
+
+    def _prepare_chunk(self, image_ids: list[Any]) -> tuple[ImageCaptionsType, ImageCaptionsType]:
+        """Preprocess the references and the results of a chunk of images."""
+        ground_truths = self.preprocessing({image_id: self.coco.imgToAnns[image_id] for image_id in image_ids})
+        results = self.preprocessing({image_id: self.cocoRes.imgToAnns[image_id] for image_id in image_ids})
+        return ground_truths, results
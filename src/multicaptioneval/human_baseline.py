@@ -0,0 +1,183 @@
+"""
+Leave-one-out human baseline: each reference is scored against the remaining references of its image.
+
+Fold k scores the k-th reference of every image (with at least two references) against the others, which
+is equivalent to K evaluations with `Bleu` and `Cider`. Here every reference is counted once, and each fold is
+derived from the counts: the BLEU clip counts from the two largest counts of every n-gram, and the CIDEr
+document frequency by removing the n-grams that only appear in the held-out references.
+`HumanBaselineCOCOEvalCap` computes the baseline of the references of an evaluation.
+"""
+import logging
+from collections import defaultdict
+from typing import Any
+
+import numpy as np
+
+from multicaptioneval.columnar import NgramUnitType
+from multicaptioneval.eval import COCOEvalCap
+from multicaptioneval.metrics.bleu.bleu_scorer import BleuScorer
+from multicaptioneval.metrics.bleu.data import BleuHypothesisStats, BleuNgramCounts, BleuStatsCounter
+from multicaptioneval.metrics.cider.cider_scorer import CiderMetric
+from multicaptioneval.metrics.cider.data import CiderNgramCounter, NgramCountType
+from multicaptioneval.processing import ImageCaptionsType
+from multicaptioneval.scores import ImageScores
+
+
+class HumanBaseline:
+    """Compute the leave-one-out BLEU and CIDEr scores of the references."""
+
+    def __init__(self, ngram_n: int = 4, sigma: float = 6.0, unit: NgramUnitType = "word") -> None:
+        self._ngram_n = ngram_n
+        self._sigma = sigma
+        self._unit = unit
+
+    @property
+    def score_names(self) -> list[str]:
+        return [f"Bleu_{n}" for n in range(1, self._ngram_n + 1)] + ["CIDEr"]
+
+    def compute_score(self, ground_truths: ImageCaptionsType) -> tuple[dict[str, Any], ImageScores]:
+        """Compute the human baseline.
+
+        :param ground_truths: image id -> preprocessed references
+        :return: the scores ({"folds": [metric -> score per fold], "corpus": metric -> mean over the folds}),
+            and the per-image scores averaged over the folds of each image
+        """
+        image_ids = [image_id for image_id, references in ground_truths.items() if len(references) > 1]
+        if not image_ids:
+            raise ValueError("The human baseline requires images with at least two references")
+        if len(image_ids) < len(ground_truths):
+            logging.info(f"Skipping {len(ground_truths) - len(image_ids)} images with a single reference")
+        references = [ground_truths[image_id] for image_id in image_ids]
+        num_folds = max(len(refs) for refs in references)
+
+        bleu_scorer = BleuScorer(max_ngram=self._ngram_n)
+        bleu_counter = BleuStatsCounter(self._ngram_n, unit=self._unit)
+        bleu_counts = [[bleu_counter._precook(ref) for ref in refs] for refs in references]
+        clip_tables = [self._clip_table(counts) for counts in bleu_counts]
+        cider_counts = [CiderNgramCounter(self._ngram_n, unit=self._unit)(refs) for refs in references]
+        # Number of references of each image that contain each n-gram
+        ngram_refs = [self._count_references(counts) for counts in cider_counts]
+        document_frequency = defaultdict(float)
+        for image_ngram_refs in ngram_refs:
+            for ngram in image_ngram_refs:
+                document_frequency[ngram] += 1
+
+        folds = []
+        image_scores = np.zeros((len(image_ids), self._ngram_n + 1))
+        image_folds = np.zeros(len(image_ids))
+        for fold in range(num_folds):
+            indices = [index for index, refs in enumerate(references) if len(refs) > fold]
+            logging.info(
+                f"Computing the human baseline for reference {fold + 1} of {num_folds} ({len(indices)} images)..."
+            )
+            bleu_score, bleu_scores = self._bleu_fold(
+                bleu_scorer, [bleu_counts[index] for index in indices], [clip_tables[index] for index in indices], fold
+            )
+            cider_score, cider_scores = self._cider_fold(
+                cider_counts, ngram_refs, document_frequency, indices, fold
+            )
+            folds.append({**dict(zip(self.score_names, bleu_score)), "CIDEr": float(cider_score)})
+            image_scores[indices] += np.column_stack([*bleu_scores, cider_scores])
+            image_folds[indices] += 1
+
+        corpus = {name: float(np.mean([fold_scores[name] for fold_scores in folds])) for name in self.score_names}
+        per_image = ImageScores()
+        image_scores /= image_folds[:, None]
+        for column, name in enumerate(self.score_names):
+            per_image.set(name, image_ids, image_scores[:, column])
+        return {"folds": folds, "corpus": corpus}, per_image
+
+    def _count_references(self, counts: list[NgramCountType]) -> dict[Any, int]:
+        ngram_refs = defaultdict(int)
+        for ref_counts in counts:
+            for ngram in ref_counts:
+                ngram_refs[ngram] += 1
+        return ngram_refs
+
+    def _clip_table(self, counts: list[BleuNgramCounts]) -> dict[Any, tuple[int, int, int]]:
+        """Get the largest count of each n-gram, the reference it comes from, and the second largest count.
+
+        Without reference k, the clip count of an n-gram is the second largest count if the largest comes from k.
+        """
+        table = {}
+        for ref_index, ref in enumerate(counts):
+            for ngram, count in ref.max_ngram_counts.items():
+                first, first_index, second = table.get(ngram, (0, -1, 0))
+                if count > first:
+                    table[ngram] = (count, ref_index, first)
+                elif count > second:
+                    table[ngram] = (first, first_index, count)
+        return table
+
+    def _bleu_fold(
+        self,
+        scorer: BleuScorer,
+        counts: list[list[BleuNgramCounts]],
+        clip_tables: list[dict[Any, tuple[int, int, int]]],
+        fold: int,
+    ) -> tuple[list[float], list[list[float]]]:
+        totalstats = scorer.new_totalstats()
+        bleu_list = [[] for _ in range(self._ngram_n)]
+        for image_counts, clip_table in zip(counts, clip_tables):
+            hypothesis = image_counts[fold]
+            others = image_counts[:fold] + image_counts[fold + 1 :]
+            correct_ngrams = [0] * self._ngram_n
+            for ngram, count in hypothesis.max_ngram_counts.items():
+                first, first_index, second = clip_table[ngram]
+                max_count = second if first_index == fold else first
+                correct_ngrams[len(ngram) - 1] += min(max_count, count)
+            stats = BleuHypothesisStats(
+                length=hypothesis.length,
+                referene_lengths=[ref.length for ref in others],
+                total_ngrams=[max(0, hypothesis.length - k + 1) for k in range(1, self._ngram_n + 1)],
+                correct_ngrams=correct_ngrams,
+            )
+            reflen = scorer.get_reflen(stats, "closest")
+            for ngram_n, score in enumerate(scorer.compute_image_bleu(stats, reflen)):
+                bleu_list[ngram_n].append(score)
+            scorer.add_stats(totalstats, stats, reflen)
+        return scorer.aggregate_bleu_scores(totalstats), bleu_list
+
+    def _cider_fold(
+        self,
+        counts: list[list[NgramCountType]],
+        ngram_refs: list[dict[Any, int]],
+        document_frequency: dict[Any, float],
+        indices: list[int],
+        fold: int,
+    ) -> tuple[float, np.ndarray]:
+        # Remove the n-grams that only appear in the held-out reference, and the images without this fold
+        fold_document_frequency = document_frequency.copy()
+        in_fold = set(indices)
+        for index, image_ngram_refs in enumerate(ngram_refs):
+            if index in in_fold:
+                for ngram in counts[index][fold]:
+                    if image_ngram_refs[ngram] == 1:
+                        fold_document_frequency[ngram] -= 1
+            else:
+                for ngram in image_ngram_refs:
+                    fold_document_frequency[ngram] -= 1
+
+        metric = CiderMetric(ngram_n=self._ngram_n, sigma=self._sigma)
+        metric.document_frequency = fold_document_frequency
+        metric.ref_len = np.log(float(len(indices)))
+        scores = metric.score_images(
+            crefs=[counts[index][:fold] + counts[index][fold + 1 :] for index in indices],
+            ctest=[counts[index][fold] for index in indices],
+        )
+        return np.mean(np.array(scores)), np.array(scores)
+
+
+class HumanBaselineCOCOEvalCap(COCOEvalCap):
+    """COCOEvalCap that scores the references against each other, see `evaluate_human_baseline`."""
+
+    def evaluate_human_baseline(self) -> tuple[dict[str, Any], ImageScores]:
+        """Score each reference against the other references of its image (leave-one-out), preprocessing once.
+
+        Only the references are used, images with a single reference are skipped.
+        :return: the scores of each fold and their mean (see `HumanBaseline.compute_score`), and the per-image scores
+        """
+        ground_truths = {image_id: self.coco.imgToAnns[image_id] for image_id in self.params["image_id"]}
+        logging.info("Apply the preprocessing (normalize unicode, tokenize, remove punctuation)...")
+        ground_truths = self.preprocessing(ground_truths)
+        return HumanBaseline(ngram_n=self.max_ngram, unit=self.unit).compute_score(ground_truths)
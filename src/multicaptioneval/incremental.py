@@ -0,0 +1,168 @@
+"""
+Incremental re-evaluation of result files that differ from a previous run in a few captions.
+
+BLEU corpus statistics are sums over images and the CIDEr document frequency only depends on the references,
+so only the images whose captions changed need to be preprocessed and rescored.
+"""
+import copy
+import hashlib
+import json
+import logging
+import pickle
+from pathlib import Path
+from typing import Any, Optional, Union
+
+import numpy as np
+
+from multicaptioneval.eval import COCOEvalCap
+from multicaptioneval.metrics.bleu.bleu import Bleu
+from multicaptioneval.processing import ImageCaptionsType
+
+
+class EvaluationState:
+    """Preprocessed captions and sufficient statistics of an evaluation."""
+
+    def __init__(
+        self,
+        signature: dict[str, Any],
+        image_ids: list[Any],
+        references_digest: str,
+        raw_hypotheses: dict[Any, list[str]],
+        hypotheses: ImageCaptionsType,
+        references: ImageCaptionsType,
+    ) -> None:
+        self.signature = signature
+        self.image_ids = image_ids
+        self.references_digest = references_digest
+        self.raw_hypotheses = raw_hypotheses
+        self.hypotheses = hypotheses
+        self.references = references
+        # BLEU per-image statistics, corpus statistics and per-image scores (one list per n-gram order)
+        self.bleu_stats = []
+        self.bleu_totals = {}
+        self.bleu_scores = []
+        # CIDEr document frequency, log number of images and per-image scores
+        self.cider_document_frequency = {}
+        self.cider_ref_len = 0.0
+        self.cider_scores = np.zeros(0)
+
+    def save(self, path: Union[str, Path]) -> None:
+        with open(path, "wb") as fp:
+            pickle.dump(self, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "EvaluationState":
+        with open(path, "rb") as fp:
+            state = pickle.load(fp)
+        if not isinstance(state, cls):
+            raise TypeError(f"Not an evaluation state: {type(state)}")
+        return state
+
+
+class IncrementalCOCOEvalCap(COCOEvalCap):
+    """COCOEvalCap that can reuse the state of a previous evaluation with the same references.
+
+    Only the images whose result captions changed are preprocessed and rescored, and the results are identical
+    to a fresh evaluation. After `evaluate`, the new state is available as `self.state`.
+    """
+
+    state: Optional[EvaluationState] = None
+
+    def evaluate(self, state: Optional[EvaluationState] = None) -> None:
+        """Evaluate the captions, reusing a previous state when it is compatible."""
+        image_ids = list(self.params["image_id"])
+        raw_hypotheses = self._raw_captions(self.cocoRes, image_ids)
+        references_digest = self._references_digest(image_ids)
+        if state is not None and self._is_compatible(state, image_ids, references_digest):
+            self._evaluate_incremental(state, raw_hypotheses)
+        else:
+            if state is not None:
+                logging.info("The previous evaluation state does not match, evaluating all images...")
+            self._evaluate_full(image_ids, raw_hypotheses, references_digest)
+        self.set_eval_per_image()
+
+    def _is_compatible(self, state: EvaluationState, image_ids: list[Any], references_digest: str) -> bool:
+        return (
+            state.signature == self.signature
+            and state.image_ids == image_ids
+            and state.references_digest == references_digest
+        )
+
+    def _raw_captions(self, coco, image_ids: list[Any]) -> dict[Any, list[str]]:
+        return {image_id: [ann["caption"] for ann in coco.imgToAnns[image_id]] for image_id in image_ids}
+
+    def _references_digest(self, image_ids: list[Any]) -> str:
+        digest = hashlib.sha256()
+        for image_id, captions in self._raw_captions(self.coco, image_ids).items():
+            digest.update(json.dumps([image_id, captions], ensure_ascii=False, default=str).encode())
+        return digest.hexdigest()
+
+    def _evaluate_full(
+        self, image_ids: list[Any], raw_hypotheses: dict[Any, list[str]], references_digest: str
+    ) -> None:
+        ground_truths, results = self._prepare_data()
+        state = EvaluationState(
+            signature=self.signature,
+            image_ids=image_ids,
+            references_digest=references_digest,
+            raw_hypotheses=raw_hypotheses,
+            hypotheses=results,
+            references=ground_truths,
+        )
+        for metric in self._initializa_chunked_metrics("Incremental"):
+            logging.info(f"Computing {metric.method} score...")
+            scorer = metric.build_scorer(ground_truths, results)
+            score, scores = metric.compute_scores(scorer)
+            if isinstance(metric, Bleu):
+                state.bleu_stats = list(scorer.data.hypotheses)
+                state.bleu_totals = scorer.new_totalstats()
+                for stats in state.bleu_stats:
+                    scorer.add_stats(state.bleu_totals, stats, scorer.get_reflen(stats, "closest"))
+                state.bleu_scores = [list(image_scores) for image_scores in scores]
+            else:
+                state.cider_document_frequency = scorer.cider.document_frequency
+                state.cider_ref_len = scorer.cider.ref_len
+                state.cider_scores = scores
+            self.print_scores(metric.score_names, score, scores, image_ids)
+        self.state = state
+
+    def _evaluate_incremental(self, previous: EvaluationState, raw_hypotheses: dict[Any, list[str]]) -> None:
+        image_ids = previous.image_ids
+        changed = [image_id for image_id in image_ids if raw_hypotheses[image_id] != previous.raw_hypotheses[image_id]]
+        logging.info(f"Rescoring {len(changed)} of {len(image_ids)} images with changed captions...")
+        positions = {image_id: position for position, image_id in enumerate(image_ids)}
+        if changed:
+            changed_results = self.preprocessing({image_id: self.cocoRes.imgToAnns[image_id] for image_id in changed})
+        else:
+            changed_results = {}
+        changed_references = {image_id: previous.references[image_id] for image_id in changed}
+
+        state = copy.copy(previous)
+        state.raw_hypotheses = raw_hypotheses
+        state.hypotheses = {**previous.hypotheses, **changed_results}
+        for metric in self._initializa_chunked_metrics("Incremental"):
+            scorer = metric.build_scorer(changed_references, changed_results)
+            if isinstance(metric, Bleu):
+                state.bleu_stats = list(previous.bleu_stats)
+                state.bleu_totals = copy.deepcopy(previous.bleu_totals)
+                state.bleu_scores = [list(image_scores) for image_scores in previous.bleu_scores]
+                for image_id, stats in zip(changed, scorer.data.hypotheses):
+                    position = positions[image_id]
+                    old_stats = state.bleu_stats[position]
+                    scorer.add_stats(state.bleu_totals, old_stats, scorer.get_reflen(old_stats, "closest"), sign=-1)
+                    reflen = scorer.get_reflen(stats, "closest")
+                    scorer.add_stats(state.bleu_totals, stats, reflen)
+                    state.bleu_stats[position] = stats
+                    for ngram_n, score in enumerate(scorer.compute_image_bleu(stats, reflen)):
+                        state.bleu_scores[ngram_n][position] = score
+                score, scores = scorer.aggregate_bleu_scores(state.bleu_totals), state.bleu_scores
+            else:
+                scorer.cider.document_frequency = previous.cider_document_frequency
+                scorer.cider.ref_len = previous.cider_ref_len
+                state.cider_scores = previous.cider_scores.copy()
+                changed_scores = scorer.cider.score_images(crefs=scorer.data.references, ctest=scorer.data.hypotheses)
+                for image_id, image_score in zip(changed, changed_scores):
+                    state.cider_scores[positions[image_id]] = image_score
+                score, scores = np.mean(state.cider_scores), state.cider_scores
+            self.print_scores(metric.score_names, score, scores, image_ids)
+        self.state = state
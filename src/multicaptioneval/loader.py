@@ -0,0 +1,101 @@
+"""
+Lightweight loader for COCO-style caption files.
+
+`pycocotools.coco.COCO` builds indexes for annotations, images and categories and deep-copies the results
+in `loadRes`. For caption evaluation we only need the captions of each image, so `CaptionIndex` builds only
+that index and can be used instead of `COCO` in `COCOEvalCap`.
+"""
+import json
+import logging
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import IO, Any, Iterable, Iterator, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def load_json(path: Union[str, Path]) -> Any:
+    """Load a JSON file, using orjson if it is installed."""
+    if orjson is not None:
+        with open(path, "rb") as fp:
+            return orjson.loads(fp.read())
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def iter_json_lines(source: Union[str, Path, IO[str]]) -> Iterator[Any]:
+    """Read a JSON Lines file (or an open text stream, e.g. stdin) one line at a time."""
+    if isinstance(source, (str, Path)):
+        with open(source) as fp:
+            yield from iter_json_lines(fp)
+        return
+    loads = orjson.loads if orjson is not None else json.loads
+    for line in source:
+        if line.strip():
+            yield loads(line)
+
+
+def load_json_lines(source: Union[str, Path, IO[str]]) -> list[Any]:
+    """Load all the records of a JSON Lines file (or an open text stream) in a list, see `iter_json_lines`."""
+    return list(iter_json_lines(source))
+
+
+class CaptionIndex:
+    """Index of the captions per image, with the subset of the `COCO` API used for caption evaluation."""
+
+    def __init__(self, image_ids: Iterable[Any], annotations: Iterable[dict[str, Any]]) -> None:
+        self.imgs = {image_id: {"id": image_id} for image_id in image_ids}
+        self.imgToAnns = defaultdict(list)
+        for annotation in annotations:
+            if annotation["image_id"] in self.imgs:
+                self.imgToAnns[annotation["image_id"]].append(annotation)
+
+    @classmethod
+    def from_dataset(cls, dataset: dict[str, Any], image_ids: Optional[Iterable[Any]] = None) -> "CaptionIndex":
+        """Index a COCO-style dataset, keeping only the given images if `image_ids` is set."""
+        all_image_ids = [image["id"] for image in dataset["images"]]
+        if image_ids is not None:
+            image_ids = set(image_ids)
+            all_image_ids = [image_id for image_id in all_image_ids if image_id in image_ids]
+        return cls(all_image_ids, dataset["annotations"])
+
+    @classmethod
+    def from_file(cls, annotation_file: Union[str, Path], image_ids: Optional[Iterable[Any]] = None) -> "CaptionIndex":
+        """Load a COCO-style annotation file, keeping only the given images if `image_ids` is set."""
+        logging.info(f"Loading annotations from {annotation_file}...")
+        start = time.perf_counter()
+        index = cls.from_dataset(load_json(annotation_file), image_ids=image_ids)
+        logging.info(f"Loaded {len(index.imgs)} images in {time.perf_counter() - start:0.2f}s")
+        return index
+
+    def getImgIds(self) -> list[Any]:
+        return list(self.imgs.keys())
+
+    def loadRes(
+        self, results: Union[str, Path, list[dict[str, Any]]], image_ids: Optional[Iterable[Any]] = None
+    ) -> "CaptionIndex":
+        """Load the results for the images of this index, similar to `COCO.loadRes`.
+
+        :param results: path to a results file (JSON, or JSON Lines with a .jsonl suffix) or the list of result
+            annotations
+        :param image_ids: optional subset of the images to keep
+        """
+        if isinstance(results, (str, Path)):
+            results = load_json_lines(results) if Path(results).suffix == ".jsonl" else load_json(results)
+        if not isinstance(results, list):
+            raise TypeError(f"results must be a list of annotations: {type(results)}")
+
+        result_image_ids = {annotation["image_id"] for annotation in results}
+        unknown_images = result_image_ids.difference(self.imgs)
+        if unknown_images:
+            raise ValueError(f"Results do not correspond to the annotations: {len(unknown_images)} unknown images")
+        if image_ids is not None:
+            result_image_ids.intersection_update(image_ids)
+        for idx, annotation in enumerate(results):
+            annotation["id"] = idx + 1
+        # Keep the order of the annotation images, same as `COCO.loadRes`
+        return CaptionIndex([image_id for image_id in self.imgs if image_id in result_image_ids], results)
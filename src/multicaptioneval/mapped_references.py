@@ -0,0 +1,390 @@
+"""
+Read-only reference statistics shared by the evaluation processes of a host through memory-mapped files.
+
+The statistics of a reference set are built once per (references, tokenizer, n-gram unit, max_ngram) in a
+directory of .npy files: the tokenized references, a table of the distinct reference n-grams with their CIDEr
+document frequency, the n-gram counts of each reference caption and the BLEU max counts of each image. The
+processes that open it map the arrays read-only, so they share the page cache instead of holding their own copies.
+
+The n-grams are stored as rows of token ids sorted by a 64-bit key, and looked up with a binary search that checks
+the tokens. Scoring an image rebuilds the counts of its references only, and runs the same steps as `Bleu` and
+`Cider`, so the scores are identical to the ones of `COCOEvalCap.evaluate`. `MappedCOCOEvalCap` evaluates against
+the statistics, preprocessing only the results.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Any, Optional, Union
+
+import numpy as np
+
+from multicaptioneval.columnar import (
+    ImageCaptionsType,
+    NgramUnitType,
+    TokenizedCorpus,
+    Vocabulary,
+    check_ngram_unit,
+    count_ngrams,
+    split_caption,
+)
+from multicaptioneval.eval import COCOEvalCap
+from multicaptioneval.metrics.bleu.bleu import Bleu
+from multicaptioneval.metrics.bleu.bleu_scorer import OPTIONS, BleuScorer
+from multicaptioneval.metrics.bleu.data import BleuHypothesisStats, BleuReferences
+from multicaptioneval.metrics.cider.cider import Cider
+from multicaptioneval.metrics.cider.cider_scorer import CiderMetric
+
+FORMAT_VERSION = 1
+# name -> dtype of the arrays next to the references corpus
+STATISTICS_ARRAYS = {
+    # distinct reference n-grams sorted by key, padded with -1
+    "ngram_keys": np.uint64,
+    "ngram_tokens": np.int32,
+    "document_frequency": np.float64,
+    # n-grams (rows of the table) and counts of each reference caption, in counting order
+    "caption_ngram_offsets": np.int64,
+    "caption_ngrams": np.int32,
+    "caption_ngram_counts": np.int32,
+    # n-grams (sorted) and max counts over the references of each image
+    "image_ngram_offsets": np.int64,
+    "image_ngrams": np.int32,
+    "image_max_counts": np.int32,
+}
+_KEY_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+_MAX_KEY_SEEDS = 16
+
+
+def _ngram_keys(rows: np.ndarray, seed: int) -> np.ndarray:
+    """Hash the rows of token ids (padded with -1) to 64-bit keys."""
+    keys = np.full(len(rows), seed, dtype=np.uint64)
+    for column in rows.astype(np.int64).T:
+        keys = (keys ^ column.astype(np.uint64)) * _KEY_MULTIPLIER
+        keys ^= keys >> np.uint64(29)
+    return keys
+
+
+def _ngram_rows(ngrams: list[tuple[int, ...]], max_ngram: int) -> np.ndarray:
+    rows = np.full((len(ngrams), max_ngram), -1, dtype=np.int64)
+    for row, ngram in enumerate(ngrams):
+        rows[row, : len(ngram)] = ngram
+    return rows
+
+
+def _encode(captions: list[str], vocabulary: Vocabulary, unit: NgramUnitType) -> list[list[int]]:
+    """Encode the captions as token ids, with a token per character for the "char" unit."""
+    if unit == "char":
+        return [[vocabulary.add(character) for character in split_caption(caption, unit)] for caption in captions]
+    return [vocabulary.encode(caption) for caption in captions]
+
+
+def get_mapped_references_key(
+    signature: dict[str, Any], image_ids: list[Any], references: dict[Any, list[str]]
+) -> str:
+    """Get the key of the statistics of the raw reference captions of the images for a configuration."""
+    digest = hashlib.sha256(json.dumps(signature, sort_keys=True, default=str).encode())
+    for image_id in image_ids:
+        digest.update(json.dumps([image_id, references[image_id]], ensure_ascii=False, default=str).encode())
+    return digest.hexdigest()
+
+
+class MappedReferenceStatistics:
+    """Memory-mapped statistics of a reference set, see `build` and `open`."""
+
+    def __init__(self, directory: Union[str, Path]) -> None:
+        self.directory = Path(directory)
+        with open(self.directory / "statistics.json") as fp:
+            metadata = json.load(fp)
+        if metadata["format_version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported reference statistics format: {metadata['format_version']}")
+        # as stored in JSON, see `same_signature`
+        self.signature: dict[str, Any] = metadata["signature"]
+        self.unit: NgramUnitType = metadata["unit"]
+        self.max_ngram: int = metadata["max_ngram"]
+        self._key_seed: int = metadata["key_seed"]
+        self.corpus = TokenizedCorpus.load(self.directory / "references", mmap=True)
+        self.arrays = {name: np.load(self.directory / f"{name}.npy", mmap_mode="r") for name in STATISTICS_ARRAYS}
+        self.ref_len = np.log(float(len(self.corpus)))
+
+    def same_signature(self, signature: dict[str, Any]) -> bool:
+        return self.signature == json.loads(json.dumps(signature, default=str))
+
+    @property
+    def image_ids(self) -> list[Any]:
+        return self.corpus.image_ids
+
+    @classmethod
+    def open(cls, directory: Union[str, Path]) -> "MappedReferenceStatistics":
+        return cls(directory)
+
+    @classmethod
+    def build(
+        cls,
+        directory: Union[str, Path],
+        references: ImageCaptionsType,
+        signature: Optional[dict[str, Any]] = None,
+        max_ngram: int = 4,
+        unit: NgramUnitType = "word",
+    ) -> "MappedReferenceStatistics":
+        """Count the statistics of the preprocessed references and write them to `directory`.
+
+        The files are written to a temporary directory renamed to `directory`, so concurrent builders of the same
+        statistics do not see partial files: the first rename wins and the other builders open its directory.
+        """
+        check_ngram_unit(unit)
+        directory = Path(directory)
+        directory.parent.mkdir(parents=True, exist_ok=True)
+        logging.info(f"Building the reference statistics of {len(references)} images in {directory}...")
+        vocabulary = Vocabulary()
+        image_ids = list(references.keys())
+        encoded = {image_id: _encode(references[image_id], vocabulary, unit) for image_id in image_ids}
+        corpus = TokenizedCorpus(image_ids, *cls._corpus_arrays(encoded), vocabulary=vocabulary)
+
+        # Provisional n-gram ids in order of appearance, renumbered in key order below
+        ngram_ids: dict[tuple[int, ...], int] = {}
+        document_frequency: list[int] = []
+        columns = {name: [] for name in ("caption_ngrams", "caption_ngram_counts", "image_ngrams", "image_max_counts")}
+        caption_offsets, image_offsets = [0], [0]
+        for captions in encoded.values():
+            max_counts: dict[int, int] = {}
+            for tokens in captions:
+                for ngram, count in count_ngrams(tokens, max_ngram).items():
+                    ngram_id = ngram_ids.setdefault(ngram, len(ngram_ids))
+                    if ngram_id == len(document_frequency):
+                        document_frequency.append(0)
+                    columns["caption_ngrams"].append(ngram_id)
+                    columns["caption_ngram_counts"].append(count)
+                    max_counts[ngram_id] = max(max_counts.get(ngram_id, 0), count)
+                caption_offsets.append(len(columns["caption_ngrams"]))
+            for ngram_id in max_counts:
+                document_frequency[ngram_id] += 1
+            columns["image_ngrams"].extend(max_counts.keys())
+            columns["image_max_counts"].extend(max_counts.values())
+            image_offsets.append(len(columns["image_ngrams"]))
+
+        rows = _ngram_rows(list(ngram_ids), max_ngram)
+        for key_seed in range(_MAX_KEY_SEEDS):
+            keys = _ngram_keys(rows, key_seed)
+            order = np.argsort(keys, kind="stable")
+            if not np.any(keys[order][1:] == keys[order][:-1]):
+                break
+        else:
+            raise ValueError("Could not find n-gram keys without collisions")
+        renumber = np.empty(len(order), dtype=np.int64)
+        renumber[order] = np.arange(len(order))
+        image_ngrams = renumber[np.array(columns["image_ngrams"], dtype=np.int64)]
+        image_index = np.repeat(np.arange(len(image_ids)), np.diff(image_offsets))
+        image_order = np.lexsort((image_ngrams, image_index))
+        arrays = {
+            "ngram_keys": keys[order],
+            "ngram_tokens": rows[order],
+            "document_frequency": np.array(document_frequency, dtype=np.float64)[order],
+            "caption_ngram_offsets": np.array(caption_offsets),
+            "caption_ngrams": renumber[np.array(columns["caption_ngrams"], dtype=np.int64)],
+            "caption_ngram_counts": np.array(columns["caption_ngram_counts"]),
+            "image_ngram_offsets": np.array(image_offsets),
+            "image_ngrams": image_ngrams[image_order],
+            "image_max_counts": np.array(columns["image_max_counts"])[image_order],
+        }
+
+        temporary = Path(tempfile.mkdtemp(prefix=f".{directory.name}.", dir=directory.parent))
+        try:
+            corpus.save(temporary / "references")
+            for name, dtype in STATISTICS_ARRAYS.items():
+                np.save(temporary / f"{name}.npy", arrays[name].astype(dtype))
+            metadata = {
+                "format_version": FORMAT_VERSION,
+                "signature": json.loads(json.dumps(signature or {}, default=str)),
+                "unit": unit,
+                "max_ngram": max_ngram,
+                "key_seed": key_seed,
+            }
+            with open(temporary / "statistics.json", "w") as fp:
+                json.dump(metadata, fp)
+            os.rename(temporary, directory)
+        except OSError:
+            if not (directory / "statistics.json").exists():
+                raise
+            logging.info(f"Using the reference statistics built concurrently in {directory}")
+        finally:
+            shutil.rmtree(temporary, ignore_errors=True)
+        return cls(directory)
+
+    @staticmethod
+    def _corpus_arrays(encoded: dict[Any, list[list[int]]]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        lengths = [len(tokens) for captions in encoded.values() for tokens in captions]
+        token_ids = [token for captions in encoded.values() for tokens in captions for token in tokens]
+        return (
+            np.array(token_ids, dtype=np.int32),
+            np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]),
+            np.concatenate([[0], np.cumsum([len(captions) for captions in encoded.values()], dtype=np.int64)]),
+        )
+
+    def lookup(self, ngrams: list[tuple[int, ...]]) -> np.ndarray:
+        """Get the row of each n-gram in the n-gram table, or -1 if it is not a reference n-gram."""
+        if not ngrams:
+            return np.zeros(0, dtype=np.int64)
+        rows = _ngram_rows(ngrams, self.max_ngram)
+        keys = _ngram_keys(rows, self._key_seed)
+        table_keys, table_tokens = self.arrays["ngram_keys"], self.arrays["ngram_tokens"]
+        positions = np.minimum(np.searchsorted(table_keys, keys), len(table_keys) - 1)
+        found = (table_keys[positions] == keys) & (table_tokens[positions] == rows).all(axis=1)
+        return np.where(found, positions, -1)
+
+    def compute_bleu(
+        self, results: ImageCaptionsType, max_ngram: int = 4, option: OPTIONS = "closest"
+    ) -> tuple[list[float], list[list[float]]]:
+        """Compute the BLEU scores of the preprocessed results, same as `Bleu(max_ngram).compute_score`."""
+        scorer = self.build_bleu_scorer(results, max_ngram)
+        return scorer.compute(option=option)
+
+    def build_bleu_scorer(self, results: ImageCaptionsType, max_ngram: int = 4) -> BleuScorer:
+        """Get a `BleuScorer` with the statistics of each image, same as `BleuStatsCounter.cook_test`.
+
+        The references of the scorer only hold their lengths, their max counts are read from the mapped arrays.
+        """
+        vocabulary = self._check_results(results, max_ngram)
+        scorer = BleuScorer(max_ngram=max_ngram, unit=self.unit)
+        offsets = self.arrays["image_ngram_offsets"]
+        for image_index, (hypothesis,) in enumerate(self._results(results)):
+            tokens = _encode([hypothesis], vocabulary, self.unit)[0]
+            counts = count_ngrams(tokens, max_ngram)
+            image_ngrams = self.arrays["image_ngrams"][offsets[image_index] : offsets[image_index + 1]]
+            max_counts = self.arrays["image_max_counts"][offsets[image_index] : offsets[image_index + 1]]
+            rows = self.lookup(list(counts))
+            positions = np.minimum(np.searchsorted(image_ngrams, rows), max(len(image_ngrams) - 1, 0))
+            found = (rows >= 0) & (image_ngrams[positions] == rows) if len(image_ngrams) else rows < -1
+            correct = [0] * max_ngram
+            for (ngram, count), is_found, position in zip(counts.items(), found.tolist(), positions.tolist()):
+                if is_found:
+                    correct[len(ngram) - 1] += min(int(max_counts[position]), count)
+            references = BleuReferences(lengths=self._reference_lengths(image_index))
+            scorer.data.references.append(references)
+            scorer.data.hypotheses.append(
+                BleuHypothesisStats(
+                    length=len(tokens),
+                    referene_lengths=references.lengths,
+                    total_ngrams=[max(0, len(tokens) - k + 1) for k in range(1, max_ngram + 1)],
+                    correct_ngrams=correct,
+                )
+            )
+        return scorer
+
+    def compute_cider(
+        self, results: ImageCaptionsType, max_ngram: int = 4, sigma: float = 6.0
+    ) -> tuple[float, np.ndarray]:
+        """Compute the CIDEr scores of the preprocessed results, same as `Cider(max_ngram, sigma).compute_score`."""
+        vocabulary = self._check_results(results, max_ngram)
+        metric = CiderMetric(ngram_n=max_ngram, sigma=sigma)
+        metric.ref_len = self.ref_len
+        scores = []
+        for image_index, (hypothesis,) in enumerate(self._results(results)):
+            test = count_ngrams(_encode([hypothesis], vocabulary, self.unit)[0], max_ngram)
+            refs, document_frequency = self._reference_counts(image_index, max_ngram)
+            # Only the n-grams of the image are looked up while scoring it
+            hypothesis_ngrams = [ngram for ngram in test if ngram not in document_frequency]
+            for ngram, row in zip(hypothesis_ngrams, self.lookup(hypothesis_ngrams).tolist()):
+                if row >= 0:
+                    document_frequency[ngram] = float(self.arrays["document_frequency"][row])
+            metric.document_frequency = document_frequency
+            scores.append(metric._compute_score_for_image(test, refs))
+        scores = np.array(scores)
+        return np.mean(scores), scores
+
+    def _reference_counts(self, image_index: int, max_ngram: int) -> tuple[list[dict], dict[tuple[int, ...], float]]:
+        """Get the n-gram counts of the references of an image, in counting order, and their document frequency."""
+        start, end = self.corpus.image_offsets[image_index], self.corpus.image_offsets[image_index + 1]
+        offsets = self.arrays["caption_ngram_offsets"][start : end + 1].tolist()
+        rows = self.arrays["caption_ngrams"][offsets[0] : offsets[-1]]
+        tokens = self.arrays["ngram_tokens"][rows].tolist()
+        counts = self.arrays["caption_ngram_counts"][offsets[0] : offsets[-1]].tolist()
+        frequencies = self.arrays["document_frequency"][rows].tolist()
+        refs, document_frequency = [], {}
+        for begin, finish in zip(offsets[:-1], offsets[1:]):
+            ref = {}
+            for position in range(begin - offsets[0], finish - offsets[0]):
+                ngram = tuple(token for token in tokens[position] if token >= 0)
+                if len(ngram) <= max_ngram:
+                    ref[ngram] = counts[position]
+                    document_frequency[ngram] = frequencies[position]
+            refs.append(ref)
+        return refs, document_frequency
+
+    def _reference_lengths(self, image_index: int) -> list[int]:
+        start, end = self.corpus.image_offsets[image_index], self.corpus.image_offsets[image_index + 1]
+        return np.diff(self.corpus.caption_offsets[start : end + 1]).tolist()
+
+    def _results(self, results: ImageCaptionsType):
+        for image_id in self.image_ids:
+            hypotheses = results[image_id]
+            assert len(hypotheses) == 1, f"expected one result caption for {image_id}"
+            yield hypotheses
+
+    def _check_results(self, results: ImageCaptionsType, max_ngram: int) -> Vocabulary:
+        """Check the results, and get a copy of the vocabulary to encode them (new tokens are not reference tokens)."""
+        if max_ngram > self.max_ngram:
+            raise ValueError(f"The statistics are counted up to {self.max_ngram}-grams: {max_ngram}")
+        if list(results.keys()) != self.image_ids:
+            raise ValueError("The results must have the images of the reference statistics, in the same order")
+        return Vocabulary(self.corpus.vocabulary.tokens)
+
+
+class MappedCOCOEvalCap(COCOEvalCap):
+    """COCOEvalCap that evaluates the results against the memory-mapped statistics of the references."""
+
+    @property
+    def reference_signature(self) -> dict[str, Any]:
+        """Identify the preprocessing and the n-gram counting of the references, see `get_mapped_references`."""
+        signature = {"tokenizer": self.preprocessing.signature, "unit": self.unit, "max_ngram": self.max_ngram}
+        if self.caption_guard is not None:
+            signature["caption_guard"] = self.caption_guard.model_dump()
+        return signature
+
+    def get_mapped_references(self, root: Union[str, Path]) -> MappedReferenceStatistics:
+        """Open the memory-mapped statistics of the references in `root`, building them if they do not exist yet.
+
+        The statistics are stored per reference captions and `reference_signature`, so the evaluations of a host
+        with the same references share them.
+        """
+        signature = self.reference_signature
+        references = {
+            image_id: [ann["caption"] for ann in self.coco.imgToAnns[image_id]] for image_id in self.params["image_id"]
+        }
+        directory = Path(root) / get_mapped_references_key(signature, self.params["image_id"], references)
+        if (directory / "statistics.json").exists():
+            logging.info(f"Using the reference statistics in {directory}")
+            return MappedReferenceStatistics.open(directory)
+        ground_truths = {image_id: self.coco.imgToAnns[image_id] for image_id in self.params["image_id"]}
+        logging.info("Apply the preprocessing (normalize unicode, tokenize, remove punctuation)...")
+        ground_truths = self.preprocessing(ground_truths)
+        return MappedReferenceStatistics.build(
+            directory, ground_truths, signature=signature, max_ngram=self.max_ngram, unit=self.unit
+        )
+
+    def evaluate(self, references: MappedReferenceStatistics) -> None:
+        """Evaluate the captions against memory-mapped reference statistics, preprocessing only the results.
+
+        The scores are the same as those of `evaluate`.
+        """
+        if not references.same_signature(self.reference_signature):
+            raise ValueError("The reference statistics were built with another preprocessing or n-gram counting")
+        if list(references.image_ids) != list(self.params["image_id"]):
+            raise ValueError("The reference statistics were built for other images")
+        results = {image_id: self.cocoRes.imgToAnns[image_id] for image_id in self.params["image_id"]}
+        logging.info("Apply the preprocessing (normalize unicode, tokenize, remove punctuation)...")
+        results = self.preprocessing(results)
+        for metric in self._initializa_metrics():
+            logging.info(f"Computing {metric.method} score from the mapped reference statistics...")
+            if isinstance(metric, Bleu):
+                score, scores = references.compute_bleu(results, max_ngram=self.max_ngram)
+            elif isinstance(metric, Cider):
+                if metric.sketch is not None:
+                    raise ValueError("The mapped reference statistics hold the exact document frequency")
+                score, scores = references.compute_cider(results, max_ngram=self.max_ngram, sigma=metric._sigma)
+            else:
+                raise ValueError(f"Mapped reference statistics are not supported for {metric.method}")
+            self.print_scores(metric.score_names, score, scores, image_ids=list(results.keys()))
+        self.set_eval_per_image()
@@ -0,0 +1,181 @@
+"""
+Candidate-vs-candidate utility matrices for minimum Bayes risk (MBR) decoding.
+
+For the K candidates of an image, `utilities[i, j]` is the score of candidate i with candidate j as its only
+reference, as `Bleu` or `Cider` would compute it for that pair. The n-grams of every candidate are counted once.
+The clipped counts of all the pairs follow from count matrices, because min(a, b) is the number of thresholds
+t >= 1 with a >= t and b >= t: they are sums of products of 0/1 matrices. The images are processed in batches of
+padded count arrays with batched matrix products.
+"""
+import logging
+from typing import Any, Literal, Optional
+
+import numpy as np
+
+from multicaptioneval.columnar import NgramUnitType, check_ngram_unit, split_caption
+from multicaptioneval.metrics.bleu.bleu_scorer import SMALL_EPS, TINY_EPS
+from multicaptioneval.metrics.cider.data import CiderNgramCounter
+from multicaptioneval.processing import ImageCaptionsType
+from multicaptioneval.sampling import ReferenceStatisticsType
+
+MBRMetricType = Literal["bleu", "cider"]
+DEFAULT_BATCH_SIZE = 64
+
+
+class _CountBatch:
+    """N-gram counts of the candidates of a batch of images, padded to the largest image of the batch.
+
+    `counts[n][b, k, v]` is the count of the v-th n-gram (of order n + 1) of image b in its k-th candidate.
+    """
+
+    def __init__(self, candidates: list[list[str]], counter: CiderNgramCounter, unit: NgramUnitType) -> None:
+        num_candidates = max(len(image_candidates) for image_candidates in candidates)
+        self.num_candidates = [len(image_candidates) for image_candidates in candidates]
+        self.lengths = np.zeros((len(candidates), num_candidates))
+        self.ngrams: list[list[list[Any]]] = [[] for _ in range(counter.max_ngram)]
+        indices = [([], [], [], []) for _ in range(counter.max_ngram)]
+        for image_index, image_candidates in enumerate(candidates):
+            columns = [{} for _ in range(counter.max_ngram)]
+            for candidate_index, candidate in enumerate(image_candidates):
+                self.lengths[image_index, candidate_index] = len(split_caption(candidate, unit))
+                for ngram, count in counter(candidate).items():
+                    order = len(ngram) - 1
+                    column = columns[order].setdefault(ngram, len(columns[order]))
+                    for values, value in zip(indices[order], (image_index, candidate_index, column, count)):
+                        values.append(value)
+            for order, order_columns in enumerate(columns):
+                self.ngrams[order].append(list(order_columns))
+
+        self.counts = []
+        for order in range(counter.max_ngram):
+            num_ngrams = max([len(image_ngrams) for image_ngrams in self.ngrams[order]] + [1])
+            counts = np.zeros((len(candidates), num_candidates, num_ngrams))
+            image_indices, candidate_indices, columns, values = indices[order]
+            counts[image_indices, candidate_indices, columns] = values
+            self.counts.append(counts)
+
+    def clipped_counts(self, order: int, weights: Optional[np.ndarray] = None) -> np.ndarray:
+        """Get sum_v weights[v] * min(counts[i, v], counts[j, v]) * (counts[j, v] if weighted) for all pairs."""
+        counts = self.counts[order]
+        clipped = np.zeros((counts.shape[0], counts.shape[1], counts.shape[1]))
+        for threshold in range(1, int(counts.max(initial=0)) + 1):
+            above = (counts >= threshold).astype(np.float64)
+            if weights is None:
+                clipped += above @ above.transpose(0, 2, 1)
+            else:
+                clipped += (above * weights[:, None, :]) @ (above * counts).transpose(0, 2, 1)
+        return clipped
+
+
+class MBRUtility:
+    """Compute BLEU and CIDEr-D utility matrices between the candidates of each image.
+
+    The candidates are preprocessed captions, e.g. from `ProcessingPipeline`, and `utilities[i, j]` includes
+    the diagonal (a candidate against itself), see `select` for the MBR choice.
+    """
+
+    def __init__(
+        self, ngram_n: int = 4, sigma: float = 6.0, unit: NgramUnitType = "word", batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> None:
+        check_ngram_unit(unit)
+        if batch_size <= 0:
+            raise ValueError(f"batch_size must be positive: {batch_size}")
+        self._ngram_n = ngram_n
+        self._sigma = sigma
+        self._unit = unit
+        self.batch_size = batch_size
+
+    def compute(
+        self,
+        candidates: ImageCaptionsType,
+        metric: MBRMetricType = "cider",
+        reference_statistics: Optional[ReferenceStatisticsType] = None,
+    ) -> dict[Any, np.ndarray]:
+        """Compute the (K, K) utility matrix of the candidates of each image.
+
+        :param candidates: image id -> K preprocessed candidates
+        :param metric: BLEU of order `ngram_n`, or CIDEr-D
+        :param reference_statistics: CIDEr document frequency and log number of documents of a corpus, e.g. from
+            `SampledCOCOEvalCap.compute_reference_statistics`. By default the document frequency is computed on the
+            candidates of each image, each candidate being a document.
+        """
+        if metric not in ("bleu", "cider"):
+            raise ValueError(f"Unknown metric: {metric}")
+        if metric == "bleu" and reference_statistics is not None:
+            raise ValueError("BLEU does not use a document frequency")
+        counter = CiderNgramCounter(self._ngram_n, unit=self._unit)
+        image_ids = [image_id for image_id, image_candidates in candidates.items() if image_candidates]
+        utilities = {}
+        for start in range(0, len(image_ids), self.batch_size):
+            batch_ids = image_ids[start : start + self.batch_size]
+            logging.info(f"Computing the {metric} utilities of images {start + 1}-{start + len(batch_ids)}...")
+            batch = _CountBatch([candidates[image_id] for image_id in batch_ids], counter, self._unit)
+            if metric == "bleu":
+                batch_utilities = self._bleu(batch)
+            else:
+                batch_utilities = self._cider(batch, reference_statistics)
+            for image_index, image_id in enumerate(batch_ids):
+                size = batch.num_candidates[image_index]
+                utilities[image_id] = batch_utilities[image_index, :size, :size]
+        return utilities
+
+    def bleu(self, candidates: ImageCaptionsType) -> dict[Any, np.ndarray]:
+        return self.compute(candidates, metric="bleu")
+
+    def cider(
+        self, candidates: ImageCaptionsType, reference_statistics: Optional[ReferenceStatisticsType] = None
+    ) -> dict[Any, np.ndarray]:
+        return self.compute(candidates, metric="cider", reference_statistics=reference_statistics)
+
+    @staticmethod
+    def select(utilities: dict[Any, np.ndarray]) -> dict[Any, int]:
+        """Get the index of the candidate with the highest mean utility against the other candidates."""
+        selected = {}
+        for image_id, matrix in utilities.items():
+            if len(matrix) == 1:
+                selected[image_id] = 0
+                continue
+            expected = (matrix.sum(axis=1) - np.diag(matrix)) / (len(matrix) - 1)
+            selected[image_id] = int(np.argmax(expected))
+        return selected
+
+    def _bleu(self, batch: _CountBatch) -> np.ndarray:
+        """Same steps as `BleuScorer.compute_bleu` with the single reference length of each pair."""
+        testlen = batch.lengths[:, :, None]
+        reflen = batch.lengths[:, None, :]
+        bleu = np.ones((len(batch.lengths), batch.lengths.shape[1], batch.lengths.shape[1]))
+        for order in range(self._ngram_n):
+            total = np.maximum(0.0, testlen - order)
+            bleu = bleu * ((batch.clipped_counts(order) + TINY_EPS) / (total + SMALL_EPS))
+        bleu = bleu ** (1.0 / self._ngram_n)
+        # Brevity penalty
+        shorter = (testlen < reflen) & (testlen > 0)
+        penalty = np.exp(1 - reflen / np.where(testlen > 0, testlen, 1.0))
+        return np.where(shorter, bleu * penalty, bleu)
+
+    def _cider(self, batch: _CountBatch, reference_statistics: Optional[ReferenceStatisticsType]) -> np.ndarray:
+        """Same steps as `CiderMetric._compute_score_for_image` with a single reference."""
+        scores = np.zeros((len(batch.lengths), batch.lengths.shape[1], batch.lengths.shape[1]))
+        for order in range(self._ngram_n):
+            counts = batch.counts[order]
+            if reference_statistics is None:
+                document_frequency = (counts > 0).sum(axis=1)
+                ref_len = np.log(np.array(batch.num_candidates, dtype=np.float64))[:, None]
+            else:
+                corpus_frequency, corpus_ref_len = reference_statistics
+                document_frequency = np.zeros(counts.shape[::2])
+                for image_index, ngrams in enumerate(batch.ngrams[order]):
+                    frequencies = [corpus_frequency.get(ngram, 0.0) for ngram in ngrams]
+                    document_frequency[image_index, : len(ngrams)] = frequencies
+                ref_len = corpus_ref_len
+            weights = ref_len - np.log(np.maximum(1.0, document_frequency))
+            norms = np.sqrt(((counts * weights[:, None, :]) ** 2).sum(axis=2))
+            similarity = batch.clipped_counts(order, weights=weights**2)
+            denominator = norms[:, :, None] * norms[:, None, :]
+            scores += np.divide(similarity, denominator, out=similarity, where=denominator != 0)
+
+        # The length of a caption for the penalty is its number of bigrams, as in `CiderMetric.counts2vec`
+        lengths = batch.counts[1].sum(axis=2) if self._ngram_n > 1 else np.zeros_like(batch.lengths)
+        delta = lengths[:, :, None] - lengths[:, None, :]
+        penalty = np.e ** (-(delta**2) / (2 * self._sigma**2))
+        return scores * penalty / self._ngram_n * 10
@@ -9,34 +9,45 @@
 # Authors : Hao Fang <hfang@uw.edu> and Tsung-Yi Lin <tl483@cornell.edu>
 
 from multicaptioneval.metrics.bleu.bleu_scorer import BleuScorer
+from multicaptioneval.columnar import NgramUnitType, iter_image_captions
+from typing import Optional
 
 
 class Bleu:
-    def __init__(self, ngram_n=4):
+    def __init__(self, ngram_n=4, unit: NgramUnitType = "word", max_length: Optional[int] = None):
         # default compute Blue score up to 4
         self._ngram_n = ngram_n
+        # count the n-grams of words, or of characters without word segmentation
+        self._unit = unit
+        # truncate the captions to their first `max_length` words (or characters)
+        self.max_length = max_length
         self._hypo_for_image = {}
         self.ref_for_image = {}
 
     def compute_score(self, ground_truths, results):
-        assert ground_truths.keys() == results.keys()
-        imgIds = ground_truths.keys()
-
-        bleu_scorer = BleuScorer(max_ngram=self._ngram_n)
-        for image_id in imgIds:
-            hypothesis = results[image_id]
-            references = ground_truths[image_id]
-
+        """Compute the BLEU scores from captions or from `TokenizedCorpus` objects sharing a vocabulary."""
+        return self.compute_scores(self.build_scorer(ground_truths, results))
+
+    def new_scorer(self) -> BleuScorer:
+        """Get an empty scorer with the configuration of the metric, e.g. to count the n-grams chunk by chunk."""
+        return BleuScorer(max_ngram=self._ngram_n, unit=self._unit, max_length=self.max_length)
+
+    def compute_scores(self, bleu_scorer: BleuScorer):
+        """Compute the corpus and per-image scores from the n-gram statistics of a scorer."""
+        return bleu_scorer.compute(option="closest")
+
+    def build_scorer(self, ground_truths, results, bleu_scorer: Optional[BleuScorer] = None) -> BleuScorer:
+        """Count the n-gram statistics of every image, adding them to `bleu_scorer` if given (e.g. in chunks)."""
+        if bleu_scorer is None:
+            bleu_scorer = self.new_scorer()
+        for _, hypothesis, references in iter_image_captions(ground_truths, results):
             # Sanity check.
             assert isinstance(hypothesis, list)
             assert len(hypothesis) == 1
             assert isinstance(references, list)
             assert len(references) > 0
             bleu_scorer.update(hypothesis[0], references)
-
-        score, scores = bleu_scorer.compute(option="closest")
-
-        return score, scores
+        return bleu_scorer
 
     @property
     def method(self) -> str:
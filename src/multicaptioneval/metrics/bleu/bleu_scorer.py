@@ -13,7 +13,8 @@
 
 import math
 from typing import Any, Literal, Union
-from multicaptioneval.metrics.bleu.data import BleuData
+from multicaptioneval.metrics.bleu.data import BleuData, BleuHypothesisStats, TextType
+from multicaptioneval.columnar import NgramUnitType, is_caption
 
 SMALL_EPS = 1e-9
 TINY_EPS = 1e-15
@@ -34,20 +35,20 @@ class BleuScorer(object):
     )
     # special_reflen is used in oracle (proportional effective ref len for a node).
 
-    def __init__(self, max_ngram=4, special_reflen=None):
+    def __init__(self, max_ngram=4, special_reflen=None, unit: NgramUnitType = "word", max_length=None):
         """singular instance"""
         self.max_ngram = max_ngram
-        self.data = BleuData(max_ngram=max_ngram)
+        self.data = BleuData(max_ngram=max_ngram, unit=unit, max_length=max_length)
         self.special_reflen = special_reflen
         self._score = None
 
     def update(
         self,
-        hypotheses: Union[str, list[str]],
-        references: Union[list[str], list[list[str]]],
+        hypotheses: Union[TextType, list[TextType]],
+        references: Union[list[TextType], list[list[TextType]]],
     ) -> None:
         """Update with the latest set of hypothesis and references."""
-        if isinstance(hypotheses, str) and isinstance(references, list):
+        if is_caption(hypotheses) and isinstance(references, list):
             self.data.add(hypotheses, references)
         else:
             self.data.add_data(hypotheses, references)
@@ -81,40 +82,22 @@ class BleuScorer(object):
         if option is None:
             option = "average" if len(self.data.references) == 1 else "closest"
 
-        totalstats = {
-            "testlen": 0,
-            "reflen": 0,
-            "total": [0] * max_ngram,
-            "correct": [0] * max_ngram,
-        }
+        totalstats = self.new_totalstats()
 
         # for each sentence
         for stats in self.data.hypotheses:
             if stats is None:
                 continue
 
-            testlen = stats.length
-            if self.special_reflen is None:  # need computation
-                reflen = self._single_reflen(stats.referene_lengths, option, testlen)
-            else:
-                reflen = self.special_reflen
+            reflen = self.get_reflen(stats, option)
 
             # append per image bleu score
-            image_bleu = self.compute_bleu(
-                correct=stats.correct_ngrams,
-                total=stats.total_ngrams,
-                testlen=testlen,
-                reflen=reflen,
-            )
+            image_bleu = self.compute_image_bleu(stats, reflen)
             for ngram_n in range(max_ngram):
                 bleu_list[ngram_n].append(image_bleu[ngram_n])
 
             # Aggregate statistics
-            totalstats["testlen"] += testlen
-            totalstats["reflen"] += reflen
-            for ngram_n in range(max_ngram):
-                totalstats["correct"][ngram_n] += stats.correct_ngrams[ngram_n]
-                totalstats["total"][ngram_n] += stats.total_ngrams[ngram_n]
+            self.add_stats(totalstats, stats, reflen)
 
         self._reflen = totalstats["reflen"]
         self._testlen = totalstats["testlen"]
@@ -122,6 +105,35 @@ class BleuScorer(object):
         self._score = self.aggregate_bleu_scores(totalstats)
         return self._score, bleu_list
 
+    def new_totalstats(self) -> dict[str, Any]:
+        return {
+            "testlen": 0,
+            "reflen": 0,
+            "total": [0] * self.max_ngram,
+            "correct": [0] * self.max_ngram,
+        }
+
+    def get_reflen(self, stats: BleuHypothesisStats, option: OPTIONS = "closest") -> float:
+        if self.special_reflen is None:  # need computation
+            return self._single_reflen(stats.referene_lengths, option, stats.length)
+        return self.special_reflen
+
+    def add_stats(self, totalstats: dict[str, Any], stats: BleuHypothesisStats, reflen: float, sign: int = 1) -> None:
+        """Add (or subtract with sign=-1) the statistics of an image to the corpus statistics."""
+        totalstats["testlen"] += sign * stats.length
+        totalstats["reflen"] += sign * reflen
+        for ngram_n in range(self.max_ngram):
+            totalstats["correct"][ngram_n] += sign * stats.correct_ngrams[ngram_n]
+            totalstats["total"][ngram_n] += sign * stats.total_ngrams[ngram_n]
+
+    def compute_image_bleu(self, stats: BleuHypothesisStats, reflen: float) -> list[float]:
+        return self.compute_bleu(
+            correct=stats.correct_ngrams,
+            total=stats.total_ngrams,
+            testlen=stats.length,
+            reflen=reflen,
+        )
+
     def aggregate_bleu_scores(self, totalstats: dict[str, Any]) -> list[float]:
         return self.compute_bleu(
             correct=totalstats["correct"],
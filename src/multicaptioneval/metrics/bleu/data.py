@@ -1,5 +1,4 @@
-from collections import defaultdict
-from typing import Optional
+from typing import Optional, Union
 from pydantic import (
     BaseModel,
     Field,
@@ -7,9 +6,13 @@ from pydantic import (
     field_validator,
 )
 from typing import Annotated
+from multicaptioneval.columnar import NgramUnitType, check_ngram_unit, count_ngrams, split_caption
 
-NgramType = tuple[str, ...]
+# Words or token ids, or a substring for character n-grams
+NgramType = Union[tuple[Union[str, int], ...], str]
 NgramCountType = dict[NgramType, int]
+# A caption is either a space-separated string or a list of token ids
+TextType = Union[str, list[int]]
 
 
 class BleuNgramCounts(BaseModel):
@@ -43,10 +46,20 @@ class BleuHypothesisStats(BaseModel):
 
 
 class BleuStatsCounter:
-    def __init__(self, max_ngram: int = 4) -> None:
+    def __init__(self, max_ngram: int = 4, unit: NgramUnitType = "word", max_length: Optional[int] = None) -> None:
+        """
+        :param max_length: keep the first `max_length` words (or characters) of longer captions
+        """
+        check_ngram_unit(unit)
+        if max_length is not None and max_length <= 0:
+            raise ValueError(f"max_length must be positive: {max_length}")
         self.max_ngram = max_ngram
+        self.unit = unit
+        self.max_length = max_length
+        # number of captions truncated to `max_length`
+        self.num_truncated = 0
 
-    def cook_references(self, references: list[str]) -> BleuReferences:  # lhuang: oracle will call with "average"
+    def cook_references(self, references: list[TextType]) -> BleuReferences:  # lhuang: oracle will call with "average"
         """Takes a list of reference sentences for a single segment
         and returns an object that encapsulates everything that BLEU
         needs to know about them."""
@@ -55,7 +68,7 @@ class BleuStatsCounter:
             processed_references.update(self._precook(refrence))
         return processed_references
 
-    def cook_test(self, test: str, references: BleuReferences) -> BleuHypothesisStats:
+    def cook_test(self, test: TextType, references: BleuReferences) -> BleuHypothesisStats:
         """Takes a test sentence and returns an object that
         encapsulates everything that BLEU needs to know about it."""
         hypothesis = self._precook(test)
@@ -78,17 +91,15 @@ class BleuStatsCounter:
 
         return stats
 
-    def _precook(self, text: str) -> BleuNgramCounts:
-        """Takes a string as input and returns an object that can be given to
+    def _precook(self, text: TextType) -> BleuNgramCounts:
+        """Takes a string (or a list of token ids) as input and returns an object that can be given to
         either cook_refs or cook_test. This is optional: cook_refs and cook_test
         can take string arguments as well."""
-        words = text.split()
-        counts = defaultdict(int)
-        for ngram_n in range(1, self.max_ngram + 1):
-            for ngram_start_index in range(len(words) - ngram_n + 1):
-                ngram = tuple(words[ngram_start_index : ngram_start_index + ngram_n])
-                counts[ngram] += 1
-        return BleuNgramCounts(length=len(words), max_ngram_counts=counts)
+        words = split_caption(text, self.unit)
+        if self.max_length is not None and len(words) > self.max_length:
+            words = words[: self.max_length]
+            self.num_truncated += 1
+        return BleuNgramCounts(length=len(words), max_ngram_counts=count_ngrams(words, self.max_ngram))
 
 
 class BleuData:
@@ -97,21 +108,23 @@ class BleuData:
     The data are preprocessed to count the ngrams in the hypotheses and references.
     """
 
-    def __init__(self, max_ngram: int = 4) -> None:
-        self._ngram_counter = BleuStatsCounter(max_ngram)
+    def __init__(self, max_ngram: int = 4, unit: NgramUnitType = "word", max_length: Optional[int] = None) -> None:
+        self._ngram_counter = BleuStatsCounter(max_ngram, unit=unit, max_length=max_length)
         self.references: list[BleuReferences] = []
         self.hypotheses: list[Optional[BleuHypothesisStats]] = []
+        # indices of the images with a caption truncated to `max_length`
+        self.truncated: list[int] = []
 
-    def add(self, new_hypothesis: str, new_references: list[str]) -> None:
+    def add(self, new_hypothesis: TextType, new_references: list[TextType]) -> None:
         """Add the hypotheses and references for a single image."""
-        if not isinstance(new_hypothesis, str):
-            raise TypeError(f"must be str: {type(new_hypothesis)}")
-        if not all([isinstance(ref, str) for ref in new_references]):
-            raise TypeError(f"must be list[str]: {type(new_references)}")
+        if not isinstance(new_hypothesis, (str, list)):
+            raise TypeError(f"must be str or list[int]: {type(new_hypothesis)}")
+        if not all([isinstance(ref, (str, list)) for ref in new_references]):
+            raise TypeError(f"must be list[str] or list[list[int]]: {type(new_references)}")
 
         self.cook_append(hypothesis=new_hypothesis, references=new_references)
 
-    def add_data(self, hypotheses: list[str], references: list[list[str]]) -> None:
+    def add_data(self, hypotheses: list[TextType], references: list[list[TextType]]) -> None:
         """Add the hypotheses and references for a multiple images."""
         if not isinstance(hypotheses, list):
             raise TypeError(f"must be list: {type(hypotheses)}")
@@ -125,11 +138,21 @@ class BleuData:
             raise AssertionError(f"refs/test mismatch! {len(self.references)}<>{len(self.hypotheses)}")
         return len(self.references)
 
-    def cook_append(self, hypothesis: str, references: list[str]) -> None:
+    def __iadd__(self, other: "BleuData") -> "BleuData":
+        """Append the data of another instance, e.g. of the next chunk of images."""
+        self.truncated.extend(len(self.references) + index for index in other.truncated)
+        self.references.extend(other.references)
+        self.hypotheses.extend(other.hypotheses)
+        return self
+
+    def cook_append(self, hypothesis: TextType, references: list[TextType]) -> None:
         """called by constructor and __iadd__ to avoid creating new instances."""
         if references is not None:
+            num_truncated = self._ngram_counter.num_truncated
             self.references.append(self._ngram_counter.cook_references(references))
             if hypothesis is not None:
                 self.hypotheses.append(self._ngram_counter.cook_test(hypothesis, self.references[-1]))
             else:
                 self.hypotheses.append(None)
+            if self._ngram_counter.num_truncated > num_truncated:
+                self.truncated.append(len(self.references) - 1)
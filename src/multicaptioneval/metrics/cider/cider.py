@@ -8,6 +8,9 @@
 # Authors: Ramakrishna Vedantam <vrama91@vt.edu> and Tsung-Yi Lin <tl483@cornell.edu>
 
 from multicaptioneval.metrics.cider.cider_scorer import CiderScorer
+from multicaptioneval.metrics.cider.sketch import SketchConfig, SketchDeviation
+from multicaptioneval.columnar import NgramUnitType, iter_image_captions
+from typing import Optional
 
 
 class Cider:
@@ -16,29 +19,58 @@ class Cider:
 
     """
 
-    def __init__(self, ngram_n: int = 4, sigma: float = 6.0) -> None:
+    def __init__(
+        self,
+        ngram_n: int = 4,
+        sigma: float = 6.0,
+        unit: NgramUnitType = "word",
+        sketch: Optional[SketchConfig] = None,
+        max_length: Optional[int] = None,
+    ) -> None:
         # set cider to sum over 1 to 4-grams
         self._ngram_n = ngram_n
+        # count the n-grams of words, or of characters without word segmentation
+        self._unit = unit
         # set the standard deviation parameter for gaussian penalty
         self._sigma = sigma
+        # count the document frequency in a bounded-memory sketch, see `measure_sketch_deviation`
+        self.sketch = sketch
+        self.sketch_deviation: Optional[SketchDeviation] = None
+        # truncate the captions to their first `max_length` words (or characters)
+        self.max_length = max_length
 
     def compute_score(self, ground_truths, results):
         """
         Main function to compute CIDEr score
         :param  hypo_for_image (dict) : dictionary with key <image> and value <tokenized hypothesis / candidate sentence>
                 ref_for_image (dict)  : dictionary with key <image> and value <tokenized reference sentence>
+                Both can also be `TokenizedCorpus` objects sharing a vocabulary.
         :return: cider (float) : computed CIDEr score for the corpus
         """
+        return self.compute_scores(self.build_scorer(ground_truths, results))
 
-        assert ground_truths.keys() == results.keys()
-        imgIds = ground_truths.keys()
+    def new_scorer(self) -> CiderScorer:
+        """Get an empty scorer with the configuration of the metric, e.g. to count the n-grams chunk by chunk."""
+        return CiderScorer(
+            ngram_n=self._ngram_n,
+            sigma=self._sigma,
+            unit=self._unit,
+            sketch=self.sketch,
+            max_length=self.max_length,
+        )
 
-        cider_scorer = CiderScorer(ngram_n=self._ngram_n, sigma=self._sigma)
+    def compute_scores(self, cider_scorer: CiderScorer):
+        """Compute the corpus and per-image scores from the n-gram counts of a scorer."""
+        (score, scores) = cider_scorer.compute()
+        self.sketch_deviation = cider_scorer.cider.sketch_deviation
+        return score, scores
 
-        for image_id in imgIds:
-            hypothesis = results[image_id]
-            references = ground_truths[image_id]
+    def build_scorer(self, ground_truths, results, cider_scorer: Optional[CiderScorer] = None) -> CiderScorer:
+        """Count the n-grams of every image, adding them to `cider_scorer` if given (e.g. in chunks)."""
+        if cider_scorer is None:
+            cider_scorer = self.new_scorer()
 
+        for _, hypothesis, references in iter_image_captions(ground_truths, results):
             # Sanity check.
             assert isinstance(hypothesis, list)
             assert len(hypothesis) == 1
@@ -46,10 +78,7 @@ class Cider:
             assert len(references) > 0
 
             cider_scorer.update(hypotheses=hypothesis[0], references=references)
-
-        (score, scores) = cider_scorer.compute()
-
-        return score, scores
+        return cider_scorer
 
     @property
     def method(self) -> str:
@@ -3,26 +3,41 @@
 # Ramakrishna Vedantam <vrama91@vt.edu>
 
 from collections import defaultdict
+import logging
 import numpy as np
 import math
-from multicaptioneval.metrics.cider.data import CiderData, NgramType, NgramCountType
-from typing import Union
+from multicaptioneval.metrics.cider.data import CiderData, NgramType, NgramCountType, TextType
+from multicaptioneval.metrics.cider.sketch import SketchConfig, SketchDeviation, SketchDocumentFrequency
+from multicaptioneval.columnar import NgramUnitType, is_caption
+from typing import Optional, Union
 
 
 VectorType = list[dict[NgramType, float]]
 
 
 class CiderMetric:
-    def __init__(self, ngram_n: int, sigma: float, multiplier: float = 10) -> None:
+    def __init__(
+        self, ngram_n: int, sigma: float, multiplier: float = 10, sketch: Optional[SketchConfig] = None
+    ) -> None:
         self._ngram_n = ngram_n
         self._sigma = sigma
         self._multiplier = multiplier
+        # Count the document frequency in a bounded-memory sketch instead of a dict
+        self.sketch = sketch
+        self.sketch_deviation: Optional[SketchDeviation] = None
 
     def compute_doc_freq(self, refrences: list[list[NgramCountType]]) -> None:
         """Compute term frequency for reference data.
 
         This will be used to compute idf (inverse document frequency later).
         """
+        if self.sketch is not None:
+            self.document_frequency = SketchDocumentFrequency.from_references(refrences, self.sketch)
+            logging.info(
+                f"Document frequency sketch: {self.document_frequency.nbytes / 2**20:.1f} MiB, "
+                f"{len(self.document_frequency.exact)} n-grams counted exactly"
+            )
+            return
         document_frequency = defaultdict(float)
         for refs in refrences:
             # refs, k ref captions of one image
@@ -42,8 +57,8 @@ class CiderMetric:
         norm = [0.0 for _ in range(self._ngram_n)]
         length = 0
         for ngram, term_freq in counts.items():
-            # give word count 1 if it doesn't appear in reference corpus
-            df = np.log(max(1.0, self.document_frequency[ngram]))
+            # give word count 1 if it doesn't appear in reference corpus, without inserting it
+            df = np.log(max(1.0, self.document_frequency.get(ngram, 0.0)))
             # ngram index
             ngram_n = len(ngram) - 1
             # tf (term_freq) * idf (precomputed idf) for n-grams
@@ -98,13 +113,50 @@ class CiderMetric:
         # compute log reference length
         self.ref_len = np.log(float(len(crefs)))
         # assert to check document frequency
-        assert len(ctest) >= max(self.document_frequency.values())
+        assert len(ctest) >= max(self.document_frequency.values(), default=0)
+        scores = self.score_images(crefs, ctest)
+        if self.sketch is not None and self.sketch.sample_size > 0:
+            self.sketch_deviation = self.measure_sketch_deviation(crefs, ctest, scores)
+            logging.info(f"Deviation of the CIDEr scores from the exact document frequency: {self.sketch_deviation}")
+        return scores
+
+    def score_images(self, crefs, ctest) -> list[float]:
+        """Compute the score of each image with the current document frequency and reference length."""
         scores = []
         for test, refs in zip(ctest, crefs):
             # append score of an image to the score list
             scores.append(self._compute_score_for_image(test, refs))
         return scores
 
+    def measure_sketch_deviation(self, crefs, ctest, scores: list[float]) -> SketchDeviation:
+        """Rescore a sample of the images with the exact document frequency of their n-grams.
+
+        The exact document frequency is only counted for the n-grams of the sampled images, so the memory stays
+        bounded by the sample size.
+        """
+        rng = np.random.default_rng(self.sketch.seed)
+        sample_size = min(self.sketch.sample_size, len(ctest))
+        indices = np.sort(rng.choice(len(ctest), size=sample_size, replace=False)).tolist()
+        ngrams = {ngram for index in indices for counts in [ctest[index], *crefs[index]] for ngram in counts}
+        document_frequency = defaultdict(float)
+        for refs in crefs:
+            for ngram in set([ngram for ref in refs for ngram in ref.keys()]) & ngrams:
+                document_frequency[ngram] += 1
+
+        exact = CiderMetric(self._ngram_n, self._sigma, self._multiplier)
+        exact.document_frequency = document_frequency
+        exact.ref_len = self.ref_len
+        exact_scores = np.array([exact._compute_score_for_image(ctest[index], crefs[index]) for index in indices])
+        sketch_scores = np.array([scores[index] for index in indices])
+        deviations = np.abs(sketch_scores - exact_scores)
+        return SketchDeviation(
+            num_images=sample_size,
+            max_abs=float(deviations.max(initial=0.0)),
+            mean_abs=float(deviations.mean()) if sample_size else 0.0,
+            score_exact=float(exact_scores.mean()) if sample_size else 0.0,
+            score_sketch=float(sketch_scores.mean()) if sample_size else 0.0,
+        )
+
     def _compute_score_for_image(self, test, refs) -> float:
         # compute vector for test captions
         vec, norm, length = self.counts2vec(test)
@@ -124,19 +176,26 @@ class CiderMetric:
 class CiderScorer:
     """CIDEr scorer."""
 
-    def __init__(self, ngram_n=4, sigma=6.0):
+    def __init__(
+        self,
+        ngram_n=4,
+        sigma=6.0,
+        unit: NgramUnitType = "word",
+        sketch: Optional[SketchConfig] = None,
+        max_length: Optional[int] = None,
+    ):
         self._ngram_n = ngram_n
         self.sigma = sigma
-        self.data = CiderData(ngram_n=ngram_n)
-        self.cider = CiderMetric(ngram_n=ngram_n, sigma=sigma)
+        self.data = CiderData(ngram_n=ngram_n, unit=unit, max_length=max_length)
+        self.cider = CiderMetric(ngram_n=ngram_n, sigma=sigma, sketch=sketch)
 
     def update(
         self,
-        hypotheses: Union[str, list[str]],
-        references: Union[list[str], list[list[str]]],
+        hypotheses: Union[TextType, list[TextType]],
+        references: Union[list[TextType], list[list[TextType]]],
     ) -> None:
         """Update with the latest set of hypothesis and references."""
-        if isinstance(hypotheses, str) and isinstance(references, list):
+        if is_caption(hypotheses) and isinstance(references, list):
             self.data.add(hypotheses, references)
         else:
             self.data.add_data(hypotheses, references)
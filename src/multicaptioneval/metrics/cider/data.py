@@ -2,19 +2,32 @@
 # Tsung-Yi Lin <tl483@cornell.edu>
 # Ramakrishna Vedantam <vrama91@vt.edu>
 
-from collections import defaultdict
 from typing import Optional, Union
+from multicaptioneval.columnar import NgramUnitType, check_ngram_unit, count_ngrams, is_caption, split_caption
 
-NgramType = tuple[str]
+# Words or token ids, or a substring for character n-grams
+NgramType = Union[tuple[Union[str, int], ...], str]
 NgramCountType = dict[NgramType, int]
+# A caption is either a space-separated string or a list of token ids
+TextType = Union[str, list[int]]
 
 
 class CiderNgramCounter:
-    def __init__(self, max_ngram: int = 4) -> None:
+    def __init__(self, max_ngram: int = 4, unit: NgramUnitType = "word", max_length: Optional[int] = None) -> None:
+        """
+        :param max_length: keep the first `max_length` words (or characters) of longer captions
+        """
+        check_ngram_unit(unit)
+        if max_length is not None and max_length <= 0:
+            raise ValueError(f"max_length must be positive: {max_length}")
         self.max_ngram = max_ngram
+        self.unit = unit
+        self.max_length = max_length
+        # number of captions truncated to `max_length`
+        self.num_truncated = 0
 
-    def __call__(self, text: Union[str, list[str]]) -> Union[NgramCountType, list[NgramCountType]]:
-        if isinstance(text, str):
+    def __call__(self, text: Union[TextType, list[TextType]]) -> Union[NgramCountType, list[NgramCountType]]:
+        if is_caption(text):
             return self.cook_text(text)
         elif isinstance(text, list):
             return self.cook_text_list(text)
@@ -22,43 +35,44 @@ class CiderNgramCounter:
             raise TypeError(f"must be str or list[str]: {type(text)}")
 
     def cook_text_list(
-        self, refs: list[str], max_ngram=4
+        self, refs: list[TextType], max_ngram: Optional[int] = None
     ) -> list[NgramCountType]:  # lhuang: oracle will call with "average"
         """Takes a list of reference sentences for a single segment
         and returns an object that encapsulates everything that BLEU
         needs to know about them.
         :param refs: list of string : reference sentences for some image
-        :param max_ngram: int : number of ngrams for which (ngram) representation is calculated
+        :param max_ngram: int : number of ngrams for which (ngram) representation is calculated, by default
+            the `max_ngram` of the counter
         :return: result (list of dict)
         """
         return [self._precook(ref, max_ngram) for ref in refs]
 
-    def cook_text(self, text: str, max_ngram=4) -> NgramCountType:
+    def cook_text(self, text: TextType, max_ngram: Optional[int] = None) -> NgramCountType:
         """Takes a sentence and returns an object that
         encapsulates everything that BLEU needs to know about it.
         :param text: list of string : hypothesis sentence for some image
-        :param max_ngram: int : number of ngrams for which (ngram) representation is calculated
+        :param max_ngram: int : number of ngrams for which (ngram) representation is calculated, by default
+            the `max_ngram` of the counter
         :return: result (dict)
         """
         return self._precook(text, max_ngram)
 
-    def _precook(self, text: str, max_ngram: int = 4) -> NgramCountType:
+    def _precook(self, text: TextType, max_ngram: Optional[int] = None) -> NgramCountType:
         """
         Takes a string as input and returns an object that can be given to
         either cook_text_list or cook_text. This is optional: cook_text_list and cook_text
         can take string arguments as well.
-        :param text: string : sentence to be converted into ngrams
+        :param text: string or list of token ids : sentence to be converted into ngrams
         :param max_ngram: int    : number of ngrams for which representation is calculated
         :return: term frequency vector for occuring ngrams
         """
-        # TODO: fix for other languages
-        words = text.split()
-        counts = defaultdict(int)
-        for ngram_n in range(1, max_ngram + 1):
-            for ngram_start_index in range(len(words) - ngram_n + 1):
-                ngram = tuple(words[ngram_start_index : ngram_start_index + ngram_n])
-                counts[ngram] += 1
-        return counts
+        if max_ngram is None:
+            max_ngram = self.max_ngram
+        words = split_caption(text, self.unit)
+        if self.max_length is not None and len(words) > self.max_length:
+            words = words[: self.max_length]
+            self.num_truncated += 1
+        return count_ngrams(words, max_ngram)
 
 
 class CiderData:
@@ -67,21 +81,23 @@ class CiderData:
     The data are preprocessed to count the ngrams in the hypotheses and references.
     """
 
-    def __init__(self, ngram_n: int = 4) -> None:
-        self._ngram_counter = CiderNgramCounter(ngram_n)
+    def __init__(self, ngram_n: int = 4, unit: NgramUnitType = "word", max_length: Optional[int] = None) -> None:
+        self._ngram_counter = CiderNgramCounter(ngram_n, unit=unit, max_length=max_length)
         self.references: list[list[NgramCountType]] = []
         self.hypotheses: list[Optional[NgramCountType]] = []
+        # indices of the images with a caption truncated to `max_length`
+        self.truncated: list[int] = []
 
-    def add(self, new_hypothesis: str, new_references: list[str]) -> None:
+    def add(self, new_hypothesis: TextType, new_references: list[TextType]) -> None:
         """Add the hypotheses and references for a single image."""
-        if not isinstance(new_hypothesis, str):
-            raise TypeError(f"must be str: {type(new_hypothesis)}")
-        if not all([isinstance(ref, str) for ref in new_references]):
-            raise TypeError(f"must be list[str]: {type(new_references)}")
+        if not isinstance(new_hypothesis, (str, list)):
+            raise TypeError(f"must be str or list[int]: {type(new_hypothesis)}")
+        if not all([isinstance(ref, (str, list)) for ref in new_references]):
+            raise TypeError(f"must be list[str] or list[list[int]]: {type(new_references)}")
 
         self.cook_append(hypothesis=new_hypothesis, references=new_references)
 
-    def add_data(self, hypotheses: list[str], references: list[list[str]]) -> None:
+    def add_data(self, hypotheses: list[TextType], references: list[list[TextType]]) -> None:
         """Add the hypotheses and references for a multiple images."""
         if not isinstance(hypotheses, list):
             raise TypeError(f"must be list: {type(hypotheses)}")
@@ -95,11 +111,21 @@ class CiderData:
             raise AssertionError(f"refs/test mismatch! {len(self.references)}<>{len(self.hypotheses)}")
         return len(self.references)
 
-    def cook_append(self, hypothesis: str, references: list[str]) -> None:
+    def __iadd__(self, other: "CiderData") -> "CiderData":
+        """Append the data of another instance, e.g. of the next chunk of images."""
+        self.truncated.extend(len(self.references) + index for index in other.truncated)
+        self.references.extend(other.references)
+        self.hypotheses.extend(other.hypotheses)
+        return self
+
+    def cook_append(self, hypothesis: TextType, references: list[TextType]) -> None:
         """called by constructor and __iadd__ to avoid creating new instances."""
         if references is not None:
+            num_truncated = self._ngram_counter.num_truncated
             self.references.append(self._ngram_counter(references))
             if hypothesis is not None:
                 self.hypotheses.append(self._ngram_counter(hypothesis))
             else:
                 self.hypotheses.append(None)
+            if self._ngram_counter.num_truncated > num_truncated:
+                self.truncated.append(len(self.references) - 1)
@@ -0,0 +1,132 @@
+"""
+Approximate CIDEr document frequency in bounded memory.
+
+The document frequency of every n-gram is counted in a count-min sketch: `depth` rows of `width` counters, each
+n-gram adding to one counter per row, so the smallest of its counters never underestimates it. The n-grams whose
+estimate reaches a threshold are then counted exactly in a second pass and removed from the sketch, which leaves
+the sketch with the collisions of the rare n-grams only. The threshold is raised so that at most `max_exact` n-grams
+are kept exactly: the document frequencies sum to the first row of the sketch, so at most sum / threshold n-grams
+reach the threshold.
+
+The n-grams are hashed with Python's `hash`, so a sketch is only valid in processes with the same hash seed (forked
+workers, or the same `PYTHONHASHSEED`).
+"""
+from typing import Any, Iterator, Optional
+
+import numpy as np
+from pydantic import BaseModel
+
+from multicaptioneval.metrics.cider.data import NgramCountType, NgramType
+
+_MASK64 = (1 << 64) - 1
+# Hashed when the sketch is built and when it is unpickled, to detect another hash seed
+_HASH_FINGERPRINT_KEY = "multicaptioneval.sketch"
+
+
+class SketchConfig(BaseModel):
+    # Counters per row, rounded up to a power of two, the table takes 4 * width * depth bytes
+    width: int = 2**21
+    depth: int = 4
+    # N-grams whose estimated document frequency reaches this threshold are counted exactly
+    exact_threshold: int = 32
+    max_exact: int = 100_000
+    # Number of images rescored with the exact document frequency of their n-grams to measure the deviation
+    sample_size: int = 1000
+    seed: int = 0
+
+
+class SketchDeviation(BaseModel):
+    """Deviation of the CIDEr scores of sampled images from the scores with the exact document frequency."""
+
+    num_images: int
+    max_abs: float
+    mean_abs: float
+    score_exact: float
+    score_sketch: float
+
+
+class SketchDocumentFrequency:
+    """Read-only document frequency with the `get` and `values` of a dict, see `from_references`."""
+
+    def __init__(self, width: int = 2**21, depth: int = 4, exact_threshold: int = 32, seed: int = 0) -> None:
+        if min(width, depth, exact_threshold) <= 0:
+            raise ValueError(f"width, depth and exact_threshold must be positive: {width}, {depth}, {exact_threshold}")
+        bits = max(1, (width - 1).bit_length())
+        self.width = 1 << bits
+        self.depth = depth
+        self.exact_threshold = exact_threshold
+        self._shift = 64 - bits
+        # Odd multipliers of the multiply-shift hashing of each row
+        multipliers = np.random.default_rng(seed).integers(0, 2**63, size=depth, dtype=np.uint64) * np.uint64(2) + 1
+        self._multipliers = multipliers
+        self._python_multipliers = [int(multiplier) for multiplier in multipliers]
+        self.table = np.zeros((depth, self.width), dtype=np.uint32)
+        self.exact: dict[NgramType, float] = {}
+        self._hash_fingerprint = hash(_HASH_FINGERPRINT_KEY)
+
+    @classmethod
+    def from_references(
+        cls, references: list[list[NgramCountType]], config: Optional[SketchConfig] = None, batch_size: int = 10_000
+    ) -> "SketchDocumentFrequency":
+        """Count the document frequency of the n-grams of the references, one document per image."""
+        config = config or SketchConfig()
+        if config.max_exact <= 0:
+            raise ValueError(f"max_exact must be positive: {config.max_exact}")
+        sketch = cls(width=config.width, depth=config.depth, exact_threshold=config.exact_threshold, seed=config.seed)
+        for _, hashes in sketch._iter_documents(references, batch_size):
+            for row, indices in enumerate(sketch._indices(hashes)):
+                sketch.table[row] += np.bincount(indices, minlength=sketch.width).astype(np.uint32)
+        total = int(sketch.table[0].sum(dtype=np.int64))
+        sketch.exact_threshold = max(sketch.exact_threshold, -(-total // config.max_exact))
+
+        # Count the frequent n-grams exactly, then remove them from the sketch. The estimates overcount, so the
+        # n-grams below the threshold are dropped again.
+        for ngrams, hashes in sketch._iter_documents(references, batch_size):
+            estimates = sketch.table[np.arange(sketch.depth)[:, None], sketch._indices(hashes)].min(axis=0)
+            for position in np.flatnonzero(estimates >= sketch.exact_threshold).tolist():
+                ngram = ngrams[position]
+                sketch.exact[ngram] = sketch.exact.get(ngram, 0.0) + 1
+        sketch.exact = {ngram: count for ngram, count in sketch.exact.items() if count >= sketch.exact_threshold}
+        if sketch.exact:
+            hashes = np.array([hash(ngram) for ngram in sketch.exact], dtype=np.int64).view(np.uint64)
+            counts = np.fromiter(sketch.exact.values(), dtype=np.float64, count=len(sketch.exact)).astype(np.uint32)
+            for row, indices in enumerate(sketch._indices(hashes)):
+                np.subtract.at(sketch.table[row], indices, counts)
+        return sketch
+
+    def get(self, ngram: NgramType, default: float = 0.0) -> float:
+        count = self.exact.get(ngram)
+        if count is not None:
+            return count
+        ngram_hash = hash(ngram) & _MASK64
+        estimate = min(
+            int(self.table[row, ((ngram_hash * multiplier) & _MASK64) >> self._shift])
+            for row, multiplier in enumerate(self._python_multipliers)
+        )
+        return float(estimate) if estimate else default
+
+    def values(self):
+        """Document frequencies of the n-grams counted exactly, which include the most frequent one."""
+        return self.exact.values()
+
+    @property
+    def nbytes(self) -> int:
+        return self.table.nbytes
+
+    def _indices(self, hashes: np.ndarray) -> np.ndarray:
+        """Get the counter of each hash in each row, (depth, len(hashes))."""
+        return ((hashes[None, :] * self._multipliers[:, None]) >> np.uint64(self._shift)).astype(np.int64)
+
+    def _iter_documents(
+        self, references: list[list[NgramCountType]], batch_size: int
+    ) -> Iterator[tuple[list[NgramType], np.ndarray]]:
+        """Yield the distinct n-grams of each image and their hashes, for batches of images."""
+        for start in range(0, len(references), batch_size):
+            batch = references[start : start + batch_size]
+            ngrams = [ngram for refs in batch for ngram in {ngram for ref in refs for ngram in ref}]
+            yield ngrams, np.array([hash(ngram) for ngram in ngrams], dtype=np.int64).view(np.uint64)
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        if state["_hash_fingerprint"] != hash(_HASH_FINGERPRINT_KEY):
+            raise ValueError("The document frequency sketch was built with another hash seed (PYTHONHASHSEED)")
+        self.__dict__.update(state)
@@ -0,0 +1,122 @@
+"""
+Evaluation of result files that cover several languages.
+
+Each image takes the language of its result captions (or of its references), given in a per-annotation
+`language` field. The captions are tokenized in one batch per language, and the pooled and per-language scores
+are computed from a single pass of n-gram counting.
+"""
+import logging
+from typing import Any, Optional, Union
+
+from pycocotools.coco import COCO
+
+from multicaptioneval.columnar import NgramUnitType
+from multicaptioneval.eval import MAX_NGRAM_N, COCOEvalCap
+from multicaptioneval.loader import CaptionIndex
+from multicaptioneval.metrics.bleu.bleu import Bleu
+from multicaptioneval.processing import CaptionGuard, ImageCaptionsType, MultilingualPipeline, TokenizationCache
+from multicaptioneval.slices import DocumentFrequencyType, bleu_slice_scores, cider_slice_scores, get_slice_indices
+
+
+class MultilingualCOCOEvalCap(COCOEvalCap):
+    """COCOEvalCap for result files with a language per annotation.
+
+    After `evaluate`, `self.eval` holds the pooled scores and `self.language_eval` the scores of each language.
+    """
+
+    def __init__(
+        self,
+        coco: Union[COCO, CaptionIndex],
+        cocoRes: Union[COCO, CaptionIndex],
+        metrics: Optional[list[str]] = None,
+        tokenizer_cfgs: Optional[dict[str, dict[str, Any]]] = None,
+        default_language: str = "default",
+        language_field: str = "language",
+        tokenization_cache: Optional[TokenizationCache] = None,
+        workers: Optional[int] = None,
+        unit: NgramUnitType = "word",
+        max_ngram: int = MAX_NGRAM_N,
+        caption_guard: Optional[CaptionGuard] = None,
+    ) -> None:
+        """
+        :param tokenizer_cfgs: language -> tokenizer config
+        :param default_language: language of the images without a language field
+        :param language_field: annotation field with the language code
+        :param workers: number of languages to tokenize concurrently (default: all)
+        :param unit: count the n-grams of words (tokenized per language), or of characters ("char", the captions of
+            every language are preprocessed the same way)
+        """
+        self.tokenizer_cfgs = tokenizer_cfgs
+        self.language_field = language_field
+        self.workers = workers
+        self.language_eval = {}
+        super().__init__(
+            coco,
+            cocoRes,
+            metrics=metrics,
+            language=default_language,
+            tokenization_cache=tokenization_cache,
+            unit=unit,
+            max_ngram=max_ngram,
+            caption_guard=caption_guard,
+        )
+
+    def _setup_preprocessing(self, tokenizer_cfg, tokenization_cache: Optional[TokenizationCache] = None) -> None:
+        if self.unit == "char":
+            super()._setup_preprocessing(tokenizer_cfg, tokenization_cache)
+            return
+        self.preprocessing = MultilingualPipeline(
+            tokenizer_cfgs=self.tokenizer_cfgs,
+            default_language=self.language,
+            language_field=self.language_field,
+            cache=tokenization_cache,
+            workers=self.workers,
+            guard=self.caption_guard,
+        )
+
+    def get_image_languages(self) -> dict[Any, str]:
+        """Get the language of each image from its result captions, or else from its references."""
+        image_languages = {}
+        for image_id in self.params["image_id"]:
+            annotations = [*self.cocoRes.imgToAnns[image_id], *self.coco.imgToAnns[image_id]]
+            languages = [ann[self.language_field] for ann in annotations if self.language_field in ann]
+            image_languages[image_id] = languages[0] if languages else self.language
+        return image_languages
+
+    def evaluate(self, document_frequency: DocumentFrequencyType = "slice") -> None:
+        """Compute the pooled and the per-language scores.
+
+        :param document_frequency: compute the CIDEr document frequency of each language on its own images
+            ("slice", same as evaluating each language separately) or on all the images ("global")
+        """
+        image_languages = self.get_image_languages()
+        ground_truths, results = self._prepare_data(image_languages)
+        image_ids = list(ground_truths.keys())
+        slice_indices = get_slice_indices(image_ids, [image_languages[image_id] for image_id in image_ids])
+        self.language_eval = {language: {} for language in slice_indices}
+        metrics = self._initializa_chunked_metrics("Multilingual")
+        scorers = [metric.new_scorer() for metric in metrics]
+        logging.info(f"Counting the n-grams of {len(slice_indices)} languages...")
+        self._count_chunk(metrics, scorers, ground_truths, results)
+        self._set_chunked_scores(metrics, scorers, image_ids)
+        for metric, scorer in zip(metrics, scorers):
+            if isinstance(metric, Bleu):
+                for language, language_scores in bleu_slice_scores(scorer, slice_indices).items():
+                    self.language_eval[language].update(zip(metric.score_names, language_scores))
+            else:
+                for language, language_score in cider_slice_scores(scorer, slice_indices, document_frequency).items():
+                    self.language_eval[language][metric.score_names] = float(language_score)
+
+    def _prepare_data(
+        self, image_languages: Optional[dict[Any, str]] = None
+    ) -> tuple[ImageCaptionsType, ImageCaptionsType]:
+        if image_languages is None:
+            image_languages = self.get_image_languages()
+        image_ids = self.params["image_id"]
+        ground_truths = {image_id: self.coco.imgToAnns[image_id] for image_id in image_ids}
+        results = {image_id: self.cocoRes.imgToAnns[image_id] for image_id in image_ids}
+        if not isinstance(self.preprocessing, MultilingualPipeline):
+            logging.info("Apply the preprocessing (normalize unicode, remove punctuation)...")
+            return self.preprocessing(ground_truths), self.preprocessing(results)
+        logging.info("Apply the preprocessing (normalize unicode, tokenize, remove punctuation) per language...")
+        return self.preprocessing(ground_truths, image_languages), self.preprocessing(results, image_languages)
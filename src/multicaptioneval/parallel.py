@@ -0,0 +1,304 @@
+"""
+Per-image scoring split across worker processes.
+
+Once the CIDEr document frequency is known, the BLEU statistics and the CIDEr similarities of an image only depend
+on its own captions. The tokenized captions are put in shared memory as the arrays of a `TokenizedCorpus`, so the
+workers read them without pickling, and each task scores a contiguous range of images. The CIDEr document
+frequency is counted per range, merged, and shared the same way before the similarities are computed. The captions
+are truncated to the `max_length` of the metrics in the workers. The scores are identical to the ones of
+`Bleu.compute_score` and `Cider.compute_score`.
+"""
+import logging
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Optional, Union
+
+import numpy as np
+
+from multicaptioneval.columnar import (
+    ImageCaptionsType,
+    NgramUnitType,
+    TokenizedCorpus,
+    Vocabulary,
+    split_caption,
+)
+from multicaptioneval.metrics.bleu.bleu import Bleu
+from multicaptioneval.metrics.bleu.bleu_scorer import BleuScorer
+from multicaptioneval.metrics.bleu.data import BleuStatsCounter
+from multicaptioneval.metrics.cider.cider import Cider
+from multicaptioneval.metrics.cider.cider_scorer import CiderMetric
+from multicaptioneval.metrics.cider.data import CiderNgramCounter, NgramCountType
+
+# name -> (shared memory block, shape, dtype)
+SharedArraysSpecType = dict[str, tuple[str, tuple[int, ...], str]]
+CORPUS_ARRAYS = ("token_ids", "caption_offsets", "image_offsets")
+
+# Corpora attached by the worker processes, see `_attach_corpora`
+_WORKER_CORPORA: dict[str, TokenizedCorpus] = {}
+_WORKER_BLOCKS: list[SharedMemory] = []
+
+
+class SharedArrays:
+    """Copy numpy arrays to shared memory blocks that other processes attach by name with `attach`."""
+
+    def __init__(self, arrays: dict[str, np.ndarray]) -> None:
+        self._blocks: list[SharedMemory] = []
+        self.spec: SharedArraysSpecType = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = SharedMemory(create=True, size=max(array.nbytes, 1))
+            self._blocks.append(block)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self.spec[name] = (block.name, array.shape, array.dtype.str)
+
+    @staticmethod
+    def attach(spec: SharedArraysSpecType, blocks: list[SharedMemory]) -> dict[str, np.ndarray]:
+        """Get read-only views of the shared arrays, the attached blocks are added to `blocks` to keep them open."""
+        arrays = {}
+        for name, (block_name, shape, dtype) in spec.items():
+            block = SharedMemory(name=block_name)
+            blocks.append(block)
+            array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+            array.flags.writeable = False
+            arrays[name] = array
+        return arrays
+
+    def close(self) -> None:
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self) -> "SharedArrays":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def _attach_corpora(spec: SharedArraysSpecType) -> None:
+    """Pool initializer: attach the shared references and results once per worker."""
+    arrays = SharedArrays.attach(spec, _WORKER_BLOCKS)
+    for name in ("references", "results"):
+        image_offsets = arrays[f"{name}.image_offsets"]
+        _WORKER_CORPORA[name] = TokenizedCorpus(
+            image_ids=list(range(len(image_offsets) - 1)),
+            token_ids=arrays[f"{name}.token_ids"],
+            caption_offsets=arrays[f"{name}.caption_offsets"],
+            image_offsets=image_offsets,
+            vocabulary=Vocabulary(),
+        )
+
+
+def _iter_worker_images(start: int, stop: int):
+    references, results = _WORKER_CORPORA["references"], _WORKER_CORPORA["results"]
+    for image_index in range(start, stop):
+        yield results.token_lists(image_index)[0], references.token_lists(image_index)
+
+
+def _bleu_chunk(ngram_n: int, max_length: Optional[int], start: int, stop: int) -> dict[str, np.ndarray]:
+    """Get the statistics and the BLEU scores of the images in [start, stop)."""
+    counter = BleuStatsCounter(ngram_n, max_length=max_length)
+    scorer = BleuScorer(max_ngram=ngram_n)
+    chunk = {
+        "length": np.zeros(stop - start, dtype=np.int64),
+        "reflen": np.zeros(stop - start, dtype=np.float64),
+        "correct": np.zeros((stop - start, ngram_n), dtype=np.int64),
+        "total": np.zeros((stop - start, ngram_n), dtype=np.int64),
+        "bleu": np.zeros((stop - start, ngram_n), dtype=np.float64),
+    }
+    for position, (hypothesis, references) in enumerate(_iter_worker_images(start, stop)):
+        stats = counter.cook_test(hypothesis, counter.cook_references(references))
+        reflen = scorer.get_reflen(stats, option="closest")
+        chunk["length"][position] = stats.length
+        chunk["reflen"][position] = reflen
+        chunk["correct"][position] = stats.correct_ngrams
+        chunk["total"][position] = stats.total_ngrams
+        chunk["bleu"][position] = scorer.compute_image_bleu(stats, reflen)
+    return chunk
+
+
+def _document_frequency_chunk(
+    ngram_n: int, max_length: Optional[int], start: int, stop: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Count the CIDEr document frequency of the images in [start, stop)."""
+    counter = CiderNgramCounter(ngram_n, max_length=max_length)
+    document_frequency = defaultdict(float)
+    for _, references in _iter_worker_images(start, stop):
+        for ngram in set([ngram for counts in counter(references) for ngram in counts.keys()]):
+            document_frequency[ngram] += 1
+    return ngram_table(document_frequency, ngram_n)
+
+
+def _cider_chunk(
+    ngram_n: int,
+    sigma: float,
+    max_length: Optional[int],
+    num_images: int,
+    spec: SharedArraysSpecType,
+    start: int,
+    stop: int,
+) -> np.ndarray:
+    """Get the CIDEr scores of the images in [start, stop) with the shared document frequency."""
+    counter = CiderNgramCounter(ngram_n, max_length=max_length)
+    images = [(counter(hypothesis), counter(references)) for hypothesis, references in _iter_worker_images(start, stop)]
+    chunk_ngrams = {ngram for image in images for counts in [image[0], *image[1]] for ngram in counts}
+    metric = CiderMetric(ngram_n=ngram_n, sigma=sigma)
+    metric.document_frequency = _lookup_document_frequency(spec, chunk_ngrams, ngram_n)
+    metric.ref_len = np.log(float(num_images))
+    return np.array([metric._compute_score_for_image(hypothesis, references) for hypothesis, references in images])
+
+
+def _lookup_document_frequency(
+    spec: SharedArraysSpecType, ngrams: set[tuple[int, ...]], ngram_n: int
+) -> dict[tuple[int, ...], float]:
+    """Get the document frequency of the given n-grams from the shared table, sorted by `np.unique`.
+
+    Only the n-grams of a chunk are looked up, instead of converting the whole table in every worker.
+    """
+    ngrams = list(ngrams)
+    rows, _ = ngram_table(dict.fromkeys(ngrams, 0.0), ngram_n)
+    blocks = []
+    try:
+        arrays = SharedArrays.attach(spec, blocks)
+        table, counts = arrays["ngrams"], arrays["counts"]
+        if not len(table) or not ngrams:
+            return {}
+        # Compare the rows column by column, in the same order as `np.unique(..., axis=0)`
+        row_dtype = [(f"f{column}", np.int64) for column in range(ngram_n)]
+        positions = np.searchsorted(table.view(row_dtype).ravel(), rows.view(row_dtype).ravel())
+        positions = np.minimum(positions, len(table) - 1)
+        found = (table[positions] == rows).all(axis=1)
+        return {ngrams[index]: float(counts[positions[index]]) for index in np.flatnonzero(found).tolist()}
+    finally:
+        # The views must be released before closing the blocks
+        arrays = table = counts = None
+        for block in blocks:
+            block.close()
+
+
+def ngram_table(counts: NgramCountType, ngram_n: int) -> tuple[np.ndarray, np.ndarray]:
+    """Convert n-grams of token ids to a (num_ngrams, ngram_n) array padded with -1 and an array of counts."""
+    ngrams = np.full((len(counts), ngram_n), -1, dtype=np.int64)
+    for row, ngram in enumerate(counts):
+        ngrams[row, : len(ngram)] = ngram
+    return ngrams, np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+
+
+def to_corpora(
+    ground_truths: Union[ImageCaptionsType, TokenizedCorpus],
+    results: Union[ImageCaptionsType, TokenizedCorpus],
+    unit: NgramUnitType = "word",
+) -> tuple[TokenizedCorpus, TokenizedCorpus]:
+    """Encode the captions as corpora sharing a vocabulary, with a token per character for the "char" unit."""
+    if isinstance(ground_truths, TokenizedCorpus) and isinstance(results, TokenizedCorpus):
+        if not ground_truths.vocabulary.is_compatible(results.vocabulary):
+            raise ValueError("ground truths and results must share the same vocabulary")
+        return ground_truths, results
+    if isinstance(ground_truths, TokenizedCorpus) or isinstance(results, TokenizedCorpus):
+        raise TypeError("ground truths and results must both be TokenizedCorpus")
+    assert ground_truths.keys() == results.keys()
+    if unit == "char":
+        ground_truths, results = [
+            {image_id: [" ".join(split_caption(caption, unit)) for caption in captions] for image_id, captions in items}
+            for items in (ground_truths.items(), results.items())
+        ]
+    for image_id, hypothesis in results.items():
+        assert len(hypothesis) == 1, f"expected one result caption for {image_id}"
+        assert len(ground_truths[image_id]) > 0, f"no reference captions for {image_id}"
+    vocabulary = Vocabulary()
+    return TokenizedCorpus.from_captions(ground_truths, vocabulary), TokenizedCorpus.from_captions(results, vocabulary)
+
+
+class ParallelScorer:
+    """Score the images of each metric across worker processes, reading the captions from shared memory.
+
+    :param workers: number of worker processes (default: number of CPUs)
+    :param chunks_per_worker: number of image ranges per worker, more ranges balance uneven captions better
+    """
+
+    def __init__(self, workers: Optional[int] = None, chunks_per_worker: int = 4) -> None:
+        if chunks_per_worker <= 0:
+            raise ValueError(f"chunks_per_worker must be positive: {chunks_per_worker}")
+        self.workers = workers or os.cpu_count() or 1
+        self.chunks_per_worker = chunks_per_worker
+
+    def compute_score(self, metric: Union[Bleu, Cider], ground_truths, results) -> tuple[Any, Any]:
+        """Same as `metric.compute_score(ground_truths, results)`."""
+        return self.compute_scores([metric], ground_truths, results)[0]
+
+    def compute_scores(self, metrics: list[Union[Bleu, Cider]], ground_truths, results) -> list[tuple[Any, Any]]:
+        """Compute the (score, scores) of each metric, sharing the captions and the workers across metrics."""
+        for metric in metrics:
+            if not isinstance(metric, (Bleu, Cider)):
+                raise ValueError(f"Parallel scoring is not supported for {metric.method}")
+            if isinstance(metric, Cider) and metric.sketch is not None:
+                raise ValueError("Parallel scoring does not support the document frequency sketch")
+        units = {metric._unit for metric in metrics}
+        if len(units) > 1:
+            raise ValueError(f"The metrics must count the same n-gram units: {units}")
+        references, hypotheses = to_corpora(ground_truths, results, unit=units.pop() if units else "word")
+        num_images = len(references)
+        if num_images == 0:
+            raise ValueError("No images to score")
+        num_chunks = min(num_images, self.workers * self.chunks_per_worker)
+        bounds = np.linspace(0, num_images, num_chunks + 1).astype(int).tolist()
+        chunks = list(zip(bounds[:-1], bounds[1:]))
+
+        arrays = {}
+        for name, corpus in (("references", references), ("results", hypotheses)):
+            arrays.update({f"{name}.{array}": getattr(corpus, array) for array in CORPUS_ARRAYS})
+        with SharedArrays(arrays) as shared, ProcessPoolExecutor(
+            max_workers=self.workers, initializer=_attach_corpora, initargs=(shared.spec,)
+        ) as pool:
+            metric_scores = []
+            for metric in metrics:
+                logging.info(f"Computing {metric.method} score of {num_images} images with {self.workers} workers...")
+                if isinstance(metric, Bleu):
+                    metric_scores.append(self._compute_bleu(metric, pool, chunks))
+                else:
+                    metric_scores.append(self._compute_cider(metric, pool, chunks, num_images))
+        return metric_scores
+
+    def _compute_bleu(
+        self, metric: Bleu, pool: ProcessPoolExecutor, chunks: list[tuple[int, int]]
+    ) -> tuple[list[float], list[list[float]]]:
+        futures = [pool.submit(_bleu_chunk, metric._ngram_n, metric.max_length, start, stop) for start, stop in chunks]
+        parts = [future.result() for future in futures]
+        columns = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+        scorer = BleuScorer(max_ngram=metric._ngram_n)
+        totalstats = scorer.new_totalstats()
+        totalstats["testlen"] = int(columns["length"].sum())
+        totalstats["reflen"] = float(columns["reflen"].sum())
+        totalstats["correct"] = columns["correct"].sum(axis=0).tolist()
+        totalstats["total"] = columns["total"].sum(axis=0).tolist()
+        return scorer.aggregate_bleu_scores(totalstats), columns["bleu"].T.tolist()
+
+    def _compute_cider(
+        self, metric: Cider, pool: ProcessPoolExecutor, chunks: list[tuple[int, int]], num_images: int
+    ) -> tuple[float, np.ndarray]:
+        futures = [
+            pool.submit(_document_frequency_chunk, metric._ngram_n, metric.max_length, start, stop)
+            for start, stop in chunks
+        ]
+        parts = [future.result() for future in futures]
+        ngrams, inverse = np.unique(np.concatenate([part[0] for part in parts]), axis=0, return_inverse=True)
+        counts = np.bincount(inverse.reshape(-1), weights=np.concatenate([part[1] for part in parts]))
+        with SharedArrays({"ngrams": ngrams, "counts": counts}) as document_frequency:
+            futures = [
+                pool.submit(
+                    _cider_chunk,
+                    metric._ngram_n,
+                    metric._sigma,
+                    metric.max_length,
+                    num_images,
+                    document_frequency.spec,
+                    start,
+                    stop,
+                )
+                for start, stop in chunks
+            ]
+            scores = np.concatenate([future.result() for future in futures])
+        return np.mean(scores), scores
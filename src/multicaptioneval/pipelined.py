@@ -0,0 +1,211 @@
+"""
+Pipelined evaluation that overlaps the preprocessing of the captions with the n-gram counting.
+
+`COCOEvalCap.evaluate` preprocesses all the captions before it counts any n-gram. `PipelinedCOCOEvalCap` splits
+the images in chunks: a producer normalizes and tokenizes the next chunks while the main thread counts the n-grams
+of the current one into the BLEU and CIDEr scorers. At most `max_pending` chunks are submitted to the producer
+ahead of the counting, so a slow consumer stalls the producer, and the tokenized captions of a chunk are dropped
+once counted: only the n-gram statistics grow with the number of images. `evaluate_stream` reads the results
+from an iterator, e.g. of the lines of a JSON Lines file, a chunk at a time.
+"""
+import logging
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Iterable, Iterator, Optional
+
+from pydantic import BaseModel
+
+from multicaptioneval.columnar import NgramUnitType
+from multicaptioneval.eval import COCOEvalCap, get_preprocessing
+from multicaptioneval.processing import CaptionGuard, GuardReport, ImageCaptionsType, TokenizationCache
+from multicaptioneval.processing.tokenizer_base import COCODatasetType
+
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_MAX_PENDING = 2
+PIPELINE_EXECUTORS = ("thread", "process")
+
+# Preprocessing of the producer process, set once by the pool initializer
+_WORKER_PREPROCESSING = None
+
+
+def _set_worker_preprocessing(
+    unit: NgramUnitType,
+    language: str,
+    tokenizer_cfg: Optional[dict[str, Any]],
+    cache_path: Optional[str],
+    batch_size: Optional[int],
+    guard: Optional[CaptionGuard],
+) -> None:
+    global _WORKER_PREPROCESSING
+    cache = TokenizationCache(cache_path) if cache_path else None
+    _WORKER_PREPROCESSING = get_preprocessing(unit, language, tokenizer_cfg, cache, guard=guard)
+    _WORKER_PREPROCESSING.batch_size = batch_size
+
+
+def _preprocess_in_worker(
+    ground_truths: COCODatasetType, results: COCODatasetType
+) -> tuple[ImageCaptionsType, ImageCaptionsType, GuardReport]:
+    """Preprocess a chunk, returning the truncated images of the chunk."""
+    _WORKER_PREPROCESSING.guard_report = GuardReport()
+    processed = _WORKER_PREPROCESSING(ground_truths), _WORKER_PREPROCESSING(results)
+    return (*processed, _WORKER_PREPROCESSING.guard_report)
+
+
+class PipelineTimings(BaseModel):
+    # Time the consumer waited for preprocessed chunks, i.e. the part of the preprocessing that was not overlapped
+    waiting: float = 0.0
+    counting: float = 0.0
+    scoring: float = 0.0
+
+
+class PipelinedCOCOEvalCap(COCOEvalCap):
+    """COCOEvalCap that preprocesses the next chunks of images while it counts the n-grams of the current one.
+
+    After `evaluate`, `self.timings` holds the time spent waiting for the producer, counting and scoring.
+    """
+
+    def _setup_preprocessing(self, tokenizer_cfg, tokenization_cache: Optional[TokenizationCache] = None) -> None:
+        # Kept to build the same preprocessing in the producer process
+        self.tokenizer_cfg = tokenizer_cfg
+        self.timings = PipelineTimings()
+        super()._setup_preprocessing(tokenizer_cfg, tokenization_cache)
+
+    def evaluate(
+        self, chunk_size: int = DEFAULT_CHUNK_SIZE, max_pending: int = DEFAULT_MAX_PENDING, executor: str = "process"
+    ) -> None:
+        """Evaluate the captions, preprocessing and counting the chunks of images concurrently.
+
+        :param chunk_size: number of images per chunk
+        :param max_pending: number of chunks submitted to the producer ahead of the counting
+        :param executor: preprocess in a worker process (the tokenizers and the counting do not share the GIL), or
+            in a thread (tokenizers that release the GIL, or no pickling of the captions)
+        """
+        self._check_pipeline(chunk_size, max_pending, executor)
+        image_ids = list(self.params["image_id"])
+        chunks = (
+            self._get_chunk(image_ids[start : start + chunk_size], self.cocoRes.imgToAnns)
+            for start in range(0, len(image_ids), chunk_size)
+        )
+        self._evaluate_chunks(chunks, max_pending, executor)
+
+    def evaluate_stream(
+        self,
+        results: Iterable[dict[str, Any]],
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        max_pending: int = DEFAULT_MAX_PENDING,
+        executor: str = "process",
+    ) -> None:
+        """Evaluate result annotations read one at a time, e.g. from `iter_json_lines`, instead of `cocoRes`.
+
+        The results are consumed a chunk at a time as the producer needs them, so the raw result captions are never
+        all in memory. The images are evaluated in the order of the stream, and `params["image_id"]` is set to them.
+        """
+        self._check_pipeline(chunk_size, max_pending, executor)
+        image_ids = self._evaluate_chunks(self._stream_chunks(results, chunk_size), max_pending, executor)
+        self.params["image_id"] = image_ids
+
+    def _check_pipeline(self, chunk_size: int, max_pending: int, executor: str) -> None:
+        if chunk_size <= 0 or max_pending <= 0:
+            raise ValueError(f"chunk_size and max_pending must be positive: {chunk_size}, {max_pending}")
+        if executor not in PIPELINE_EXECUTORS:
+            raise ValueError(f"Unknown executor: {executor}, expected one of {PIPELINE_EXECUTORS}")
+
+    def _evaluate_chunks(
+        self, chunks: Iterator[tuple[COCODatasetType, COCODatasetType]], max_pending: int, executor: str
+    ) -> list[Any]:
+        """Preprocess and count the chunks of (references, results), pulling them as the producer needs them.
+
+        :return: the image ids of the chunks, in order
+        """
+        metrics = self._initializa_chunked_metrics("Pipelined")
+        self.timings = PipelineTimings()
+        scorers = [metric.new_scorer() for metric in metrics]
+        image_ids = []
+        with self._get_producer(executor) as producer:
+            pending: deque[Future] = deque()
+            index = 0
+            try:
+                while True:
+                    while len(pending) < max_pending:
+                        chunk = next(chunks, None)
+                        if chunk is None:
+                            break
+                        image_ids.extend(chunk[0].keys())
+                        pending.append(self._submit_chunk(producer, executor, *chunk))
+                    if not pending:
+                        break
+                    start = time.perf_counter()
+                    ground_truths, results, guard_report = pending.popleft().result()
+                    self.guard_report.update(guard_report)
+                    self.timings.waiting += time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    index += 1
+                    logging.info(f"Counting the n-grams of chunk {index} ({len(image_ids)} images submitted)...")
+                    self._count_chunk(metrics, scorers, ground_truths, results)
+                    self.timings.counting += time.perf_counter() - start
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+
+        start = time.perf_counter()
+        self._set_chunked_scores(metrics, scorers, image_ids)
+        self.timings.scoring = time.perf_counter() - start
+        return image_ids
+
+    def _get_chunk(
+        self, image_ids: list[Any], results: dict[Any, list[dict[str, Any]]]
+    ) -> tuple[COCODatasetType, COCODatasetType]:
+        ground_truths = {image_id: self.coco.imgToAnns[image_id] for image_id in image_ids}
+        return ground_truths, {image_id: results[image_id] for image_id in image_ids}
+
+    def _stream_chunks(
+        self, results: Iterable[dict[str, Any]], chunk_size: int
+    ) -> Iterator[tuple[COCODatasetType, COCODatasetType]]:
+        """Group the result annotations in chunks of `chunk_size` images, checking them like `loadRes`."""
+        seen, chunk = set(), {}
+        for annotation in results:
+            image_id = annotation["image_id"]
+            if image_id not in self.coco.imgs:
+                raise ValueError(f"Results do not correspond to the annotations: unknown image {image_id}")
+            if image_id in seen:
+                raise ValueError(f"Several results for the image {image_id} in the stream")
+            seen.add(image_id)
+            chunk[image_id] = [annotation]
+            if len(chunk) == chunk_size:
+                yield self._get_chunk(list(chunk), chunk)
+                chunk = {}
+        if chunk:
+            yield self._get_chunk(list(chunk), chunk)
+
+    def _get_producer(self, executor: str) -> Executor:
+        if executor == "thread":
+            return ThreadPoolExecutor(max_workers=1)
+        cache = self.preprocessing.cache
+        return ProcessPoolExecutor(
+            max_workers=1,
+            initializer=_set_worker_preprocessing,
+            initargs=(
+                self.unit,
+                self.language,
+                self.tokenizer_cfg,
+                str(cache.path) if cache is not None else None,
+                self.preprocessing.batch_size,
+                self.caption_guard,
+            ),
+        )
+
+    def _submit_chunk(
+        self, producer: Executor, executor: str, ground_truths: COCODatasetType, results: COCODatasetType
+    ) -> Future:
+        if executor == "thread":
+            return producer.submit(self._preprocess_chunk, ground_truths, results)
+        return producer.submit(_preprocess_in_worker, ground_truths, results)
+
+    def _preprocess_chunk(
+        self, ground_truths: COCODatasetType, results: COCODatasetType
+    ) -> tuple[ImageCaptionsType, ImageCaptionsType, GuardReport]:
+        # The report of the thread producer is `self.guard_report` itself
+        return self.preprocessing(ground_truths), self.preprocessing(results), GuardReport()
@@ -1,2 +1,5 @@
 from multicaptioneval.processing.tokenizer_base import ImageCaptionsType
-from multicaptioneval.processing.pipeline import ProcessingPipeline
+from multicaptioneval.processing.pipeline import CharacterPipeline, ProcessingPipeline
+from multicaptioneval.processing.cache import TokenizationCache
+from multicaptioneval.processing.multilingual import MultilingualPipeline
+from multicaptioneval.processing.guards import CaptionGuard, GuardReport
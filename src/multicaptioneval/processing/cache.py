@@ -0,0 +1,150 @@
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Iterable, Union
+
+from pydantic import BaseModel
+
+
+# SQLite limits the number of host parameters in a single statement
+MAX_QUERY_PARAMS = 500
+
+
+class CacheStats(BaseModel):
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class SQLiteLRUStore:
+    """Table of a SQLite database whose rows carry a `last_used` clock to evict the least recently used ones.
+
+    Subclasses define the `TABLE` name, its `COLUMNS` (with a `last_used INTEGER NOT NULL` column), the
+    `TABLE_OPTIONS` and the `FILE_NAME` of the database when `path` is a directory. The connection is shared by the
+    threads and guarded by `_lock`.
+    """
+
+    TABLE: str
+    COLUMNS: str
+    TABLE_OPTIONS: str = ""
+    FILE_NAME: str
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        path = Path(path).expanduser()
+        if path.suffix == "":
+            path.mkdir(parents=True, exist_ok=True)
+            path = path / self.FILE_NAME
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(path), check_same_thread=False)
+        self._setup()
+
+    def _setup(self) -> None:
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(f"CREATE TABLE IF NOT EXISTS {self.TABLE} ({self.COLUMNS}) {self.TABLE_OPTIONS}")
+            self._connection.execute(f"CREATE INDEX IF NOT EXISTS {self.TABLE}_last_used ON {self.TABLE} (last_used)")
+        row = self._connection.execute(f"SELECT MAX(last_used) FROM {self.TABLE}").fetchone()
+        self._clock = row[0] or 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute(f"SELECT COUNT(*) FROM {self.TABLE}").fetchone()[0]
+
+    def clear(self) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(f"DELETE FROM {self.TABLE}")
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self) -> "SQLiteLRUStore":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class TokenizationCache(SQLiteLRUStore):
+    """Persistent cache of tokenized captions backed by SQLite.
+
+    Entries are keyed by (namespace, text), where the namespace identifies the tokenizer, its config and
+    the package version. The cache holds at most `max_entries` rows and evicts the least recently used ones.
+    """
+
+    TABLE = "captions"
+    COLUMNS = (
+        "namespace TEXT NOT NULL, "
+        "text TEXT NOT NULL, "
+        "tokens TEXT NOT NULL, "
+        "last_used INTEGER NOT NULL, "
+        "PRIMARY KEY (namespace, text)"
+    )
+    TABLE_OPTIONS = "WITHOUT ROWID"
+    FILE_NAME = "tokenization_cache.sqlite"
+
+    def __init__(self, path: Union[str, Path], max_entries: int = 2**22) -> None:
+        if max_entries <= 0:
+            raise ValueError(f"max_entries must be positive: {max_entries}")
+        self.max_entries = max_entries
+        super().__init__(path)
+
+    def get_many(self, namespace: str, texts: Iterable[str]) -> dict[str, str]:
+        """Look up the tokenized version of the texts, returning only the hits."""
+        texts = list(dict.fromkeys(texts))
+        found = {}
+        with self._lock:
+            for start in range(0, len(texts), MAX_QUERY_PARAMS):
+                batch = texts[start : start + MAX_QUERY_PARAMS]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    f"SELECT text, tokens FROM captions WHERE namespace = ? AND text IN ({placeholders})",
+                    [namespace, *batch],
+                )
+                found.update(rows)
+            if found:
+                self._clock += 1
+                with self._connection:
+                    self._connection.executemany(
+                        "UPDATE captions SET last_used = ? WHERE namespace = ? AND text = ?",
+                        [(self._clock, namespace, text) for text in found],
+                    )
+            self.stats.hits += len(found)
+            self.stats.misses += len(texts) - len(found)
+        return found
+
+    def set_many(self, namespace: str, items: dict[str, str]) -> None:
+        """Store the tokenized texts and evict the least recently used entries if needed."""
+        if not items:
+            return
+        with self._lock:
+            self._clock += 1
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO captions (namespace, text, tokens, last_used) VALUES (?, ?, ?, ?)",
+                    [(namespace, text, tokens, self._clock) for text, tokens in items.items()],
+                )
+                self._evict()
+
+    def _evict(self) -> None:
+        size = self._connection.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+        overflow = size - self.max_entries
+        if overflow <= 0:
+            return
+        self._connection.execute(
+            "DELETE FROM captions WHERE (namespace, text) IN "
+            "(SELECT namespace, text FROM captions ORDER BY last_used LIMIT ?)",
+            (overflow,),
+        )
+        self.stats.evictions += overflow
+        logging.info(f"Evicted {overflow} entries from the tokenization cache")
@@ -0,0 +1,71 @@
+"""
+Guards against degenerate captions, e.g. a token repeated thousands of times or a huge unsegmented blob.
+
+A caption is truncated to its first `max_chars` characters before the normalization and the tokenization, and to
+its first `max_tokens` tokens (characters for character n-grams) after them, so the time spent in the tokenizers
+and in the n-gram counting is bounded per caption whatever the captions are. The ids of the images with a truncated
+caption are reported.
+"""
+import logging
+from typing import Any, Optional
+
+from pydantic import BaseModel
+
+from multicaptioneval.processing.tokenizer_base import COCODatasetType, ImageCaptionsType
+
+
+class GuardReport(BaseModel):
+    # Ids of the images with a caption truncated to `max_chars` or to `max_tokens`, in order of appearance
+    truncated_chars: list[Any] = []
+    truncated_tokens: list[Any] = []
+
+    def update(self, other: "GuardReport") -> None:
+        self.truncated_chars = list(dict.fromkeys([*self.truncated_chars, *other.truncated_chars]))
+        self.truncated_tokens = list(dict.fromkeys([*self.truncated_tokens, *other.truncated_tokens]))
+
+
+class CaptionGuard(BaseModel):
+    # Characters of a raw caption given to the normalization and the tokenizer
+    max_chars: Optional[int] = 4096
+    # Tokens of a tokenized caption (characters in character mode) given to the n-gram counting
+    max_tokens: Optional[int] = 1024
+
+    def truncate_captions(self, coco_captions: COCODatasetType, report: GuardReport) -> COCODatasetType:
+        """Truncate the raw captions to `max_chars` characters, without modifying the annotations."""
+        if self.max_chars is None:
+            return coco_captions
+        truncated, image_ids = {}, []
+        for image_id, captions in coco_captions.items():
+            if any(len(caption["caption"]) > self.max_chars for caption in captions):
+                image_ids.append(image_id)
+                captions = [{**caption, "caption": caption["caption"][: self.max_chars]} for caption in captions]
+            truncated[image_id] = captions
+        if image_ids:
+            logging.warning(f"Truncated the captions of {len(image_ids)} images to {self.max_chars} characters")
+        report.update(GuardReport(truncated_chars=image_ids))
+        return truncated
+
+    def truncate_tokens(
+        self, image_captions: ImageCaptionsType, report: GuardReport, characters: bool = False
+    ) -> ImageCaptionsType:
+        """Truncate the space-separated tokens (or the characters) of the processed captions to `max_tokens`."""
+        if self.max_tokens is None:
+            return image_captions
+        truncated, image_ids = {}, []
+        for image_id, captions in image_captions.items():
+            # A caption has fewer tokens than characters
+            if any(len(caption) > self.max_tokens for caption in captions):
+                captions = [self._truncate_caption(caption, characters) for caption in captions]
+                if captions != image_captions[image_id]:
+                    image_ids.append(image_id)
+            truncated[image_id] = captions
+        if image_ids:
+            logging.warning(f"Truncated the captions of {len(image_ids)} images to {self.max_tokens} tokens")
+        report.update(GuardReport(truncated_tokens=image_ids))
+        return truncated
+
+    def _truncate_caption(self, caption: str, characters: bool) -> str:
+        if characters:
+            return caption[: self.max_tokens]
+        tokens = caption.split()
+        return " ".join(tokens[: self.max_tokens]) if len(tokens) > self.max_tokens else caption
@@ -0,0 +1,99 @@
+import json
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+
+from multicaptioneval.processing.cache import TokenizationCache
+from multicaptioneval.processing.guards import CaptionGuard, GuardReport
+from multicaptioneval.processing.pipeline import PACKAGE_VERSION, ProcessingPipeline
+from multicaptioneval.processing.tokenizer_base import COCODatasetType, ImageCaptionsType
+
+
+class MultilingualPipeline:
+    """Route the captions to the `ProcessingPipeline` of their language.
+
+    The language of a caption is read from its `language_field`, falling back to the language of its image and
+    then to `default_language`. The captions of each language are processed as one batch, and the languages
+    are processed concurrently with up to `workers` threads.
+    """
+
+    def __init__(
+        self,
+        tokenizer_cfgs: Optional[dict[str, dict[str, Any]]] = None,
+        default_language: str = "default",
+        language_field: str = "language",
+        cache: Optional[TokenizationCache] = None,
+        batch_size: Optional[int] = None,
+        workers: Optional[int] = None,
+        guard: Optional[CaptionGuard] = None,
+    ) -> None:
+        self.tokenizer_cfgs = tokenizer_cfgs or {}
+        self.default_language = default_language
+        self.language_field = language_field
+        self.cache = cache
+        self.batch_size = batch_size
+        self.workers = workers
+        self.guard = guard
+        self.pipelines: dict[str, ProcessingPipeline] = {}
+
+    @property
+    def signature(self) -> str:
+        cfg = json.dumps(
+            {"tokenizer_cfgs": self.tokenizer_cfgs, "default_language": self.default_language},
+            sort_keys=True,
+            default=str,
+        )
+        return f"{type(self).__module__}.{type(self).__qualname__}|{cfg}|{PACKAGE_VERSION}"
+
+    @property
+    def guard_report(self) -> GuardReport:
+        """Truncated images of all the languages."""
+        report = GuardReport()
+        for pipeline in self.pipelines.values():
+            report.update(pipeline.guard_report)
+        return report
+
+    def get_pipeline(self, language: str) -> ProcessingPipeline:
+        if language not in self.pipelines:
+            self.pipelines[language] = ProcessingPipeline(
+                language=language,
+                tokenizer_cfg=self.tokenizer_cfgs.get(language),
+                cache=self.cache,
+                batch_size=self.batch_size,
+                guard=self.guard,
+            )
+        return self.pipelines[language]
+
+    def group_by_language(
+        self, coco_captions: COCODatasetType, image_languages: Optional[dict[Any, str]] = None
+    ) -> dict[str, COCODatasetType]:
+        """Split the captions by language, keeping the captions of an image in the same order."""
+        image_languages = image_languages or {}
+        groups = defaultdict(lambda: defaultdict(list))
+        for image_id, captions in coco_captions.items():
+            image_language = image_languages.get(image_id, self.default_language)
+            for caption in captions:
+                groups[caption.get(self.language_field, image_language)][image_id].append(caption)
+        return {language: dict(group) for language, group in groups.items()}
+
+    def __call__(
+        self, coco_captions: COCODatasetType, image_languages: Optional[dict[Any, str]] = None
+    ) -> ImageCaptionsType:
+        groups = self.group_by_language(coco_captions, image_languages)
+        # Create the pipelines before starting the threads
+        pipelines = {language: self.get_pipeline(language) for language in groups}
+        with ThreadPoolExecutor(max_workers=self.workers or len(groups) or 1) as pool:
+            futures = {language: pool.submit(pipelines[language], group) for language, group in groups.items()}
+            processed = {language: future.result() for language, future in futures.items()}
+
+        # Put the captions back in their original order
+        image_captions = {}
+        for image_id, captions in coco_captions.items():
+            image_language = (image_languages or {}).get(image_id, self.default_language)
+            offsets = defaultdict(int)
+            image_captions[image_id] = []
+            for caption in captions:
+                language = caption.get(self.language_field, image_language)
+                image_captions[image_id].append(processed[language][image_id][offsets[language]])
+                offsets[language] += 1
+        return image_captions
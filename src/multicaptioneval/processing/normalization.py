@@ -54,3 +54,12 @@ PUNCTUATIONS = [
 @lru_cache(maxsize=2**16)
 def remove_punctuation(input_str: str) -> str:
     return " ".join([c for c in input_str.split() if c not in PUNCTUATIONS])
+
+
+# Characters of the punctuation marks above, removed anywhere in the captions for character n-grams
+PUNCTUATION_CHARACTERS = frozenset("".join(PUNCTUATIONS))
+
+
+@lru_cache(maxsize=2**16)
+def remove_punctuation_characters(input_str: str) -> str:
+    return "".join([c for c in input_str if c not in PUNCTUATION_CHARACTERS and not c.isspace()])
@@ -1,6 +1,12 @@
+import json
+from importlib.metadata import PackageNotFoundError, version
+from multicaptioneval.columnar import TokenizedCorpus, Vocabulary
+from multicaptioneval.processing.cache import TokenizationCache
+from multicaptioneval.processing.guards import CaptionGuard, GuardReport
 from multicaptioneval.processing.normalization import (
     normalize_unicode,
     remove_punctuation,
+    remove_punctuation_characters,
 )
 from multicaptioneval.processing.tokenizer_ptb import PTBTokenizer
 from multicaptioneval.processing.tokenizer_ko import KoreanTokenizer
@@ -15,6 +21,10 @@ from multicaptioneval.processing.tokenizer_base import (
 )
 from typing import Any, Optional
 
+try:
+    PACKAGE_VERSION = version("multicaptioneval")
+except PackageNotFoundError:
+    PACKAGE_VERSION = "unknown"
 
 TOKENIZERS = {
     "ja": JapaneseTokenizer,
@@ -33,22 +43,45 @@ class ProcessingPipeline:
     1. Normalizing unicode
     2. Tokenization
     3. Removing punctuation
+
+    If a `TokenizationCache` is given, the tokenizer is only called for the captions that are not cached.
+    If `batch_size` is set, the tokenizer is called on at most `batch_size` images at a time to bound its memory.
+    If a `CaptionGuard` is given, the captions are truncated before the normalization and after the tokenization,
+    and the truncated images are added to `guard_report`.
     """
 
     def __init__(
         self,
         language: str = "default",
         tokenizer_cfg: Optional[dict[str, Any]] = None,
+        cache: Optional[TokenizationCache] = None,
+        batch_size: Optional[int] = None,
+        guard: Optional[CaptionGuard] = None,
     ) -> None:
         if tokenizer_cfg is None:
             tokenizer_cfg = {}
+        if batch_size is not None and batch_size <= 0:
+            raise ValueError(f"batch_size must be positive: {batch_size}")
+        self.cache = cache
+        self.batch_size = batch_size
+        self.guard = guard
+        self.guard_report = GuardReport()
         self._setup_tokenizer(language, tokenizer_cfg)
 
     def _setup_tokenizer(self, language: str, tokenizer_cfg: dict[str, Any]) -> None:
         if language in {"zh", "ja", "ko", "th"}:
             self.tokenizer = TOKENIZERS[language](**tokenizer_cfg)
+            self._tokenizer_cfg = tokenizer_cfg
         else:
             self.tokenizer = TOKENIZERS["ptb"]()
+            self._tokenizer_cfg = {}
+
+    @property
+    def signature(self) -> str:
+        """Identify the tokenizer, its config and the package version."""
+        tokenizer = type(self.tokenizer)
+        cfg = json.dumps(self._tokenizer_cfg, sort_keys=True, default=str)
+        return f"{tokenizer.__module__}.{tokenizer.__qualname__}|{cfg}|{PACKAGE_VERSION}"
 
     def normalize_captions(self, coco_captions: COCODatasetType) -> COCODatasetType:
         return {
@@ -66,6 +99,82 @@ class ProcessingPipeline:
         }
         return image_captions
 
+    def tokenize(self, coco_captions: COCODatasetType) -> ImageCaptionsType:
+        if self.cache is None:
+            return self._tokenize_batches(coco_captions)
+
+        texts = [caption["caption"] for captions in coco_captions.values() for caption in captions]
+        namespace = self.signature
+        tokenized = self.cache.get_many(namespace, texts)
+        # Tokenize each unique missing caption once
+        missing = [text for text in dict.fromkeys(texts) if text not in tokenized]
+        if missing:
+            new_tokens = self._tokenize_batches({idx: [{"caption": text}] for idx, text in enumerate(missing)})
+            new_tokens = {text: new_tokens[idx][0] for idx, text in enumerate(missing)}
+            self.cache.set_many(namespace, new_tokens)
+            tokenized.update(new_tokens)
+        return {
+            image_id: [tokenized[caption["caption"]] for caption in captions]
+            for image_id, captions in coco_captions.items()
+        }
+
+    def _tokenize_batches(self, coco_captions: COCODatasetType) -> ImageCaptionsType:
+        if self.batch_size is None or len(coco_captions) <= self.batch_size:
+            return self.tokenizer(coco_captions)
+        image_ids = list(coco_captions.keys())
+        tokenized = {}
+        for start in range(0, len(image_ids), self.batch_size):
+            batch = image_ids[start : start + self.batch_size]
+            tokenized.update(self.tokenizer({image_id: coco_captions[image_id] for image_id in batch}))
+        return tokenized
+
     def __call__(self, coco_captions: COCODatasetType) -> ImageCaptionsType:
+        if self.guard is not None:
+            coco_captions = self.guard.truncate_captions(coco_captions, self.guard_report)
         coco_captions = self.normalize_captions(coco_captions)
-        return self.remove_punctuation_in_captions(self.tokenizer(coco_captions))
+        image_captions = self.remove_punctuation_in_captions(self.tokenize(coco_captions))
+        if self.guard is not None:
+            image_captions = self.guard.truncate_tokens(image_captions, self.guard_report)
+        return image_captions
+
+    def to_corpus(self, coco_captions: COCODatasetType, vocabulary: Optional[Vocabulary] = None) -> TokenizedCorpus:
+        """Process the captions and store them in columnar format.
+
+        Use the same vocabulary for the references and the results so that they can be scored together.
+        """
+        return TokenizedCorpus.from_captions(self(coco_captions), vocabulary=vocabulary)
+
+
+class CharacterPipeline:
+    """Pipeline for character n-grams, without word segmentation.
+
+    This involves:
+    1. Normalizing unicode
+    2. Removing punctuation characters and whitespace
+
+    The captions are meant for the metrics in character mode (`unit="char"`), which count the n-grams on the
+    characters of the string directly.
+    """
+
+    def __init__(self, batch_size: Optional[int] = None, guard: Optional[CaptionGuard] = None) -> None:
+        self.cache = None
+        # Kept for compatibility with `ProcessingPipeline`, the captions are processed one by one
+        self.batch_size = batch_size
+        # `max_tokens` of the guard is a number of characters
+        self.guard = guard
+        self.guard_report = GuardReport()
+
+    @property
+    def signature(self) -> str:
+        return f"{type(self).__module__}.{type(self).__qualname__}|{{}}|{PACKAGE_VERSION}"
+
+    def __call__(self, coco_captions: COCODatasetType) -> ImageCaptionsType:
+        if self.guard is not None:
+            coco_captions = self.guard.truncate_captions(coco_captions, self.guard_report)
+        image_captions = {
+            image_id: [remove_punctuation_characters(normalize_unicode(caption["caption"])) for caption in captions]
+            for image_id, captions in coco_captions.items()
+        }
+        if self.guard is not None:
+            image_captions = self.guard.truncate_tokens(image_captions, self.guard_report, characters=True)
+        return image_captions
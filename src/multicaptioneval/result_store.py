@@ -0,0 +1,145 @@
+"""
+Content-addressed store of evaluation results.
+
+An evaluation is identified by a hash of its inputs (image ids, reference and result captions) and of its
+configuration (tokenizer, metrics and package version), so the same evaluation can return its stored scores
+instead of being recomputed. Entries are checksummed, and the least recently used ones are evicted when the store
+exceeds `max_entries` or `max_bytes`.
+"""
+import hashlib
+import io
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Any, Optional, Union
+
+import numpy as np
+
+from multicaptioneval.processing.cache import SQLiteLRUStore
+from multicaptioneval.scores import ImageScores
+
+
+def get_result_key(inputs_digest: str, signature: dict[str, Any]) -> str:
+    """Get the key of an evaluation from the digest of its inputs and its configuration."""
+    content = json.dumps({"inputs": inputs_digest, "signature": signature}, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class StoredResult:
+    """Scores of a stored evaluation."""
+
+    def __init__(
+        self, key: str, signature: dict[str, Any], eval: dict[str, float], image_scores: ImageScores, created: float
+    ) -> None:
+        self.key = key
+        self.signature = signature
+        self.eval = eval
+        self.image_scores = image_scores
+        self.created = created
+
+
+class ResultStore(SQLiteLRUStore):
+    """Store of evaluation results backed by SQLite, keyed by `get_result_key`."""
+
+    TABLE = "results"
+    COLUMNS = (
+        "key TEXT PRIMARY KEY, "
+        "signature TEXT NOT NULL, "
+        "eval TEXT NOT NULL, "
+        "image_scores BLOB NOT NULL, "
+        "checksum TEXT NOT NULL, "
+        "size INTEGER NOT NULL, "
+        "created REAL NOT NULL, "
+        "last_used INTEGER NOT NULL"
+    )
+    FILE_NAME = "result_store.sqlite"
+
+    def __init__(self, path: Union[str, Path], max_entries: int = 10_000, max_bytes: int = 2**30) -> None:
+        if max_entries <= 0 or max_bytes <= 0:
+            raise ValueError(f"max_entries and max_bytes must be positive: {max_entries}, {max_bytes}")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        super().__init__(path)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM results WHERE key = ?", (key,)).fetchone() is not None
+
+    def get(self, key: str) -> Optional[StoredResult]:
+        """Get a stored result, entries that fail their checksum are removed and count as misses."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT signature, eval, image_scores, checksum, created FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self._checksum(row[0], row[1], row[2]) != row[3]:
+                logging.warning(f"Removing the corrupted result {key} from the result store")
+                with self._connection:
+                    self._connection.execute("DELETE FROM results WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.stats.misses += 1
+                return None
+            self._clock += 1
+            with self._connection:
+                self._connection.execute("UPDATE results SET last_used = ? WHERE key = ?", (self._clock, key))
+            self.stats.hits += 1
+        signature, eval_json, image_scores, _, created = row
+        return StoredResult(
+            key=key,
+            signature=json.loads(signature),
+            eval=json.loads(eval_json),
+            image_scores=self._load_image_scores(image_scores),
+            created=created,
+        )
+
+    def put(self, key: str, signature: dict[str, Any], eval: dict[str, float], image_scores: ImageScores) -> None:
+        """Store a result and evict the least recently used entries if needed."""
+        signature_json = json.dumps(signature, sort_keys=True, default=str)
+        eval_json = json.dumps({name: float(score) for name, score in eval.items()})
+        buffer = io.BytesIO()
+        np.savez(buffer, **image_scores.columns())
+        blob = buffer.getvalue()
+        checksum = self._checksum(signature_json, eval_json, blob)
+        size = len(signature_json) + len(eval_json) + len(blob)
+        with self._lock:
+            self._clock += 1
+            with self._connection:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO results "
+                    "(key, signature, eval, image_scores, checksum, size, created, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, signature_json, eval_json, blob, checksum, size, time.time(), self._clock),
+                )
+                self._evict()
+
+    def _evict(self) -> None:
+        count, total_size = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        evicted = 0
+        # Always keep the most recent entry, even if it is larger than `max_bytes`
+        rows = self._connection.execute("SELECT key, size FROM results ORDER BY last_used").fetchall()
+        for key, size in rows[:-1]:
+            if count - evicted <= self.max_entries and total_size <= self.max_bytes:
+                break
+            self._connection.execute("DELETE FROM results WHERE key = ?", (key,))
+            evicted += 1
+            total_size -= size
+        if evicted:
+            self.stats.evictions += evicted
+            logging.info(f"Evicted {evicted} entries from the result store")
+
+    def _checksum(self, signature: str, eval_json: str, image_scores: bytes) -> str:
+        digest = hashlib.sha256()
+        for part in (signature.encode(), eval_json.encode(), image_scores):
+            digest.update(len(part).to_bytes(8, "little"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _load_image_scores(self, blob: bytes) -> ImageScores:
+        with np.load(io.BytesIO(blob), allow_pickle=False) as columns:
+            image_scores = ImageScores()
+            image_ids = columns["image_id"].tolist()
+            for name in columns.files:
+                if name != "image_id":
+                    image_scores.set(name, image_ids, columns[name])
+        return image_scores
@@ -0,0 +1,260 @@
+"""
+Estimate the corpus scores from stratified random samples of the images, with confidence intervals.
+
+The sample grows until the confidence intervals are narrow enough. Each image is preprocessed and scored once,
+and CIDEr uses the document frequency of all the references (or a cached one), so the per-image CIDEr scores are
+the ones of a full evaluation. The CIDEr estimate is a stratified mean; the corpus BLEU is a ratio of sums, so
+its uncertainty is estimated with a stratified bootstrap of the per-image statistics. Both account for the finite
+number of images, and the estimates are exact once all images are sampled. `SampledCOCOEvalCap` samples the
+images of an evaluation.
+"""
+import logging
+import math
+from statistics import NormalDist
+from typing import Any, Optional, Union
+
+import numpy as np
+from pydantic import BaseModel
+
+from multicaptioneval.columnar import NgramUnitType
+from multicaptioneval.eval import COCOEvalCap
+from multicaptioneval.metrics.bleu.bleu import Bleu
+from multicaptioneval.metrics.bleu.bleu_scorer import BleuScorer
+from multicaptioneval.metrics.cider.cider import Cider
+from multicaptioneval.metrics.cider.cider_scorer import CiderMetric
+from multicaptioneval.metrics.cider.data import CiderNgramCounter
+from multicaptioneval.processing import ImageCaptionsType
+from multicaptioneval.slices import SlicesType, get_slice_indices
+
+# CIDEr document frequency and log number of images
+ReferenceStatisticsType = tuple[dict[Any, float], float]
+DEFAULT_TARGET_WIDTHS = {"Bleu_4": 0.01, "CIDEr": 0.02}
+
+
+class MetricEstimate(BaseModel):
+    score: float
+    std_error: float
+    lower: float
+    upper: float
+
+    @property
+    def width(self) -> float:
+        return self.upper - self.lower
+
+
+class SampledScores(BaseModel):
+    estimates: dict[str, MetricEstimate]
+    num_images: int
+    total_images: int
+    confidence: float
+    # Whether the target widths were reached (or all images were sampled)
+    converged: bool
+
+    @property
+    def scores(self) -> dict[str, float]:
+        return {name: estimate.score for name, estimate in self.estimates.items()}
+
+
+def compute_reference_statistics(
+    references: ImageCaptionsType, ngram_n: int = 4, unit: NgramUnitType = "word"
+) -> ReferenceStatisticsType:
+    """Compute the CIDEr document frequency and the log number of images of preprocessed references."""
+    counter = CiderNgramCounter(ngram_n, unit=unit)
+    metric = CiderMetric(ngram_n=ngram_n, sigma=6.0)
+    metric.compute_doc_freq([counter(refs) for refs in references.values()])
+    return metric.document_frequency, np.log(float(len(references)))
+
+
+def get_sample_sizes(strata_sizes: list[int], num_images: int, min_per_stratum: int = 2) -> list[int]:
+    """Allocate `num_images` to the strata proportionally to their sizes, at least 2 per stratum if possible."""
+    total = sum(strata_sizes)
+    return [min(size, max(min_per_stratum, math.ceil(num_images * size / total))) for size in strata_sizes]
+
+
+class StratifiedEstimator:
+    """Accumulate the per-image statistics of the sampled images and estimate the corpus scores."""
+
+    def __init__(
+        self,
+        metrics: list[Union[Bleu, Cider]],
+        strata_sizes: list[int],
+        reference_statistics: Optional[ReferenceStatisticsType] = None,
+        confidence: float = 0.95,
+        bootstrap_samples: int = 200,
+        seed: int = 0,
+    ) -> None:
+        if bootstrap_samples < 2:
+            raise ValueError(f"bootstrap_samples must be at least 2: {bootstrap_samples}")
+        for metric in metrics:
+            if not isinstance(metric, (Bleu, Cider)):
+                raise ValueError(f"Sampled evaluation is not supported for {metric.method}")
+            if isinstance(metric, Cider) and reference_statistics is None:
+                raise ValueError("CIDEr requires the document frequency of the references")
+        self.metrics = metrics
+        self.strata_sizes = strata_sizes
+        self.reference_statistics = reference_statistics
+        self.confidence = confidence
+        self.bootstrap_samples = bootstrap_samples
+        self._rng = np.random.default_rng(seed)
+        self._z = NormalDist().inv_cdf((1 + confidence) / 2)
+        # Per stratum: BLEU rows of [correct n-grams..., total n-grams..., test length] and CIDEr scores
+        self._bleu_stats = [[] for _ in strata_sizes]
+        self._cider_scores = [[] for _ in strata_sizes]
+
+    def add(self, ground_truths: ImageCaptionsType, results: ImageCaptionsType, strata: list[int]) -> None:
+        """Add preprocessed images, `strata` gives the stratum of each image."""
+        for metric in self.metrics:
+            scorer = metric.build_scorer(ground_truths, results)
+            if isinstance(metric, Bleu):
+                for stratum, stats in zip(strata, scorer.data.hypotheses):
+                    row = [*stats.correct_ngrams, *stats.total_ngrams, stats.length]
+                    self._bleu_stats[stratum].append(row)
+            else:
+                scorer.cider.document_frequency, scorer.cider.ref_len = self.reference_statistics
+                image_scores = scorer.cider.score_images(crefs=scorer.data.references, ctest=scorer.data.hypotheses)
+                for stratum, score in zip(strata, image_scores):
+                    self._cider_scores[stratum].append(float(score))
+
+    def estimate(self) -> dict[str, MetricEstimate]:
+        estimates = {}
+        for metric in self.metrics:
+            if isinstance(metric, Bleu):
+                scorer = BleuScorer(max_ngram=metric._ngram_n)
+                for name, score, std_error in zip(metric.score_names, *self._estimate_bleu(scorer)):
+                    estimates[name] = self._metric_estimate(score, std_error)
+            else:
+                estimates[metric.score_names] = self._metric_estimate(*self._estimate_cider())
+        return estimates
+
+    def _metric_estimate(self, score: float, std_error: float) -> MetricEstimate:
+        half_width = self._z * std_error
+        return MetricEstimate(
+            score=float(score), std_error=float(std_error), lower=score - half_width, upper=score + half_width
+        )
+
+    def _estimate_cider(self) -> tuple[float, float]:
+        total = sum(self.strata_sizes)
+        score, variance = 0.0, 0.0
+        for size, scores in zip(self.strata_sizes, self._cider_scores):
+            if not scores:
+                continue
+            scores = np.array(scores)
+            weight = size / total
+            score += weight * scores.mean()
+            if 1 < len(scores) < size:
+                variance += weight**2 * (1 - len(scores) / size) * scores.var(ddof=1) / len(scores)
+        return score, math.sqrt(variance)
+
+    def _estimate_bleu(self, scorer: BleuScorer) -> tuple[list[float], list[float]]:
+        """Estimate the corpus statistics, and bootstrap them within the strata to get the standard errors."""
+        max_ngram = scorer.max_ngram
+        strata_stats = [np.array(stats, dtype=np.float64) for stats in self._bleu_stats]
+        totals = sum(size / len(stats) * stats.sum(axis=0) for size, stats in zip(self.strata_sizes, strata_stats))
+        scores = self._bleu_from_totals(scorer, totals)
+        if all(len(stats) >= size for size, stats in zip(self.strata_sizes, strata_stats)):
+            return scores, [0.0] * max_ngram
+
+        replicates = []
+        for _ in range(self.bootstrap_samples):
+            replicate = totals.copy()
+            for size, stats in zip(self.strata_sizes, strata_stats):
+                if len(stats) >= size:
+                    continue
+                sample = stats[self._rng.integers(0, len(stats), len(stats))].sum(axis=0)
+                # Rescale the resampled deviation by the finite population correction
+                deviation = size / len(stats) * (sample - stats.sum(axis=0))
+                replicate += math.sqrt(1 - len(stats) / size) * deviation
+            replicates.append(self._bleu_from_totals(scorer, np.maximum(replicate, 0.0)))
+        return scores, np.array(replicates).std(axis=0, ddof=1).tolist()
+
+    def _bleu_from_totals(self, scorer: BleuScorer, totals: np.ndarray) -> list[float]:
+        max_ngram = scorer.max_ngram
+        totalstats = scorer.new_totalstats()
+        totalstats["correct"] = totals[:max_ngram].tolist()
+        totalstats["total"] = totals[max_ngram : 2 * max_ngram].tolist()
+        totalstats["testlen"] = float(totals[2 * max_ngram])
+        return scorer.aggregate_bleu_scores(totalstats)
+
+
+class SampledCOCOEvalCap(COCOEvalCap):
+    """COCOEvalCap that estimates the scores from a sample of the images, see `evaluate_sampled`."""
+
+    def compute_reference_statistics(self) -> ReferenceStatisticsType:
+        """Compute the CIDEr document frequency of the references of all the images, e.g. to cache it."""
+        ground_truths = {image_id: self.coco.imgToAnns[image_id] for image_id in self.params["image_id"]}
+        logging.info("Apply the preprocessing (normalize unicode, tokenize, remove punctuation)...")
+        ground_truths = self.preprocessing(ground_truths)
+        return compute_reference_statistics(ground_truths, ngram_n=self.max_ngram, unit=self.unit)
+
+    def evaluate_sampled(
+        self,
+        target_widths: Optional[dict[str, float]] = None,
+        confidence: float = 0.95,
+        initial_size: int = 500,
+        growth: float = 2.0,
+        strata: Optional[SlicesType] = None,
+        reference_statistics: Optional[ReferenceStatisticsType] = None,
+        bootstrap_samples: int = 200,
+        seed: int = 0,
+    ) -> SampledScores:
+        """Estimate the scores from growing stratified random samples of the images.
+
+        :param target_widths: metric -> confidence interval width at which to stop, e.g. {"Bleu_4": 0.01}
+        :param confidence: confidence level of the intervals
+        :param initial_size: number of images of the first sample, which grows by `growth` in each round
+        :param strata: stratum name -> image ids, or one label per image in `params["image_id"]`
+        :param reference_statistics: CIDEr document frequency from `compute_reference_statistics`, computed if
+            not given
+        :return: the estimates with their confidence intervals
+        """
+        target_widths = DEFAULT_TARGET_WIDTHS if target_widths is None else target_widths
+        image_ids = list(self.params["image_id"])
+        if strata is None:
+            strata_indices = [np.arange(len(image_ids))]
+        else:
+            strata_indices = list(get_slice_indices(image_ids, strata).values())
+            if sum(len(indices) for indices in strata_indices) != len(image_ids):
+                raise ValueError("The strata must partition the images")
+        metrics = self._initializa_metrics()
+        if reference_statistics is None and any(isinstance(metric, Cider) for metric in metrics):
+            reference_statistics = self.compute_reference_statistics()
+        estimator = StratifiedEstimator(
+            metrics,
+            strata_sizes=[len(indices) for indices in strata_indices],
+            reference_statistics=reference_statistics,
+            confidence=confidence,
+            bootstrap_samples=bootstrap_samples,
+            seed=seed,
+        )
+        rng = np.random.default_rng(seed)
+        strata_order = [rng.permutation(indices) for indices in strata_indices]
+        sampled = [0] * len(strata_indices)
+        num_images = initial_size
+        while True:
+            sample_sizes = get_sample_sizes(estimator.strata_sizes, num_images)
+            new_ids, new_strata = [], []
+            for stratum, (order, start, end) in enumerate(zip(strata_order, sampled, sample_sizes)):
+                new_ids.extend(image_ids[index] for index in order[start:end])
+                new_strata.extend([stratum] * (end - start))
+            sampled = sample_sizes
+            if new_ids:
+                ground_truths = self.preprocessing({image_id: self.coco.imgToAnns[image_id] for image_id in new_ids})
+                results = self.preprocessing({image_id: self.cocoRes.imgToAnns[image_id] for image_id in new_ids})
+                estimator.add(ground_truths, results, new_strata)
+            estimates = estimator.estimate()
+            converged = all(
+                estimates[name].width <= width for name, width in target_widths.items() if name in estimates
+            )
+            intervals = [
+                f"{name}: {estimate.score:0.3f} ± {estimate.width / 2:0.3f}" for name, estimate in estimates.items()
+            ]
+            logging.info(f"Sampled {sum(sampled)} of {len(image_ids)} images: {', '.join(intervals)}")
+            if converged or sum(sampled) == len(image_ids):
+                return SampledScores(
+                    estimates=estimates,
+                    num_images=sum(sampled),
+                    total_images=len(image_ids),
+                    confidence=confidence,
+                    converged=converged or sum(sampled) == len(image_ids),
+                )
+            num_images = math.ceil(num_images * growth)
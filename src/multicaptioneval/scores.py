@@ -0,0 +1,101 @@
+import csv
+from pathlib import Path
+from typing import Any, Iterable, Optional, Union
+
+import numpy as np
+
+
+class ImageScores:
+    """Per-image scores stored as one array per metric.
+
+    The dict-of-dicts form of `COCOEvalCap.imgToEval` is only built when requested.
+    """
+
+    def __init__(self) -> None:
+        self.image_ids: list[Any] = []
+        self.scores: dict[str, np.ndarray] = {}
+        self._positions: dict[Any, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.image_ids)
+
+    @property
+    def metric_names(self) -> list[str]:
+        return list(self.scores.keys())
+
+    def set(self, method: str, image_ids: Iterable[Any], scores: Iterable[float]) -> None:
+        """Set the scores of a metric, the image ids are usually the same across metrics."""
+        image_ids = list(image_ids)
+        scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+        if len(image_ids) != len(scores):
+            raise ValueError(f"image ids/scores mismatch! {len(image_ids)}<>{len(scores)}")
+        if not self.image_ids:
+            self.image_ids = image_ids
+            self._positions = {image_id: position for position, image_id in enumerate(image_ids)}
+        if image_ids == self.image_ids:
+            self.scores[method] = scores
+            return
+
+        # Align the scores with the known images, adding any new images
+        new_image_ids = [image_id for image_id in dict.fromkeys(image_ids) if image_id not in self._positions]
+        if new_image_ids:
+            for image_id in new_image_ids:
+                self._positions[image_id] = len(self.image_ids)
+                self.image_ids.append(image_id)
+            for name, column in self.scores.items():
+                self.scores[name] = np.concatenate([column, np.full(len(new_image_ids), np.nan)])
+        column = self.scores.get(method, np.full(len(self.image_ids), np.nan))
+        column[[self._positions[image_id] for image_id in image_ids]] = scores
+        self.scores[method] = column
+
+    def columns(self) -> dict[str, np.ndarray]:
+        """Get the columns (image_id and one per metric), e.g. to build an Arrow table or a DataFrame."""
+        return {"image_id": self._image_id_array(), **self.scores}
+
+    def to_structured(self) -> np.ndarray:
+        """Get the scores as a structured array with an image_id field and a field per metric."""
+        image_ids = self._image_id_array()
+        dtype = [("image_id", image_ids.dtype)] + [(name, np.float64) for name in self.scores]
+        array = np.empty(len(self.image_ids), dtype=dtype)
+        array["image_id"] = image_ids
+        for name, column in self.scores.items():
+            array[name] = column
+        return array
+
+    def to_dict(self) -> dict[Any, dict[str, Any]]:
+        """Get the scores in the `imgToEval` format: image_id -> {"image_id": ..., metric: score}."""
+        columns = {name: column.tolist() for name, column in self.scores.items()}
+        image_to_eval = {}
+        for position, image_id in enumerate(self.image_ids):
+            image_eval = {"image_id": image_id}
+            for name, column in columns.items():
+                if not np.isnan(column[position]):
+                    image_eval[name] = column[position]
+            image_to_eval[image_id] = image_eval
+        return image_to_eval
+
+    def save(self, path: Union[str, Path], file_format: Optional[str] = None) -> None:
+        """Save the scores as .npz, .csv or .parquet (requires pyarrow), inferring the format from the suffix."""
+        path = Path(path)
+        file_format = (file_format or path.suffix.lstrip(".")).lower()
+        if file_format == "npz":
+            np.savez(path, **self.columns())
+        elif file_format == "csv":
+            with open(path, "w", newline="") as fp:
+                writer = csv.writer(fp)
+                writer.writerow(["image_id", *self.scores])
+                writer.writerows(zip(self.image_ids, *[column.tolist() for column in self.scores.values()]))
+        elif file_format == "parquet":
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError as e:
+                raise ImportError("Saving the scores as parquet requires pyarrow: pip install pyarrow") from e
+            pq.write_table(pa.table(self.columns()), path)
+        else:
+            raise ValueError(f"Unknown file format: {file_format}")
+
+    def _image_id_array(self) -> np.ndarray:
+        if all(isinstance(image_id, (int, np.integer)) for image_id in self.image_ids):
+            return np.array(self.image_ids, dtype=np.int64)
+        return np.array([str(image_id) for image_id in self.image_ids])
@@ -0,0 +1,419 @@
+"""
+Long-running local scoring service that keeps the preprocessing pipelines and the reference sets warm.
+
+Starting an evaluation in a new process pays for importing the tokenizers, loading their dictionaries and
+preprocessing the references. The service keeps one `ProcessingPipeline` per language and tokenizer config, the
+preprocessed references of every registered reference set and their CIDEr document frequencies, and scores
+batches of results against them. It serves JSON over HTTP on a loopback address only:
+
+    GET    /health                  -> {"status": "ok"}
+    GET    /reference-sets          -> {"reference_sets": [{"reference_set": ..., "num_images": ...}, ...]}
+    POST   /reference-sets          <- {"reference_set": id, "annotations": path or COCO dataset,
+                                        "language": ..., "tokenizer_cfg": {...}}
+    DELETE /reference-sets/<id>
+    POST   /score                   <- {"reference_set": id, "results": path or [{"image_id", "caption"}],
+                                        "metrics": [...], "image_scores": false}
+                                    -> {"reference_set": id, "num_images": ..., "eval": {...}, "evalImgs": [...],
+                                        "guard_report": {...}}
+
+Requests are handled concurrently, each pipeline tokenizes one batch at a time. With a `CaptionGuard`, the captions
+of the references and of the results are truncated to its limits, and each score reports its truncated images.
+"""
+import ipaddress
+import json
+import logging
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Optional, Union
+
+import numpy as np
+
+from multicaptioneval.eval import MAX_NGRAM_N, METRICS
+from multicaptioneval.loader import CaptionIndex
+from multicaptioneval.metrics.cider.cider import Cider
+from multicaptioneval.processing import (
+    CaptionGuard,
+    GuardReport,
+    ImageCaptionsType,
+    ProcessingPipeline,
+    TokenizationCache,
+)
+from multicaptioneval.scores import ImageScores
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8642
+# Number of CIDEr document frequencies (one per distinct set of evaluated images) kept per reference set
+MAX_CACHED_DOCUMENT_FREQUENCIES = 8
+
+
+class ServiceError(Exception):
+    """Error in a request, reported to the client with the given HTTP status."""
+
+    def __init__(self, message: str, status: HTTPStatus = HTTPStatus.BAD_REQUEST) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class ReferenceSet:
+    """Preprocessed references of a registered reference set."""
+
+    def __init__(
+        self,
+        name: str,
+        index: CaptionIndex,
+        references: ImageCaptionsType,
+        pipeline: ProcessingPipeline,
+        pipeline_lock: threading.Lock,
+    ) -> None:
+        self.name = name
+        self.index = index
+        self.references = references
+        self.pipeline = pipeline
+        self.pipeline_lock = pipeline_lock
+        # tuple of evaluated image ids -> (document frequency, log number of images), only read while scoring
+        self._document_frequencies: dict[tuple[Any, ...], tuple[dict[Any, float], float]] = {}
+        self._lock = threading.Lock()
+
+    def get_document_frequency(self, image_ids: tuple[Any, ...]) -> Optional[tuple[dict[Any, float], float]]:
+        with self._lock:
+            return self._document_frequencies.get(image_ids)
+
+    def set_document_frequency(
+        self, image_ids: tuple[Any, ...], document_frequency: dict[Any, float], ref_len: float
+    ) -> None:
+        with self._lock:
+            if len(self._document_frequencies) >= MAX_CACHED_DOCUMENT_FREQUENCIES:
+                self._document_frequencies.pop(next(iter(self._document_frequencies)))
+            self._document_frequencies[image_ids] = (document_frequency, ref_len)
+
+    def info(self) -> dict[str, Any]:
+        return {"reference_set": self.name, "num_images": len(self.references), "tokenizer": self.pipeline.signature}
+
+
+class ScoringService:
+    """Keep the preprocessing pipelines and the reference sets in memory and score results against them."""
+
+    def __init__(
+        self, tokenization_cache: Optional[TokenizationCache] = None, caption_guard: Optional[CaptionGuard] = None
+    ) -> None:
+        self.tokenization_cache = tokenization_cache
+        self.caption_guard = caption_guard
+        self._pipelines: dict[str, tuple[ProcessingPipeline, threading.Lock]] = {}
+        self._reference_sets: dict[str, ReferenceSet] = {}
+        self._lock = threading.Lock()
+
+    def get_pipeline(
+        self, language: str = "default", tokenizer_cfg: Optional[dict[str, Any]] = None
+    ) -> tuple[ProcessingPipeline, threading.Lock]:
+        """Get the warm pipeline of a language and tokenizer config, creating it on first use."""
+        key = json.dumps([language, tokenizer_cfg or {}], sort_keys=True, default=str)
+        with self._lock:
+            if key not in self._pipelines:
+                logging.info(f"Loading the preprocessing pipeline for {key}...")
+                pipeline = ProcessingPipeline(
+                    language, tokenizer_cfg=tokenizer_cfg, cache=self.tokenization_cache, guard=self.caption_guard
+                )
+                self._pipelines[key] = (pipeline, threading.Lock())
+            return self._pipelines[key]
+
+    def add_reference_set(
+        self,
+        name: str,
+        annotations: Union[str, Path, dict[str, Any]],
+        language: str = "default",
+        tokenizer_cfg: Optional[dict[str, Any]] = None,
+    ) -> ReferenceSet:
+        """Register (or replace) a reference set from a COCO-style annotation file or dataset."""
+        if isinstance(annotations, dict):
+            index = CaptionIndex.from_dataset(annotations)
+        else:
+            index = CaptionIndex.from_file(annotations)
+        pipeline, pipeline_lock = self.get_pipeline(language, tokenizer_cfg)
+        logging.info(f"Preprocessing the references of {name}...")
+        with pipeline_lock:
+            references = pipeline({image_id: index.imgToAnns[image_id] for image_id in index.getImgIds()})
+        # Only the image ids are needed to validate the results
+        reference_set = ReferenceSet(name, CaptionIndex(index.getImgIds(), []), references, pipeline, pipeline_lock)
+        with self._lock:
+            self._reference_sets[name] = reference_set
+        return reference_set
+
+    def remove_reference_set(self, name: str) -> None:
+        with self._lock:
+            if self._reference_sets.pop(name, None) is None:
+                raise ServiceError(f"Unknown reference set: {name}", HTTPStatus.NOT_FOUND)
+
+    def get_reference_set(self, name: str) -> ReferenceSet:
+        with self._lock:
+            if name not in self._reference_sets:
+                raise ServiceError(f"Unknown reference set: {name}", HTTPStatus.NOT_FOUND)
+            return self._reference_sets[name]
+
+    def list_reference_sets(self) -> list[dict[str, Any]]:
+        with self._lock:
+            return [reference_set.info() for reference_set in self._reference_sets.values()]
+
+    def score(
+        self,
+        name: str,
+        results: Union[str, Path, list[dict[str, Any]]],
+        metrics: Optional[list[str]] = None,
+        image_scores: bool = False,
+    ) -> dict[str, Any]:
+        """Score the results of the images they cover against a registered reference set.
+
+        :return: {"reference_set", "num_images", "eval": metric -> score}, "evalImgs" if `image_scores` is set, and
+            the "guard_report" of the results if the service has a caption guard
+        """
+        reference_set = self.get_reference_set(name)
+        metric_names = [metric.lower() for metric in (metrics or ["bleu", "cider"])]
+        unknown_metrics = [metric for metric in metric_names if metric not in METRICS]
+        if unknown_metrics:
+            raise ServiceError(f"Unknown metrics: {unknown_metrics}")
+        try:
+            result_index = reference_set.index.loadRes(results)
+        except (TypeError, ValueError, KeyError) as e:
+            raise ServiceError(f"Invalid results: {e}") from e
+        image_ids = result_index.getImgIds()
+        if not image_ids:
+            raise ServiceError("No results to score")
+        # The metrics score exactly one result per image
+        duplicates = [image_id for image_id in image_ids if len(result_index.imgToAnns[image_id]) != 1]
+        if duplicates:
+            raise ServiceError(f"Several results for the images: {duplicates[:10]}")
+
+        with reference_set.pipeline_lock:
+            # The report of the pipeline is shared by the requests, only the truncated results of this one are reported
+            reference_set.pipeline.guard_report = GuardReport()
+            hypotheses = reference_set.pipeline({image_id: result_index.imgToAnns[image_id] for image_id in image_ids})
+            guard_report = reference_set.pipeline.guard_report
+        references = {image_id: reference_set.references[image_id] for image_id in image_ids}
+
+        overall = {}
+        per_image = ImageScores()
+        for metric_name in metric_names:
+            metric = METRICS[metric_name](MAX_NGRAM_N)
+            if isinstance(metric, Cider):
+                score, scores = self._cider_score(reference_set, metric, references, hypotheses)
+            else:
+                score, scores = metric.compute_score(references, hypotheses)
+            if isinstance(score, list):
+                for score_name, metric_score, metric_scores in zip(metric.score_names, score, scores):
+                    overall[score_name] = float(metric_score)
+                    per_image.set(score_name, image_ids, metric_scores)
+            else:
+                overall[metric.score_names] = float(score)
+                per_image.set(metric.score_names, image_ids, scores)
+
+        response = {"reference_set": name, "num_images": len(image_ids), "eval": overall}
+        if image_scores:
+            response["evalImgs"] = list(per_image.to_dict().values())
+        if self.caption_guard is not None:
+            response["guard_report"] = guard_report.model_dump()
+        return response
+
+    def _cider_score(
+        self,
+        reference_set: ReferenceSet,
+        metric: Cider,
+        references: ImageCaptionsType,
+        hypotheses: ImageCaptionsType,
+    ) -> tuple[float, np.ndarray]:
+        """Compute CIDEr, reusing the document frequency of the same evaluated images."""
+        scorer = metric.build_scorer(references, hypotheses)
+        key = tuple(references.keys())
+        cached = reference_set.get_document_frequency(key)
+        if cached is None:
+            scores = scorer.cider(crefs=scorer.data.references, ctest=scorer.data.hypotheses)
+            reference_set.set_document_frequency(key, scorer.cider.document_frequency, scorer.cider.ref_len)
+        else:
+            scorer.cider.document_frequency, scorer.cider.ref_len = cached
+            scores = scorer.cider.score_images(crefs=scorer.data.references, ctest=scorer.data.hypotheses)
+        return np.mean(np.array(scores)), np.array(scores)
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    """JSON over HTTP interface of a `ScoringService`."""
+
+    server: "ScoringServer"
+
+    def do_GET(self) -> None:
+        if self.path == "/health":
+            self._respond(HTTPStatus.OK, {"status": "ok"})
+        elif self.path == "/reference-sets":
+            self._respond(HTTPStatus.OK, {"reference_sets": self.server.service.list_reference_sets()})
+        else:
+            self._respond(HTTPStatus.NOT_FOUND, {"error": f"Unknown path: {self.path}"})
+
+    def do_POST(self) -> None:
+        self._handle(self._post)
+
+    def do_DELETE(self) -> None:
+        self._handle(self._delete)
+
+    def _post(self) -> dict[str, Any]:
+        request = self._read_json()
+        service = self.server.service
+        if self.path == "/reference-sets":
+            reference_set = service.add_reference_set(
+                name=self._get_field(request, "reference_set"),
+                annotations=self._get_field(request, "annotations"),
+                language=request.get("language", "default"),
+                tokenizer_cfg=request.get("tokenizer_cfg"),
+            )
+            return reference_set.info()
+        elif self.path == "/score":
+            return service.score(
+                name=self._get_field(request, "reference_set"),
+                results=self._get_field(request, "results"),
+                metrics=request.get("metrics"),
+                image_scores=request.get("image_scores", False),
+            )
+        raise ServiceError(f"Unknown path: {self.path}", HTTPStatus.NOT_FOUND)
+
+    def _delete(self) -> dict[str, Any]:
+        prefix = "/reference-sets/"
+        if not self.path.startswith(prefix):
+            raise ServiceError(f"Unknown path: {self.path}", HTTPStatus.NOT_FOUND)
+        name = urllib.parse.unquote(self.path[len(prefix) :])
+        self.server.service.remove_reference_set(name)
+        return {"reference_set": name}
+
+    def _handle(self, handler) -> None:
+        try:
+            self._respond(HTTPStatus.OK, handler())
+        except ServiceError as e:
+            self._respond(e.status, {"error": str(e)})
+        except FileNotFoundError as e:
+            self._respond(HTTPStatus.NOT_FOUND, {"error": str(e)})
+        except Exception as e:
+            logging.exception(f"Failed to handle {self.command} {self.path}")
+            self._respond(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": f"{type(e).__name__}: {e}"})
+
+    def _read_json(self) -> dict[str, Any]:
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError as e:
+            raise ServiceError(f"Invalid JSON: {e}") from e
+        if not isinstance(request, dict):
+            raise ServiceError("The request must be a JSON object")
+        return request
+
+    def _get_field(self, request: dict[str, Any], field: str) -> Any:
+        if field not in request:
+            raise ServiceError(f"Missing field: {field}")
+        return request[field]
+
+    def _respond(self, status: HTTPStatus, payload: dict[str, Any]) -> None:
+        body = json.dumps(payload, ensure_ascii=False, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logging.info(f"{self.address_string()} {format % args}")
+
+
+class ScoringServer(ThreadingHTTPServer):
+    """Threaded HTTP server of a `ScoringService`, bound to a loopback address."""
+
+    daemon_threads = True
+
+    def __init__(self, service: ScoringService, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> None:
+        if not is_loopback(host):
+            raise ValueError(f"The scoring service only binds to loopback addresses: {host}")
+        self.service = service
+        super().__init__((host, port), ScoringRequestHandler)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class ScoringClient:
+    """Minimal client of the scoring service."""
+
+    def __init__(self, url: str = f"http://{DEFAULT_HOST}:{DEFAULT_PORT}", timeout: Optional[float] = None) -> None:
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def health(self) -> dict[str, Any]:
+        return self._request("GET", "/health")
+
+    def list_reference_sets(self) -> list[dict[str, Any]]:
+        return self._request("GET", "/reference-sets")["reference_sets"]
+
+    def add_reference_set(
+        self,
+        name: str,
+        annotations: Union[str, dict[str, Any]],
+        language: str = "default",
+        tokenizer_cfg: Optional[dict[str, Any]] = None,
+    ) -> dict[str, Any]:
+        """Register a reference set, `annotations` is a path readable by the server or a COCO-style dataset."""
+        request = {"reference_set": name, "annotations": annotations, "language": language}
+        if tokenizer_cfg is not None:
+            request["tokenizer_cfg"] = tokenizer_cfg
+        return self._request("POST", "/reference-sets", request)
+
+    def remove_reference_set(self, name: str) -> dict[str, Any]:
+        return self._request("DELETE", f"/reference-sets/{urllib.parse.quote(name, safe='')}")
+
+    def score(
+        self,
+        name: str,
+        results: Union[str, list[dict[str, Any]]],
+        metrics: Optional[list[str]] = None,
+        image_scores: bool = False,
+    ) -> dict[str, Any]:
+        request = {"reference_set": name, "results": results, "image_scores": image_scores}
+        if metrics is not None:
+            request["metrics"] = metrics
+        return self._request("POST", "/score", request)
+
+    def _request(self, method: str, path: str, payload: Optional[dict[str, Any]] = None) -> dict[str, Any]:
+        data = None if payload is None else json.dumps(payload, ensure_ascii=False).encode()
+        request = urllib.request.Request(
+            self.url + path, data=data, method=method, headers={"Content-Type": "application/json"}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read())["error"]
+            except (ValueError, KeyError):
+                message = e.reason
+            raise ServiceError(message, HTTPStatus(e.code)) from e
+
+
+def serve(
+    service: Optional[ScoringService] = None, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT
+) -> None:
+    """Run the scoring service until interrupted."""
+    server = ScoringServer(service or ScoringService(), host=host, port=port)
+    logging.info(f"Serving on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
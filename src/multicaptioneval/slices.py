@@ -0,0 +1,131 @@
+"""
+Corpus scores for many subsets (slices) of the evaluated images from a single pass of sufficient statistics.
+
+BLEU corpus scores only depend on the sums of the per-image statistics, so the statistics are counted once and
+summed per slice. CIDEr uses either the document frequency of all the evaluated images (global) or the
+document frequency of each slice, which gives the same scores as evaluating each slice separately.
+`SlicedCOCOEvalCap` scores the slices of an evaluation.
+"""
+import logging
+from collections.abc import Mapping
+from typing import Any, Iterable, Literal, Sequence, Union
+
+import numpy as np
+
+from multicaptioneval.eval import COCOEvalCap
+from multicaptioneval.metrics.bleu.bleu import Bleu
+from multicaptioneval.metrics.bleu.bleu_scorer import BleuScorer
+from multicaptioneval.metrics.cider.cider import Cider
+from multicaptioneval.metrics.cider.cider_scorer import CiderScorer
+
+# Either slice name -> image ids, or one label per evaluated image
+SlicesType = Union[Mapping[Any, Iterable[Any]], Sequence[Any], np.ndarray]
+DocumentFrequencyType = Literal["global", "slice"]
+
+
+def get_slice_indices(image_ids: list[Any], slices: SlicesType) -> dict[Any, np.ndarray]:
+    """Get the sorted positions of the images of each slice."""
+    if isinstance(slices, Mapping):
+        positions = {image_id: position for position, image_id in enumerate(image_ids)}
+        slice_indices = {}
+        for name, slice_image_ids in slices.items():
+            slice_image_ids = list(slice_image_ids)
+            unknown = [image_id for image_id in slice_image_ids if image_id not in positions]
+            if unknown:
+                raise ValueError(f"Slice {name} has {len(unknown)} images that are not evaluated")
+            slice_indices[name] = np.unique([positions[image_id] for image_id in slice_image_ids]).astype(np.int64)
+            if len(slice_indices[name]) == 0:
+                raise ValueError(f"Slice {name} is empty")
+        return slice_indices
+
+    labels = np.asarray(slices)
+    if len(labels) != len(image_ids):
+        raise ValueError(f"labels/images mismatch! {len(labels)}<>{len(image_ids)}")
+    names, inverse = np.unique(labels, return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    boundaries = np.cumsum(np.bincount(inverse, minlength=len(names)))[:-1]
+    return {name.item(): indices for name, indices in zip(names, np.split(order, boundaries))}
+
+
+def bleu_slice_scores(scorer: BleuScorer, slice_indices: dict[Any, np.ndarray]) -> dict[Any, list[float]]:
+    """Compute the corpus BLEU scores of each slice by summing the per-image statistics.
+
+    Images without a hypothesis are skipped, as in `BleuScorer.compute`: their statistics are zeros.
+    """
+    max_ngram = scorer.max_ngram
+    correct = np.zeros((len(scorer.data.hypotheses), max_ngram), dtype=np.int64)
+    total = np.zeros((len(scorer.data.hypotheses), max_ngram), dtype=np.int64)
+    testlen = np.zeros(len(scorer.data.hypotheses), dtype=np.int64)
+    reflen = np.zeros(len(scorer.data.hypotheses), dtype=np.float64)
+    for position, stats in enumerate(scorer.data.hypotheses):
+        if stats is None:
+            continue
+        correct[position] = stats.correct_ngrams
+        total[position] = stats.total_ngrams
+        testlen[position] = stats.length
+        reflen[position] = scorer.get_reflen(stats, "closest")
+
+    scores = {}
+    for name, indices in slice_indices.items():
+        totalstats = scorer.new_totalstats()
+        totalstats["testlen"] = int(testlen[indices].sum())
+        totalstats["reflen"] = float(reflen[indices].sum())
+        totalstats["correct"] = correct[indices].sum(axis=0).tolist()
+        totalstats["total"] = total[indices].sum(axis=0).tolist()
+        scores[name] = scorer.aggregate_bleu_scores(totalstats)
+    return scores
+
+
+def cider_slice_scores(
+    scorer: CiderScorer,
+    slice_indices: dict[Any, np.ndarray],
+    document_frequency: DocumentFrequencyType = "global",
+) -> dict[Any, float]:
+    """Compute the corpus CIDEr score of each slice."""
+    references = scorer.data.references
+    hypotheses = scorer.data.hypotheses
+    if document_frequency == "global":
+        _, image_scores = scorer.compute()
+        return {name: np.mean(image_scores[indices]) for name, indices in slice_indices.items()}
+    elif document_frequency != "slice":
+        raise ValueError(f"Unknown document frequency: {document_frequency}")
+
+    metric = scorer.cider
+    scores = {}
+    for name, indices in slice_indices.items():
+        slice_references = [references[index] for index in indices]
+        metric.compute_doc_freq(slice_references)
+        metric.ref_len = np.log(float(len(slice_references)))
+        image_scores = metric.score_images(slice_references, [hypotheses[index] for index in indices])
+        scores[name] = np.mean(np.array(image_scores))
+    return scores
+
+
+class SlicedCOCOEvalCap(COCOEvalCap):
+    """COCOEvalCap that scores several subsets of the images, see `evaluate_slices`."""
+
+    def evaluate_slices(
+        self, slices: SlicesType, document_frequency: DocumentFrequencyType = "global"
+    ) -> dict[Any, dict[str, float]]:
+        """Compute the corpus scores of several subsets of the images, preprocessing and counting only once.
+
+        :param slices: slice name -> image ids, or one label per image in `params["image_id"]`
+        :param document_frequency: compute the CIDEr document frequency on all the images ("global")
+            or on the images of each slice ("slice", same as evaluating each slice separately)
+        :return: slice name -> metric name -> score
+        """
+        ground_truths, results = self._prepare_data()
+        slice_indices = get_slice_indices(list(ground_truths.keys()), slices)
+        slice_eval = {name: {} for name in slice_indices}
+        for metric in self._initializa_metrics():
+            logging.info(f"Computing {metric.method} score for {len(slice_indices)} slices...")
+            scorer = metric.build_scorer(ground_truths, results)
+            if isinstance(metric, Bleu):
+                for name, scores in bleu_slice_scores(scorer, slice_indices).items():
+                    slice_eval[name].update(zip(metric.score_names, scores))
+            elif isinstance(metric, Cider):
+                for name, score in cider_slice_scores(scorer, slice_indices, document_frequency).items():
+                    slice_eval[name][metric.score_names] = float(score)
+            else:
+                raise ValueError(f"Slice evaluation is not supported for {metric.method}")
+        return slice_eval
@@ -0,0 +1,176 @@
+"""
+Metric-parameter sweeps from one set of n-gram statistics.
+
+The n-grams are counted once up to the largest order, then every variant is computed from the counts:
+
+- BLEU of order n is the n-th score of the BLEU of any higher order, and each reference length option only changes
+  the reference length of each image.
+- The CIDEr similarity of each order does not depend on the other orders nor on `sigma`: it is computed once per
+  image and reference, then each (max_ngram, sigma) variant averages the first orders with the length penalty of
+  its `sigma`, in the same floating point steps as `CiderMetric._compute_score_for_image`.
+
+The scores are the same as those of separate `Bleu(ngram_n).compute_score` (with the option) and
+`Cider(ngram_n, sigma).compute_score` runs. `SweepCOCOEvalCap` sweeps the metrics of an evaluation.
+"""
+import logging
+import math
+from typing import Iterable, Optional
+
+import numpy as np
+from pydantic import BaseModel
+
+from multicaptioneval.eval import METRICS, COCOEvalCap
+from multicaptioneval.metrics.bleu.bleu import Bleu
+from multicaptioneval.metrics.bleu.bleu_scorer import OPTIONS, BleuScorer
+from multicaptioneval.metrics.cider.cider import Cider
+from multicaptioneval.metrics.cider.cider_scorer import CiderMetric, CiderScorer
+
+BLEU_OPTIONS: tuple[OPTIONS, ...] = ("closest", "average", "shortest")
+DEFAULT_SIGMAS = (6.0,)
+
+# Variant parameters -> (corpus score, per-image scores)
+BleuSweepType = dict[tuple[OPTIONS, int], tuple[float, np.ndarray]]
+CiderSweepType = dict[tuple[int, float], tuple[float, np.ndarray]]
+
+
+class SweepRow(BaseModel):
+    metric: str
+    max_ngram: int
+    # reference length option of BLEU
+    option: Optional[str] = None
+    # standard deviation of the length penalty of CIDEr
+    sigma: Optional[float] = None
+    score: float
+
+
+def _check_max_ngrams(max_ngrams: Optional[Iterable[int]], counted: int) -> list[int]:
+    max_ngrams = list(range(1, counted + 1)) if max_ngrams is None else list(max_ngrams)
+    if not all(1 <= max_ngram <= counted for max_ngram in max_ngrams):
+        raise ValueError(f"The n-gram orders must be between 1 and {counted}: {max_ngrams}")
+    return max_ngrams
+
+
+def bleu_sweep(
+    scorer: BleuScorer, options: Iterable[OPTIONS] = BLEU_OPTIONS, max_ngrams: Optional[Iterable[int]] = None
+) -> BleuSweepType:
+    """Compute the BLEU score of each reference length option and n-gram order (default: all counted orders)."""
+    max_ngrams = _check_max_ngrams(max_ngrams, scorer.max_ngram)
+    variants = {}
+    for option in options:
+        if option not in BLEU_OPTIONS:
+            raise ValueError(f"Unknown reference length option: {option}, expected one of {BLEU_OPTIONS}")
+        totalstats = scorer.new_totalstats()
+        image_bleus = []
+        # Same steps as `BleuScorer.compute`
+        for stats in scorer.data.hypotheses:
+            if stats is None:
+                continue
+            reflen = scorer.get_reflen(stats, option)
+            image_bleus.append(scorer.compute_image_bleu(stats, reflen))
+            scorer.add_stats(totalstats, stats, reflen)
+        score = scorer.aggregate_bleu_scores(totalstats)
+        image_bleus = np.array(image_bleus).reshape(-1, scorer.max_ngram)
+        for max_ngram in max_ngrams:
+            variants[option, max_ngram] = (score[max_ngram - 1], image_bleus[:, max_ngram - 1])
+    return variants
+
+
+def cider_sweep(
+    scorer: CiderScorer, max_ngrams: Optional[Iterable[int]] = None, sigmas: Iterable[float] = DEFAULT_SIGMAS
+) -> CiderSweepType:
+    """Compute the CIDEr score of each n-gram order (default: all counted orders) and length penalty `sigma`."""
+    metric = scorer.cider
+    max_ngrams = _check_max_ngrams(max_ngrams, metric._ngram_n)
+    references, hypotheses = scorer.data.references, scorer.data.hypotheses
+    metric.compute_doc_freq(references)
+    metric.ref_len = np.log(float(len(references)))
+    # Without the length penalty, sharing the document frequency
+    unpenalized = CiderMetric(metric._ngram_n, sigma=math.inf, multiplier=metric._multiplier)
+    unpenalized.document_frequency = metric.document_frequency
+    unpenalized.ref_len = metric.ref_len
+
+    similarities, deltas = [], []
+    for test, refs in zip(hypotheses, references):
+        vec, norm, length = unpenalized.counts2vec(test)
+        image_similarities, image_deltas = [], []
+        for ref in refs:
+            vec_ref, norm_ref, length_ref = unpenalized.counts2vec(ref)
+            image_similarities.append(unpenalized.sim(vec, vec_ref, norm, norm_ref, length, length_ref))
+            image_deltas.append(float(length - length_ref))
+        similarities.append(image_similarities)
+        deltas.append(image_deltas)
+
+    variants = {}
+    for max_ngram in max_ngrams:
+        for sigma in sigmas:
+            scores = np.array(
+                [
+                    _combine_similarities(image_similarities, image_deltas, max_ngram, sigma, metric._multiplier)
+                    for image_similarities, image_deltas in zip(similarities, deltas)
+                ]
+            )
+            variants[max_ngram, sigma] = (np.mean(scores), scores)
+    return variants
+
+
+def _combine_similarities(
+    similarities: list[np.ndarray], deltas: list[float], max_ngram: int, sigma: float, multiplier: float
+) -> float:
+    """Same steps as `CiderMetric.sim` and `_compute_score_for_image` with the first `max_ngram` orders."""
+    score = np.zeros(max_ngram, dtype=np.float32)
+    for similarity, delta in zip(similarities, deltas):
+        val = similarity[:max_ngram].copy()
+        # The lengths are numbers of bigrams, which are not counted for unigrams only
+        delta = delta if max_ngram > 1 else 0.0
+        for ngram_n in range(max_ngram):
+            val[ngram_n] *= np.e ** (-(delta**2) / (2 * sigma**2))
+        score += val
+    score_avg = np.mean(score)
+    score_avg /= len(similarities)
+    return score_avg * multiplier
+
+
+def sweep_rows(bleu: Optional[BleuSweepType] = None, cider: Optional[CiderSweepType] = None) -> list[SweepRow]:
+    """Gather the corpus scores of the variants in one table."""
+    rows = []
+    for (option, max_ngram), (score, _) in (bleu or {}).items():
+        rows.append(SweepRow(metric="Bleu", max_ngram=max_ngram, option=option, score=score))
+    for (max_ngram, sigma), (score, _) in (cider or {}).items():
+        rows.append(SweepRow(metric="CIDEr", max_ngram=max_ngram, sigma=sigma, score=score))
+    return rows
+
+
+class SweepCOCOEvalCap(COCOEvalCap):
+    """COCOEvalCap that computes the scores of a grid of metric parameters from one set of n-gram statistics."""
+
+    def evaluate_sweep(
+        self,
+        bleu_options: Iterable[OPTIONS] = BLEU_OPTIONS,
+        max_ngrams: Optional[Iterable[int]] = None,
+        sigmas: Iterable[float] = DEFAULT_SIGMAS,
+    ) -> list[SweepRow]:
+        """Compute the corpus scores of a grid of metric parameters, preprocessing and counting only once.
+
+        :param bleu_options: reference length options of BLEU
+        :param max_ngrams: n-gram orders (default: 1 to `max_ngram`), the n-grams are counted up to the largest
+        :param sigmas: standard deviations of the CIDEr length penalty
+        :return: one row per metric variant
+        """
+        max_ngrams = list(range(1, self.max_ngram + 1)) if max_ngrams is None else list(max_ngrams)
+        if not max_ngrams:
+            raise ValueError("No n-gram order to evaluate")
+        ground_truths, results = self._prepare_data()
+        rows = []
+        for name in self.metric_names:
+            metric = METRICS[name](max(max_ngrams), unit=self.unit)
+            logging.info(f"Computing {metric.method} scores for the parameter sweep...")
+            if isinstance(metric, Bleu):
+                scorer = metric.build_scorer(ground_truths, results)
+                rows.extend(sweep_rows(bleu=bleu_sweep(scorer, bleu_options, max_ngrams)))
+            elif isinstance(metric, Cider):
+                metric.sketch = self.document_frequency_sketch
+                scorer = metric.build_scorer(ground_truths, results)
+                rows.extend(sweep_rows(cider=cider_sweep(scorer, max_ngrams, sigmas)))
+            else:
+                raise ValueError(f"Parameter sweeps are not supported for {metric.method}")
+        return rows
@@ -0,0 +1,248 @@
+"""
+Rolling BLEU and CIDEr over a sliding window of a stream of captioned images, e.g. a sample of the traffic of a live
+captioning service scored against references collected in the background.
+
+The sufficient statistics of the window support the removal of images as well as their addition:
+
+- BLEU corpus statistics are sums over images: an image entering or leaving the window adds or subtracts its
+  statistics, and its BLEU scores do not depend on the other images.
+- The CIDEr document frequency counts the images whose references contain each n-gram: it is incremented and
+  decremented with the reference n-grams of the images entering and leaving the window.
+
+The CIDEr score of an image depends on the document frequency and on the number of images of the window, so the CIDEr
+scores are recomputed from the stored n-gram counts when requested after the window changed, without preprocessing
+or counting anything again. The scores are the same as those of `COCOEvalCap.evaluate` on the images of the window.
+"""
+import logging
+import time
+from collections import deque
+from typing import Any, Optional
+
+import numpy as np
+
+from multicaptioneval.columnar import NgramUnitType, check_ngram_unit
+from multicaptioneval.eval import MAX_NGRAM_N, get_preprocessing
+from multicaptioneval.metrics.bleu.bleu_scorer import BleuScorer
+from multicaptioneval.metrics.bleu.data import BleuHypothesisStats, BleuStatsCounter
+from multicaptioneval.metrics.cider.cider_scorer import CiderMetric
+from multicaptioneval.metrics.cider.data import CiderNgramCounter, NgramCountType, NgramType
+from multicaptioneval.processing import CaptionGuard, ImageCaptionsType, TokenizationCache
+from multicaptioneval.scores import ImageScores
+
+WINDOW_METRICS = ("bleu", "cider")
+
+
+class WindowImage:
+    """Statistics of an image of the window."""
+
+    __slots__ = ("image_id", "timestamp", "bleu_stats", "bleu_reflen", "bleu_scores", "cider_test", "cider_refs")
+
+    def __init__(
+        self,
+        image_id: Any,
+        timestamp: float,
+        bleu_stats: Optional[BleuHypothesisStats] = None,
+        bleu_reflen: float = 0.0,
+        bleu_scores: Optional[list[float]] = None,
+        cider_test: Optional[NgramCountType] = None,
+        cider_refs: Optional[list[NgramCountType]] = None,
+    ) -> None:
+        self.image_id = image_id
+        self.timestamp = timestamp
+        self.bleu_stats = bleu_stats
+        self.bleu_reflen = bleu_reflen
+        self.bleu_scores = bleu_scores
+        self.cider_test = cider_test
+        self.cider_refs = cider_refs
+
+    @property
+    def reference_ngrams(self) -> set[NgramType]:
+        """The n-grams counted once in the CIDEr document frequency for this image."""
+        return set([ngram for ref in self.cider_refs for ngram in ref.keys()])
+
+
+class SlidingWindowEvaluator:
+    """Evaluate the last `max_images` images, or the images added in the last `max_age` seconds, or both.
+
+    Images are added in batches of raw captions with `add`, and expire when newer images push them out of the window.
+    `evaluate` returns the corpus scores of the window and sets `eval` and `image_scores` like `COCOEvalCap`.
+    """
+
+    def __init__(
+        self,
+        max_images: Optional[int] = None,
+        max_age: Optional[float] = None,
+        metrics: Optional[list[str]] = None,
+        language: str = "default",
+        tokenizer_cfg: Optional[dict[str, Any]] = None,
+        tokenization_cache: Optional[TokenizationCache] = None,
+        unit: NgramUnitType = "word",
+        max_ngram: int = MAX_NGRAM_N,
+        caption_guard: Optional[CaptionGuard] = None,
+    ) -> None:
+        """
+        :param max_images: number of images of the window
+        :param max_age: duration of the window in seconds, relative to the timestamps given to `add` and `evaluate`
+        """
+        check_ngram_unit(unit)
+        if max_images is None and max_age is None:
+            raise ValueError("The window must be bounded by max_images or max_age")
+        if (max_images is not None and max_images <= 0) or (max_age is not None and max_age <= 0):
+            raise ValueError(f"The window bounds must be positive: max_images={max_images}, max_age={max_age}")
+        self.metric_names = ["bleu", "cider"] if metrics is None else [metric.lower() for metric in metrics]
+        for metric in self.metric_names:
+            if metric not in WINDOW_METRICS:
+                raise ValueError(f"Sliding-window evaluation is not supported for {metric}")
+        self.max_images = max_images
+        self.max_age = max_age
+        self.unit = unit
+        self.max_ngram = max_ngram
+        self.preprocessing = get_preprocessing(unit, language, tokenizer_cfg, tokenization_cache, guard=caption_guard)
+        self.images: deque[WindowImage] = deque()
+        self._image_ids: set[Any] = set()
+        self.eval = {}
+        self.image_scores = ImageScores()
+
+        self._bleu_counter = BleuStatsCounter(max_ngram, unit=unit)
+        self._bleu_scorer = BleuScorer(max_ngram=max_ngram, unit=unit)
+        self._bleu_totals = self._bleu_scorer.new_totalstats()
+        self._cider_counter = CiderNgramCounter(max_ngram, unit=unit)
+        self._cider = CiderMetric(ngram_n=max_ngram, sigma=6.0)
+        self._cider.document_frequency = {}
+        # CIDEr scores of the images of the window, None after the window changed
+        self._cider_scores: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+    @property
+    def image_ids(self) -> list[Any]:
+        return [image.image_id for image in self.images]
+
+    def add(
+        self,
+        results: dict[Any, list[str]],
+        references: dict[Any, list[str]],
+        timestamp: Optional[float] = None,
+    ) -> None:
+        """Preprocess and add the raw captions of a batch of images, then expire the images out of the window.
+
+        :param results: image id -> the result caption, in a list, the image ids of the window must be unique
+        :param references: image id -> the reference captions, for the same image ids
+        :param timestamp: time of the batch in seconds, by default the current time, not older than the last batch
+        :raises ValueError: if an image is still in the window, or if the timestamp is older than the last batch
+        """
+        if results.keys() != references.keys():
+            raise ValueError("The results and the references must have the same image ids")
+        results = self.preprocessing(self._to_coco(results))
+        references = self.preprocessing(self._to_coco(references))
+        self.add_preprocessed(results, references, timestamp=timestamp)
+
+    def add_preprocessed(
+        self, results: ImageCaptionsType, references: ImageCaptionsType, timestamp: Optional[float] = None
+    ) -> None:
+        """Add the preprocessed captions of a batch of images, then expire the images out of the window."""
+        timestamp = time.time() if timestamp is None else timestamp
+        # The images expire from the head of the window, which must stay the oldest
+        if self.images and timestamp < self.images[-1].timestamp:
+            raise ValueError(f"The timestamp {timestamp} is older than the last batch: {self.images[-1].timestamp}")
+        # Images out of the window at `timestamp` can be added again
+        self.expire(timestamp)
+        repeated = [image_id for image_id in results if image_id in self._image_ids]
+        if repeated:
+            raise ValueError(f"{len(repeated)} images are already in the window, e.g. {repeated[0]}")
+        for image_id, hypotheses in results.items():
+            assert len(hypotheses) == 1, f"expected one result caption for {image_id}"
+            assert len(references[image_id]) > 0, f"expected reference captions for {image_id}"
+            self._add_image(self._count_image(image_id, hypotheses[0], references[image_id], timestamp))
+        self.expire(timestamp)
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """Remove the images older than `max_age` at `now` and the oldest images beyond `max_images`.
+
+        :return: the number of removed images
+        """
+        num_images = len(self.images)
+        if self.max_age is not None:
+            now = time.time() if now is None else now
+            while self.images and self.images[0].timestamp < now - self.max_age:
+                self._remove_image(self.images.popleft())
+        if self.max_images is not None:
+            while len(self.images) > self.max_images:
+                self._remove_image(self.images.popleft())
+        return num_images - len(self.images)
+
+    def evaluate(self, now: Optional[float] = None) -> dict[str, float]:
+        """Compute the scores of the images of the window at `now` (by default the current time)."""
+        self.expire(now)
+        self.eval = {}
+        self.image_scores = ImageScores()
+        if not self.images:
+            logging.warning("The evaluation window is empty")
+            return self.eval
+        image_ids = self.image_ids
+        if "bleu" in self.metric_names:
+            scores = self._bleu_scorer.aggregate_bleu_scores(self._bleu_totals)
+            image_scores = np.array([image.bleu_scores for image in self.images])
+            for ngram_n, score in enumerate(scores):
+                self._set_scores(f"Bleu_{ngram_n + 1}", score, image_ids, image_scores[:, ngram_n])
+        if "cider" in self.metric_names:
+            if self._cider_scores is None:
+                self._cider.ref_len = np.log(float(len(self.images)))
+                self._cider_scores = np.array(
+                    self._cider.score_images(
+                        crefs=[image.cider_refs for image in self.images],
+                        ctest=[image.cider_test for image in self.images],
+                    )
+                )
+            self._set_scores("CIDEr", np.mean(self._cider_scores), image_ids, self._cider_scores)
+        return self.eval
+
+    def _set_scores(self, name: str, score: float, image_ids: list[Any], scores: np.ndarray) -> None:
+        self.eval[name] = score
+        self.image_scores.set(name, image_ids, scores)
+        logging.info(f"{name}: {score:0.3f} over {len(image_ids)} images")
+
+    def _count_image(self, image_id: Any, hypothesis: str, references: list[str], timestamp: float) -> WindowImage:
+        image = WindowImage(image_id, timestamp)
+        if "bleu" in self.metric_names:
+            image.bleu_stats = self._bleu_counter.cook_test(
+                hypothesis, self._bleu_counter.cook_references(references)
+            )
+            image.bleu_reflen = self._bleu_scorer.get_reflen(image.bleu_stats, "closest")
+            image.bleu_scores = self._bleu_scorer.compute_image_bleu(image.bleu_stats, image.bleu_reflen)
+        if "cider" in self.metric_names:
+            image.cider_test = self._cider_counter(hypothesis)
+            image.cider_refs = self._cider_counter(references)
+        return image
+
+    def _add_image(self, image: WindowImage) -> None:
+        self.images.append(image)
+        self._image_ids.add(image.image_id)
+        if image.bleu_stats is not None:
+            self._bleu_scorer.add_stats(self._bleu_totals, image.bleu_stats, image.bleu_reflen)
+        if image.cider_refs is not None:
+            document_frequency = self._cider.document_frequency
+            for ngram in image.reference_ngrams:
+                document_frequency[ngram] = document_frequency.get(ngram, 0.0) + 1
+            self._cider_scores = None
+
+    def _remove_image(self, image: WindowImage) -> None:
+        self._image_ids.discard(image.image_id)
+        if image.bleu_stats is not None:
+            self._bleu_scorer.add_stats(self._bleu_totals, image.bleu_stats, image.bleu_reflen, sign=-1)
+        if image.cider_refs is not None:
+            document_frequency = self._cider.document_frequency
+            for ngram in image.reference_ngrams:
+                document_frequency[ngram] -= 1
+                # n-grams out of the window are not kept, so the memory is bounded by the window
+                if document_frequency[ngram] == 0:
+                    del document_frequency[ngram]
+            self._cider_scores = None
+
+    @staticmethod
+    def _to_coco(image_captions: dict[Any, list[str]]) -> dict[Any, list[dict[str, Any]]]:
+        return {
+            image_id: [{"image_id": image_id, "caption": caption} for caption in captions]
+            for image_id, captions in image_captions.items()
+        }
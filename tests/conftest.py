@@ -1,6 +1,9 @@
 import json
 from pytest import fixture
-from typing import Optional
+from typing import Any, Callable, Optional, Union
+
+from multicaptioneval.eval import COCOEvalCap
+from multicaptioneval.loader import CaptionIndex
 
 
 @fixture(scope="session")
@@ -36,3 +39,34 @@ def sacrebleu_references(references: dict[str, list[list[str]]], image_ids: list
             else:
                 refs[ref_idx].append(None)
     return refs
+
+
+@fixture(scope="session")
+def annotation_file() -> str:
+    return "tests/fixtures/th_captions_val2014.json"
+
+
+@fixture(scope="session")
+def results_file() -> str:
+    return "tests/fixtures/th_captions_val2014_fakecap_results.json"
+
+
+@fixture(scope="session")
+def get_eval() -> Callable[..., COCOEvalCap]:
+    """Factory of evaluators of the fixture results of a language with character segmentation, by default Thai."""
+
+    def get_eval(
+        cls: type = COCOEvalCap,
+        results: Optional[Union[str, list[dict[str, Any]]]] = None,
+        language: str = "th",
+        **kwargs,
+    ) -> COCOEvalCap:
+        coco = CaptionIndex.from_file(f"tests/fixtures/{language}_captions_val2014.json")
+        if results is None:
+            results = f"tests/fixtures/{language}_captions_val2014_fakecap_results.json"
+        coco_result = coco.loadRes(results)
+        coco_eval = cls(coco, coco_result, language=language, tokenizer_cfg={"word_segmenter": "char"}, **kwargs)
+        coco_eval.params["image_id"] = coco_result.getImgIds()
+        return coco_eval
+
+    return get_eval
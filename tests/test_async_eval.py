@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from multicaptioneval.async_eval import AsyncCOCOEvalCap
+from multicaptioneval.eval import COCOEvalCap
+from multicaptioneval.metrics.cider.sketch import SketchConfig
+
+LANGUAGES = ["th", "zh"]
+
+
+def test_async_evaluation(get_eval) -> None:
+    """Make sure concurrent asynchronous evaluations give the same scores as `evaluate`."""
+
+    async def run(coco_eval: AsyncCOCOEvalCap) -> list:
+        return [progress async for progress in coco_eval.iter_evaluate(chunk_size=7)]
+
+    async def run_all() -> list:
+        return await asyncio.gather(*[run(coco_eval) for coco_eval in async_evals])
+
+    async_evals = [get_eval(AsyncCOCOEvalCap, language=language) for language in LANGUAGES]
+    progress = asyncio.run(run_all())
+    for language, coco_eval, language_progress in zip(LANGUAGES, async_evals, progress):
+        expected = get_eval(COCOEvalCap, language=language)
+        expected.evaluate()
+        assert coco_eval.eval == expected.eval
+        assert coco_eval.imgToEval == expected.imgToEval
+        assert language_progress[-1].stage == "done"
+        assert {item.stage for item in language_progress} == {"preprocessing", "Bleu", "CIDEr", "done"}
+
+
+def test_async_evaluation_cancel(get_eval) -> None:
+    async def run() -> None:
+        coco_eval = get_eval(AsyncCOCOEvalCap)
+        started = asyncio.Event()
+
+        async def evaluate() -> None:
+            async for _ in coco_eval.iter_evaluate(chunk_size=5):
+                started.set()
+
+        task = asyncio.create_task(evaluate())
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert coco_eval.eval == {}
+
+    asyncio.run(run())
+
+
+def test_async_evaluation_sketch(get_eval) -> None:
+    """The deviation of a sketched CIDEr is measured as in `evaluate`."""
+    sketch = SketchConfig(width=4096, max_exact=1000, sample_size=50)
+    coco_eval = get_eval(AsyncCOCOEvalCap, document_frequency_sketch=sketch)
+    asyncio.run(coco_eval.evaluate_async(chunk_size=7))
+    expected = get_eval(COCOEvalCap, document_frequency_sketch=sketch)
+    expected.evaluate()
+    assert coco_eval.eval == pytest.approx(expected.eval)
+    assert coco_eval.sketch_deviation is not None and coco_eval.sketch_deviation == expected.sketch_deviation
@@ -0,0 +1,83 @@
+import pytest
+
+from multicaptioneval.checkpoint import CheckpointedCOCOEvalCap
+from multicaptioneval.eval import COCOEvalCap
+from multicaptioneval.processing import CaptionGuard
+
+
+def test_checkpoint_resume(tmp_path, monkeypatch, get_eval) -> None:
+    """Interrupt an evaluation and make sure the resumed one only processes the remaining chunks."""
+    expected = get_eval(COCOEvalCap)
+    expected.evaluate()
+
+    prepared = []
+    prepare_chunk = CheckpointedCOCOEvalCap._prepare_chunk
+
+    def interrupted_prepare_chunk(self, image_ids):
+        if len(prepared) == 2:
+            raise KeyboardInterrupt
+        prepared.append(image_ids)
+        return prepare_chunk(self, image_ids)
+
+    monkeypatch.setattr(CheckpointedCOCOEvalCap, "_prepare_chunk", interrupted_prepare_chunk)
+    with pytest.raises(KeyboardInterrupt):
+        get_eval(CheckpointedCOCOEvalCap).evaluate(tmp_path, chunk_size=10)
+    monkeypatch.setattr(CheckpointedCOCOEvalCap, "_prepare_chunk", prepare_chunk)
+
+    coco_eval = get_eval(CheckpointedCOCOEvalCap)
+    resumed = []
+
+    def resumed_prepare_chunk(image_ids):
+        resumed.append(image_ids)
+        return prepare_chunk(coco_eval, image_ids)
+
+    monkeypatch.setattr(coco_eval, "_prepare_chunk", resumed_prepare_chunk)
+    coco_eval.evaluate(tmp_path, chunk_size=10)
+    assert resumed[0] == coco_eval.params["image_id"][20:30]
+    assert len(prepared) + len(resumed) == len(list(tmp_path.glob("stats-*.pkl")))
+    assert coco_eval.eval == expected.eval
+    assert coco_eval.imgToEval == expected.imgToEval
+    ground_truths, results = coco_eval.load_captions(tmp_path)
+    assert list(results) == coco_eval.params["image_id"]
+
+    # Another chunk size or other inputs do not match the checkpoint
+    with pytest.raises(ValueError, match="chunk_size"):
+        get_eval(CheckpointedCOCOEvalCap).evaluate(tmp_path, chunk_size=20)
+    get_eval(CheckpointedCOCOEvalCap).evaluate(tmp_path, chunk_size=20, overwrite=True)
+
+
+def test_checkpoint_invalid(tmp_path, monkeypatch, get_eval) -> None:
+    """Nothing is preprocessed nor written without images or with a metric that cannot be checkpointed."""
+    coco_eval = get_eval(CheckpointedCOCOEvalCap)
+    coco_eval.params["image_id"] = []
+    with pytest.raises(ValueError, match="No images"):
+        coco_eval.evaluate(tmp_path / "empty")
+
+    class Meteor:
+        method = "METEOR"
+
+    coco_eval = get_eval(CheckpointedCOCOEvalCap)
+    monkeypatch.setattr(coco_eval, "_initializa_metrics", lambda: [Meteor()])
+    monkeypatch.setattr(coco_eval, "_prepare_chunk", lambda image_ids: pytest.fail("the chunk was preprocessed"))
+    with pytest.raises(ValueError, match="not supported for METEOR"):
+        coco_eval.evaluate(tmp_path / "meteor")
+    assert not (tmp_path / "empty").exists() and not (tmp_path / "meteor").exists()
+
+
+def test_checkpoint_caption_guard(tmp_path, monkeypatch, get_eval) -> None:
+    """A resumed run reports the images truncated in the saved chunks, and other guard limits do not match."""
+    caption_guard = CaptionGuard(max_chars=20, max_tokens=8)
+    expected = get_eval(caption_guard=caption_guard)
+    expected.evaluate()
+    assert expected.guard_report.truncated_chars
+
+    get_eval(CheckpointedCOCOEvalCap, caption_guard=caption_guard).evaluate(tmp_path, chunk_size=10)
+    coco_eval = get_eval(CheckpointedCOCOEvalCap, caption_guard=caption_guard)
+    monkeypatch.setattr(coco_eval, "_prepare_chunk", lambda image_ids: pytest.fail("the chunk was preprocessed"))
+    coco_eval.evaluate(tmp_path, chunk_size=10)
+    assert coco_eval.eval == expected.eval
+    assert sorted(coco_eval.guard_report.truncated_chars) == sorted(expected.guard_report.truncated_chars)
+    assert sorted(coco_eval.guard_report.truncated_tokens) == sorted(expected.guard_report.truncated_tokens)
+
+    with pytest.raises(ValueError, match="caption_guard"):
+        get_eval(CheckpointedCOCOEvalCap, caption_guard=CaptionGuard(max_chars=40)).evaluate(tmp_path, chunk_size=10)
@@ -0,0 +1,94 @@
+import json
+
+import pytest
+
+from multicaptioneval.cli import main
+from multicaptioneval.eval import COCOEvalCap
+from multicaptioneval.loader import load_json
+
+TOKENIZER_ARGS = ["--language", "th", "--tokenizer-cfg", '{"word_segmenter": "char"}']
+
+
+@pytest.fixture(scope="module")
+def expected(get_eval) -> COCOEvalCap:
+    coco_eval = get_eval()
+    coco_eval.evaluate()
+    return coco_eval
+
+
+@pytest.fixture(scope="module")
+def evaluate_args(annotation_file: str, results_file: str) -> list[str]:
+    return ["evaluate", annotation_file, results_file, *TOKENIZER_ARGS]
+
+
+def test_cli_evaluate(
+    tmp_path, capsys, expected: COCOEvalCap, evaluate_args: list[str], annotation_file: str, results_file: str
+) -> None:
+    main([*evaluate_args, "--batch-size", "7", "--workers", "2", "--timings"])
+    report = json.loads(capsys.readouterr().out)
+    assert report["scores"] == expected.eval
+    assert report["num_images"] == len(expected.params["image_id"])
+    assert set(report["timings"]) == {"load", "setup", "evaluate"}
+
+    # Streamed JSON Lines results, per-image scores and profiling output
+    jsonl_file = tmp_path / "results.jsonl"
+    jsonl_file.write_text("\n".join(json.dumps(result, ensure_ascii=False) for result in load_json(results_file)))
+    output_file, image_scores_file, profile_file = tmp_path / "scores.json", tmp_path / "scores.csv", tmp_path / "prof"
+    main(
+        [
+            "evaluate",
+            annotation_file,
+            str(jsonl_file),
+            *TOKENIZER_ARGS,
+            "--output",
+            str(output_file),
+            "--image-scores",
+            str(image_scores_file),
+            "--profile",
+            str(profile_file),
+        ]
+    )
+    assert load_json(output_file)["scores"] == expected.eval
+    assert len(image_scores_file.read_text().splitlines()) == len(expected.params["image_id"]) + 1
+    assert profile_file.exists()
+
+
+def test_cli_evaluate_reference_cache(tmp_path, capsys, expected: COCOEvalCap, evaluate_args: list[str]) -> None:
+    state_file = tmp_path / "state.pkl"
+    for _ in range(2):
+        main([*evaluate_args, "--reference-cache", str(state_file)])
+        assert json.loads(capsys.readouterr().out)["scores"] == expected.eval
+    assert state_file.exists()
+
+
+def test_cli_evaluate_pipelined(capsys, expected: COCOEvalCap, evaluate_args: list[str]) -> None:
+    main([*evaluate_args, "--pipelined", "--batch-size", "7", "--timings"])
+    report = json.loads(capsys.readouterr().out)
+    assert report["scores"] == expected.eval
+    assert {"pipeline.waiting", "pipeline.counting", "pipeline.scoring"} <= set(report["timings"])
+
+
+def test_cli_evaluate_streaming(
+    tmp_path, capsys, expected: COCOEvalCap, annotation_file: str, results_file: str
+) -> None:
+    jsonl_file = tmp_path / "results.jsonl"
+    jsonl_file.write_text("\n".join(json.dumps(result, ensure_ascii=False) for result in load_json(results_file)))
+    main(["evaluate", annotation_file, str(jsonl_file), *TOKENIZER_ARGS, "--streaming", "--batch-size", "100"])
+    report = json.loads(capsys.readouterr().out)
+    # The images are evaluated in the order of the stream, the mean CIDEr can differ in the last bits
+    assert report["scores"] == pytest.approx(expected.eval)
+    assert report["num_images"] == len(expected.params["image_id"])
+
+
+def test_cli_evaluate_mapped_references(tmp_path, capsys, expected: COCOEvalCap, evaluate_args: list[str]) -> None:
+    for _ in range(2):
+        main([*evaluate_args, "--mapped-references", str(tmp_path)])
+        assert json.loads(capsys.readouterr().out)["scores"] == expected.eval
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+@pytest.mark.parametrize("option", [["--workers", "2"], ["--executor", "thread"]])
+def test_cli_evaluate_ignored_workers(tmp_path, evaluate_args: list[str], option: list[str]) -> None:
+    for mode in (["--reference-cache", str(tmp_path / "state.pkl")], ["--checkpoint-dir", str(tmp_path)]):
+        with pytest.raises(SystemExit, match="--workers and --executor"):
+            main([*evaluate_args, *mode, *option])
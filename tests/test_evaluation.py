@@ -1,7 +1,14 @@
+import numpy as np
 import pytest
 
 from pycocotools.coco import COCO
 from multicaptioneval.eval import COCOEvalCap
+from multicaptioneval.loader import CaptionIndex
+from multicaptioneval.multilingual import MultilingualCOCOEvalCap
+from multicaptioneval.processing import CaptionGuard
+from multicaptioneval.sampling import SampledCOCOEvalCap
+from multicaptioneval.slices import SlicedCOCOEvalCap
+from multicaptioneval.sweep import SweepCOCOEvalCap
 
 
 @pytest.mark.parametrize(
@@ -66,3 +73,212 @@ def test_eval(annotation_file: str, results_file: str, language: str) -> None:
     assert len(coco_eval.imgToEval) == len(coco_result.imgs)
     scores = coco_eval.eval.items()
     assert scores
+
+
+@pytest.mark.parametrize(
+    "annotation_file,results_file,language",
+    [
+        (
+            "tests/fixtures/en_captions_val2014.json",
+            "tests/fixtures/en_captions_val2014_fakecap_results.json",
+            "en",
+        ),
+        (
+            "tests/fixtures/zh_captions_val2014.json",
+            "tests/fixtures/zh_captions_val2014_fakecap_results.json",
+            "zh",
+        ),
+    ],
+)
+def test_eval_with_caption_index(annotation_file: str, results_file: str, language: str) -> None:
+    """Make sure the lightweight loader gives the same scores as pycocotools."""
+    coco = COCO(annotation_file)
+    coco_result = coco.loadRes(results_file)
+    coco_eval = COCOEvalCap(coco, coco_result, language=language)
+    coco_eval.params["image_id"] = coco_result.getImgIds()
+    coco_eval.evaluate()
+
+    caption_index = CaptionIndex.from_file(annotation_file)
+    caption_index_result = caption_index.loadRes(results_file)
+    assert caption_index_result.getImgIds() == coco_result.getImgIds()
+    caption_index_eval = COCOEvalCap(caption_index, caption_index_result, language=language)
+    caption_index_eval.params["image_id"] = caption_index_result.getImgIds()
+    caption_index_eval.evaluate()
+    assert caption_index_eval.eval == coco_eval.eval
+
+
+@pytest.mark.parametrize("executor", ["thread", "process", "shared_memory"])
+def test_eval_concurrent_metrics(executor: str) -> None:
+    """Make sure the concurrent metrics give the same results as the sequential ones."""
+    coco = CaptionIndex.from_file("tests/fixtures/th_captions_val2014.json")
+    coco_result = coco.loadRes("tests/fixtures/th_captions_val2014_fakecap_results.json")
+    evaluations = []
+    for workers in (1, 2):
+        coco_eval = COCOEvalCap(coco, coco_result, language="th", tokenizer_cfg={"word_segmenter": "char"})
+        coco_eval.params["image_id"] = coco_result.getImgIds()
+        coco_eval.evaluate(workers=workers, executor=executor)
+        evaluations.append(coco_eval)
+    assert evaluations[0].eval == evaluations[1].eval
+    assert list(evaluations[0].eval) == list(evaluations[1].eval)
+    assert evaluations[0].imgToEval == evaluations[1].imgToEval
+
+
+def test_eval_image_scores_export(tmp_path) -> None:
+    """Make sure the columnar per-image scores match imgToEval and can be exported."""
+    coco = CaptionIndex.from_file("tests/fixtures/th_captions_val2014.json")
+    coco_result = coco.loadRes("tests/fixtures/th_captions_val2014_fakecap_results.json")
+    coco_eval = COCOEvalCap(coco, coco_result, language="th", tokenizer_cfg={"word_segmenter": "char"})
+    coco_eval.params["image_id"] = coco_result.getImgIds()
+    coco_eval.evaluate()
+
+    image_scores = coco_eval.get_image_scores()
+    assert image_scores.dtype.names == ("image_id", "Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4", "CIDEr")
+    for row in image_scores:
+        image_eval = coco_eval.imgToEval[int(row["image_id"])]
+        assert all(row[name] == image_eval[name] for name in image_scores.dtype.names)
+
+    coco_eval.export_image_scores(tmp_path / "scores.npz")
+    exported = np.load(tmp_path / "scores.npz")
+    assert np.array_equal(exported["CIDEr"], image_scores["CIDEr"])
+    coco_eval.export_image_scores(tmp_path / "scores.csv")
+    with open(tmp_path / "scores.csv") as fp:
+        assert len(fp.readlines()) == len(image_scores) + 1
+
+    # pycocoevalcap-style code assigns the per-image evaluation
+    coco_eval.imgToEval = {image_id: {"image_id": image_id} for image_id in coco_eval.imgToEval}
+    coco_eval.evalImgs = [image_eval for image_eval in coco_eval.imgToEval.values()]
+    assert coco_eval.evalImgs == list(coco_eval.imgToEval.values())
+    assert all(image_eval.keys() == {"image_id"} for image_eval in coco_eval.evalImgs)
+
+
+def test_eval_slices() -> None:
+    """Make sure the slice scores match separate evaluations of each slice."""
+    coco = CaptionIndex.from_file("tests/fixtures/th_captions_val2014.json")
+    coco_result = coco.loadRes("tests/fixtures/th_captions_val2014_fakecap_results.json")
+    image_ids = coco_result.getImgIds()
+    labels = [image_id % 3 for image_id in image_ids]
+
+    coco_eval = SlicedCOCOEvalCap(coco, coco_result, language="th", tokenizer_cfg={"word_segmenter": "char"})
+    coco_eval.params["image_id"] = image_ids
+    slice_eval = coco_eval.evaluate_slices(labels, document_frequency="slice")
+    assert slice_eval == coco_eval.evaluate_slices(
+        {label: [image_id for image_id in image_ids if image_id % 3 == label] for label in range(3)},
+        document_frequency="slice",
+    )
+    for label, scores in slice_eval.items():
+        slice_coco_eval = COCOEvalCap(coco, coco_result, language="th", tokenizer_cfg={"word_segmenter": "char"})
+        slice_coco_eval.params["image_id"] = [image_id for image_id in image_ids if image_id % 3 == label]
+        slice_coco_eval.evaluate()
+        assert scores == slice_coco_eval.eval
+
+
+def test_eval_sweep(get_eval) -> None:
+    """Make sure the sweep includes the scores of the default parameters."""
+    coco_eval = get_eval(SweepCOCOEvalCap)
+    coco_eval.evaluate()
+    rows = coco_eval.evaluate_sweep(sigmas=[3.0, 6.0])
+    assert len(rows) == 3 * 4 + 4 * 2
+    scores = {(row.metric, row.max_ngram, row.option, row.sigma): row.score for row in rows}
+    for max_ngram in range(1, 5):
+        assert scores["Bleu", max_ngram, "closest", None] == coco_eval.eval[f"Bleu_{max_ngram}"]
+    assert scores["CIDEr", 4, None, 6.0] == coco_eval.eval["CIDEr"]
+
+
+def test_eval_sampled() -> None:
+    """Make sure the sampled estimates cover the full scores, and are exact when all images are sampled."""
+    coco = CaptionIndex.from_file("tests/fixtures/zh_captions_val2014.json")
+    coco_result = coco.loadRes("tests/fixtures/zh_captions_val2014_fakecap_results.json")
+    coco_eval = SampledCOCOEvalCap(coco, coco_result, language="zh", tokenizer_cfg={"word_segmenter": "char"})
+    coco_eval.params["image_id"] = coco_result.getImgIds()
+    coco_eval.evaluate()
+    reference_statistics = coco_eval.compute_reference_statistics()
+
+    image_ids = coco_eval.params["image_id"]
+    sampled = coco_eval.evaluate_sampled(
+        target_widths={"Bleu_4": 1.0, "CIDEr": 10.0},
+        initial_size=len(image_ids) // 2,
+        strata=[image_id % 2 for image_id in image_ids],
+        reference_statistics=reference_statistics,
+    )
+    assert sampled.converged and sampled.num_images < len(image_ids)
+    for name, estimate in sampled.estimates.items():
+        assert estimate.lower < estimate.score < estimate.upper
+
+    sampled = coco_eval.evaluate_sampled(target_widths={"CIDEr": 0.0}, initial_size=10)
+    assert sampled.num_images == len(image_ids)
+    assert sampled.scores == pytest.approx(coco_eval.eval)
+    assert all(estimate.std_error == 0 for estimate in sampled.estimates.values())
+
+
+def get_multilingual_eval(**kwargs) -> tuple[MultilingualCOCOEvalCap, dict[str, COCOEvalCap]]:
+    """Mix the th and zh fixtures in one result file, with the separate evaluations of each language."""
+    tokenizer_cfgs = {"th": {"word_segmenter": "char"}, "zh": {"word_segmenter": "char"}}
+    dataset = {"images": [], "annotations": []}
+    results = []
+    expected = {}
+    for language, tokenizer_cfg in tokenizer_cfgs.items():
+        coco = CaptionIndex.from_file(f"tests/fixtures/{language}_captions_val2014.json")
+        coco_result = coco.loadRes(f"tests/fixtures/{language}_captions_val2014_fakecap_results.json")
+        image_ids = coco_result.getImgIds()[:200]
+        coco_eval = COCOEvalCap(coco, coco_result, language=language, tokenizer_cfg=tokenizer_cfg, **kwargs)
+        coco_eval.params["image_id"] = image_ids
+        coco_eval.evaluate()
+        expected[language] = coco_eval
+
+        # Only the results have a language field
+        for image_id in image_ids:
+            dataset["images"].append({"id": f"{language}-{image_id}"})
+            for ann in coco.imgToAnns[image_id]:
+                dataset["annotations"].append({"image_id": f"{language}-{image_id}", "caption": ann["caption"]})
+            for ann in coco_result.imgToAnns[image_id]:
+                results.append({"image_id": f"{language}-{image_id}", "caption": ann["caption"], "language": language})
+
+    coco = CaptionIndex.from_dataset(dataset)
+    coco_eval = MultilingualCOCOEvalCap(coco, coco.loadRes(results), tokenizer_cfgs=tokenizer_cfgs, **kwargs)
+    coco_eval.evaluate()
+    return coco_eval, expected
+
+
+@pytest.mark.parametrize("options", [{}, {"unit": "char", "max_ngram": 2}])
+def test_eval_multilingual(options: dict) -> None:
+    """Make sure the per-language scores of a mixed result file match separate evaluations of each language."""
+    coco_eval, expected = get_multilingual_eval(**options)
+    max_ngram = options.get("max_ngram", 4)
+    assert set(coco_eval.eval) == {*[f"Bleu_{n}" for n in range(1, max_ngram + 1)], "CIDEr"}
+    for language, language_eval in expected.items():
+        assert coco_eval.language_eval[language] == language_eval.eval
+        for image_id, image_eval in language_eval.imgToEval.items():
+            assert coco_eval.imgToEval[f"{language}-{image_id}"][f"Bleu_{max_ngram}"] == image_eval[f"Bleu_{max_ngram}"]
+
+
+def test_eval_multilingual_caption_guard() -> None:
+    """A guarded multilingual evaluation reports the truncated images of every language."""
+    coco_eval, expected = get_multilingual_eval(caption_guard=CaptionGuard(max_chars=20, max_tokens=8))
+    for language, language_eval in expected.items():
+        assert coco_eval.language_eval[language] == language_eval.eval
+    for field in ("truncated_chars", "truncated_tokens"):
+        truncated = [
+            f"{language}-{image_id}"
+            for language, language_eval in expected.items()
+            for image_id in getattr(language_eval.guard_report, field)
+        ]
+        assert truncated and sorted(getattr(coco_eval.guard_report, field)) == sorted(truncated)
+
+
+def test_eval_characters() -> None:
+    """Character n-grams need no segmenter and give scores close to the character segmenter."""
+    coco = CaptionIndex.from_file("tests/fixtures/zh_captions_val2014.json")
+    coco_result = coco.loadRes("tests/fixtures/zh_captions_val2014_fakecap_results.json")
+    coco_eval = COCOEvalCap(coco, coco_result, language="zh", unit="char", max_ngram=6)
+    coco_eval.params["image_id"] = coco_result.getImgIds()
+    coco_eval.evaluate()
+    assert list(coco_eval.eval) == [f"Bleu_{n}" for n in range(1, 7)] + ["CIDEr"]
+
+    coco_eval = COCOEvalCap(coco, coco_result, language="zh", unit="char")
+    coco_eval.params["image_id"] = coco_result.getImgIds()
+    coco_eval.evaluate()
+    segmented_eval = COCOEvalCap(coco, coco_result, language="zh", tokenizer_cfg={"word_segmenter": "char"})
+    segmented_eval.params["image_id"] = coco_result.getImgIds()
+    segmented_eval.evaluate()
+    for name, score in segmented_eval.eval.items():
+        assert coco_eval.eval[name] == pytest.approx(score, abs=0.02)
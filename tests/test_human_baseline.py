@@ -0,0 +1,34 @@
+import numpy as np
+
+from multicaptioneval.human_baseline import HumanBaseline, HumanBaselineCOCOEvalCap
+from multicaptioneval.metrics.bleu.bleu import Bleu
+from multicaptioneval.metrics.cider.cider import Cider
+
+
+def test_human_baseline(references: dict[str, list[list[str]]]) -> None:
+    """Verify the leave-one-out scores against separate evaluations for each held-out reference."""
+    scores, image_scores = HumanBaseline().compute_score(references)
+    num_folds = max(len(refs) for refs in references.values())
+    assert len(scores["folds"]) == num_folds
+
+    for fold, fold_scores in enumerate(scores["folds"]):
+        fold_images = [image_id for image_id, refs in references.items() if len(refs) > fold]
+        hypotheses = {image_id: [references[image_id][fold]] for image_id in fold_images}
+        others = {image_id: references[image_id][:fold] + references[image_id][fold + 1 :] for image_id in fold_images}
+        bleu_score, _ = Bleu().compute_score(ground_truths=others, results=hypotheses)
+        cider_score, _ = Cider().compute_score(ground_truths=others, results=hypotheses)
+        assert np.allclose([fold_scores[f"Bleu_{n}"] for n in range(1, 5)], bleu_score)
+        assert np.isclose(fold_scores["CIDEr"], cider_score)
+
+    assert len(image_scores) == len(references)
+    assert np.isclose(scores["corpus"]["CIDEr"], np.mean([fold_scores["CIDEr"] for fold_scores in scores["folds"]]))
+
+
+def test_human_baseline_evaluation(get_eval) -> None:
+    """The baseline of an evaluation is the one of its preprocessed references."""
+    coco_eval = get_eval(HumanBaselineCOCOEvalCap)
+    scores, image_scores = coco_eval.evaluate_human_baseline()
+    references = {image_id: coco_eval.coco.imgToAnns[image_id] for image_id in coco_eval.params["image_id"]}
+    expected_scores, expected_image_scores = HumanBaseline().compute_score(coco_eval.preprocessing(references))
+    assert scores == expected_scores
+    assert image_scores.to_dict() == expected_image_scores.to_dict()
@@ -0,0 +1,25 @@
+import copy
+import json
+
+from multicaptioneval.eval import COCOEvalCap
+from multicaptioneval.incremental import EvaluationState, IncrementalCOCOEvalCap
+
+
+def test_incremental_evaluation(tmp_path, get_eval, results_file: str) -> None:
+    """Make sure rescoring only the changed images gives the same results as a fresh evaluation."""
+    results = json.load(open(results_file))
+    previous = get_eval(IncrementalCOCOEvalCap, json.load(open(results_file)))
+    previous.evaluate()
+    previous.state.save(tmp_path / "state.pkl")
+
+    # Change a few captions
+    for result in results[::10]:
+        result["caption"] = result["caption"][::-1]
+    fresh = get_eval(COCOEvalCap, copy.deepcopy(results))
+    fresh.evaluate()
+    incremental = get_eval(IncrementalCOCOEvalCap, results)
+    incremental.evaluate(state=EvaluationState.load(tmp_path / "state.pkl"))
+
+    assert incremental.eval == fresh.eval
+    assert incremental.imgToEval == fresh.imgToEval
+    assert incremental.eval != previous.eval
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from multicaptioneval.mapped_references import MappedCOCOEvalCap, MappedReferenceStatistics
+
+
+@pytest.mark.parametrize("unit", ["word", "char"])
+def test_mapped_references(tmp_path, monkeypatch, get_eval, unit) -> None:
+    """Make sure the evaluation with the memory-mapped references gives the same scores as `evaluate`."""
+    expected = get_eval(unit=unit)
+    expected.evaluate()
+
+    references = get_eval(MappedCOCOEvalCap, unit=unit).get_mapped_references(tmp_path)
+    assert isinstance(references.arrays["ngram_keys"], np.memmap)
+    assert np.all(np.diff(references.arrays["ngram_keys"].astype(np.float64)) >= 0)
+    coco_eval = get_eval(MappedCOCOEvalCap, unit=unit)
+    coco_eval.evaluate(references)
+    assert coco_eval.eval == expected.eval
+    assert coco_eval.imgToEval == expected.imgToEval
+
+    # The statistics are opened without preprocessing the references again
+    coco_eval = get_eval(MappedCOCOEvalCap, unit=unit)
+    monkeypatch.setattr(MappedReferenceStatistics, "build", lambda *args, **kwargs: pytest.fail("rebuilt"))
+    reopened = coco_eval.get_mapped_references(tmp_path)
+    assert reopened.directory == references.directory
+    coco_eval.evaluate(reopened)
+    assert coco_eval.eval == expected.eval
+
+    # Lower n-gram orders are computed from the same statistics
+    lower = get_eval(unit=unit, max_ngram=2)
+    lower.evaluate()
+    bleu, _ = references.compute_bleu(lower._prepare_data()[1], max_ngram=2)
+    assert bleu == [lower.eval["Bleu_1"], lower.eval["Bleu_2"]]
+
+    with pytest.raises(ValueError, match="preprocessing"):
+        get_eval(MappedCOCOEvalCap, unit=unit, max_ngram=2).evaluate(references)
@@ -1,5 +1,6 @@
 import sacrebleu
 import numpy as np
+from collections import defaultdict
 from typing import Optional
 
 from pycocoevalcap.cider.cider import Cider as PyCOCOCider
@@ -7,6 +8,16 @@ from pycocoevalcap.bleu.bleu import Bleu as PyCOCOBLEU
 
 from multicaptioneval.metrics.cider.cider import Cider as MultiCaptionCider
 from multicaptioneval.metrics.bleu.bleu import Bleu as MultiCaptionBLEU
+from multicaptioneval.metrics.bleu.bleu_scorer import BleuScorer
+from multicaptioneval.columnar import TokenizedCorpus, Vocabulary, count_ngrams
+from multicaptioneval.mbr import MBRUtility
+from multicaptioneval.metrics.cider.cider_scorer import CiderMetric
+from multicaptioneval.metrics.cider.data import CiderNgramCounter
+from multicaptioneval.metrics.cider.sketch import SketchConfig
+from multicaptioneval.parallel import ParallelScorer
+from multicaptioneval.sampling import compute_reference_statistics
+from multicaptioneval.slices import bleu_slice_scores
+from multicaptioneval.sweep import bleu_sweep, cider_sweep, sweep_rows
 
 
 def test_cider(results: dict[str, list[str]], references: dict[str, list[list[str]]]) -> None:
@@ -50,3 +61,163 @@ def test_bleu_against_pycocobleu(results: dict[str, list[str]], references: dict
     # Check the score for each image.
     for ngram, scores in enumerate(pycococbleu_scores):
         np.allclose(scores, multicapbleu_scores[ngram])
+
+
+def test_metrics_on_tokenized_corpus(
+    results: dict[str, list[str]], references: dict[str, list[list[str]]], tmp_path
+) -> None:
+    """Verify the scores on the columnar corpus match the scores on the captions."""
+    vocabulary = Vocabulary()
+    TokenizedCorpus.from_captions(references, vocabulary=vocabulary).save(tmp_path / "references")
+    TokenizedCorpus.from_captions(results, vocabulary=vocabulary).save(tmp_path / "results")
+    reference_corpus = TokenizedCorpus.load(tmp_path / "references")
+    result_corpus = TokenizedCorpus.load(tmp_path / "results", vocabulary=reference_corpus.vocabulary)
+    assert result_corpus.to_captions() == results
+
+    for metric in (MultiCaptionBLEU(), MultiCaptionCider()):
+        score, scores = metric.compute_score(ground_truths=references, results=results)
+        corpus_score, corpus_scores = metric.compute_score(ground_truths=reference_corpus, results=result_corpus)
+        assert np.allclose(score, corpus_score)
+        assert np.allclose(scores, corpus_scores)
+
+
+def test_metrics_on_characters(results: dict[str, list[str]], references: dict[str, list[list[str]]]) -> None:
+    """Verify the character mode matches the word mode on captions segmented into characters."""
+
+    def segment(captions: list[str]) -> list[str]:
+        return [" ".join(caption.replace(" ", "")) for caption in captions]
+
+    char_results = {image_id: segment(captions) for image_id, captions in results.items()}
+    char_references = {image_id: segment(captions) for image_id, captions in references.items()}
+    for metric_cls in (MultiCaptionBLEU, MultiCaptionCider):
+        for ngram_n in (4, 6):
+            score, scores = metric_cls(ngram_n).compute_score(ground_truths=char_references, results=char_results)
+            char_score, char_scores = metric_cls(ngram_n, unit="char").compute_score(
+                ground_truths=references, results=results
+            )
+            assert np.allclose(score, char_score)
+            assert np.allclose(scores, char_scores)
+
+
+def test_metrics_in_parallel(results: dict[str, list[str]], references: dict[str, list[list[str]]]) -> None:
+    """Verify the images scored across worker processes give exactly the serial scores."""
+    scorer = ParallelScorer(workers=2, chunks_per_worker=3)
+    for unit, max_length in (("word", None), ("char", None), ("word", 3), ("char", 5)):
+        metrics = [
+            MultiCaptionBLEU(unit=unit, max_length=max_length),
+            MultiCaptionCider(unit=unit, max_length=max_length),
+        ]
+        parallel_scores = scorer.compute_scores(metrics, ground_truths=references, results=results)
+        for metric, (score, scores) in zip(metrics, parallel_scores):
+            serial_score, serial_scores = metric.compute_score(ground_truths=references, results=results)
+            assert score == serial_score
+            assert np.array_equal(scores, serial_scores)
+
+
+def test_mbr_utilities(references: dict[str, list[list[str]]]) -> None:
+    """Verify the utility matrices match scoring every pair of candidates with `Bleu` and `Cider`."""
+    candidates = dict(list(references.items())[:20])
+    utility = MBRUtility(batch_size=8)
+    bleu_utilities = utility.bleu(candidates)
+    cider_utilities = utility.cider(candidates)
+    reference_statistics = compute_reference_statistics(references)
+    corpus_utilities = utility.cider(candidates, reference_statistics=reference_statistics)
+    corpus_metric = CiderMetric(ngram_n=4, sigma=6.0)
+    corpus_metric.document_frequency = defaultdict(float, reference_statistics[0])
+    corpus_metric.ref_len = reference_statistics[1]
+    counter = CiderNgramCounter(4)
+    for image_id, image_candidates in candidates.items():
+        pseudo_references = {index: [candidate] for index, candidate in enumerate(image_candidates)}
+        for index, candidate in enumerate(image_candidates):
+            hypotheses = {position: [candidate] for position in pseudo_references}
+            _, bleu_scores = MultiCaptionBLEU().compute_score(ground_truths=pseudo_references, results=hypotheses)
+            assert np.allclose(bleu_utilities[image_id][index], bleu_scores[3])
+            _, cider_scores = MultiCaptionCider().compute_score(ground_truths=pseudo_references, results=hypotheses)
+            assert np.allclose(cider_utilities[image_id][index], cider_scores, rtol=1e-5, atol=1e-6)
+            corpus_scores = [
+                corpus_metric._compute_score_for_image(counter(candidate), [counter(other)])
+                for other in image_candidates
+            ]
+            assert np.allclose(corpus_utilities[image_id][index], corpus_scores, rtol=1e-5, atol=1e-6)
+    assert set(MBRUtility.select(cider_utilities)) == set(candidates)
+
+
+def test_cider_sketch(results: dict[str, list[str]], references: dict[str, list[list[str]]]) -> None:
+    """A large sketch is close to the exact scores, a small one deviates more and reports it."""
+    exact = MultiCaptionCider()
+    exact_score, exact_scores = exact.compute_score(ground_truths=references, results=results)
+    assert exact.sketch_deviation is None
+
+    sketched = MultiCaptionCider(sketch=SketchConfig(width=2**20))
+    sketch_score, sketch_scores = sketched.compute_score(ground_truths=references, results=results)
+    assert np.allclose(exact_scores, sketch_scores, atol=0.01)
+    assert abs(sketch_score - exact_score) < 1e-4
+    assert sketched.sketch_deviation.max_abs == np.abs(exact_scores - sketch_scores).max()
+
+    small = MultiCaptionCider(sketch=SketchConfig(width=4096, max_exact=1000, sample_size=50))
+    small_score, _ = small.compute_score(ground_truths=references, results=results)
+    deviation = small.sketch_deviation
+    assert deviation.num_images == 50 and sketched.sketch_deviation.max_abs < deviation.max_abs
+    assert abs(small_score - exact_score) < 0.2
+
+    # The scoring only reads the document frequency
+    metric = CiderMetric(ngram_n=4, sigma=6.0)
+    counter = CiderNgramCounter(4)
+    crefs = [counter(refs) for refs in references.values()]
+    metric(crefs, [counter(results[image_id][0]) for image_id in references])
+    assert len(metric.document_frequency) == len({ngram for refs in crefs for ref in refs for ngram in ref})
+
+
+def test_count_ngrams_runs() -> None:
+    """Counting by runs of repeated units gives the same counts, in the same order, as a sliding window."""
+    for units in (["a"] * 100 + ["b", "a", "a"] * 30 + ["c"] * 5, "ab" * 20 + "c" * 100 + "a"):
+        expected = defaultdict(int)
+        for ngram_n in range(1, 5):
+            for start in range(len(units) - ngram_n + 1):
+                ngram = units[start : start + ngram_n]
+                expected[ngram if isinstance(ngram, str) else tuple(ngram)] += 1
+        counts = count_ngrams(units, 4)
+        assert counts == expected and list(counts) == list(expected)
+
+
+def test_metric_sweep(results: dict[str, list[str]], references: dict[str, list[list[str]]]) -> None:
+    """The variants computed from one set of statistics match separate runs."""
+    image_ids = list(results)[:200]
+    results = {image_id: results[image_id] for image_id in image_ids}
+    references = {image_id: references[image_id] for image_id in image_ids}
+
+    bleu_variants = bleu_sweep(MultiCaptionBLEU(4).build_scorer(references, results), max_ngrams=[2, 4])
+    assert len(bleu_variants) == 6
+    for (option, max_ngram), (score, scores) in bleu_variants.items():
+        expected_score, expected_scores = MultiCaptionBLEU(max_ngram).build_scorer(references, results).compute(option)
+        assert score == expected_score[-1]
+        assert np.array_equal(scores, expected_scores[-1])
+
+    cider_variants = cider_sweep(MultiCaptionCider(4).build_scorer(references, results), [1, 3, 4], [3.0, 6.0])
+    for (max_ngram, sigma), (score, scores) in cider_variants.items():
+        expected_score, expected_scores = MultiCaptionCider(max_ngram, sigma=sigma).compute_score(references, results)
+        assert score == expected_score
+        assert np.array_equal(scores, expected_scores)
+    assert [row.metric for row in sweep_rows(bleu_variants, cider_variants)] == ["Bleu"] * 6 + ["CIDEr"] * 6
+
+
+def test_bleu_slice_statistics(
+    results: dict[str, list[str]], references: dict[str, list[list[str]]], monkeypatch
+) -> None:
+    """The slice statistics of all the images are the corpus statistics, skipping images without a hypothesis."""
+    scorer = MultiCaptionBLEU(4).build_scorer(references, results)
+    score, _ = scorer.compute(option="closest")
+    scorer.data.references.append(scorer.data.references[0])
+    scorer.data.hypotheses.append(None)
+
+    totals = []
+    aggregate_bleu_scores = BleuScorer.aggregate_bleu_scores
+
+    def tracked_aggregate_bleu_scores(self, totalstats):
+        totals.append(totalstats)
+        return aggregate_bleu_scores(self, totalstats)
+
+    monkeypatch.setattr(BleuScorer, "aggregate_bleu_scores", tracked_aggregate_bleu_scores)
+    slice_scores = bleu_slice_scores(scorer, {"all": np.arange(len(scorer.data.hypotheses))})
+    assert slice_scores["all"] == score
+    assert totals[0]["reflen"] == scorer._reflen and totals[0]["testlen"] == scorer._testlen
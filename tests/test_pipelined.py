@@ -0,0 +1,77 @@
+import threading
+
+import pytest
+
+from multicaptioneval.eval import COCOEvalCap
+from multicaptioneval.loader import load_json
+from multicaptioneval.metrics.bleu.bleu import Bleu
+from multicaptioneval.pipelined import PipelinedCOCOEvalCap
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_pipelined_evaluation(get_eval, executor: str) -> None:
+    """Make sure the pipelined evaluation gives the same scores as `evaluate`."""
+    expected = get_eval(COCOEvalCap)
+    expected.evaluate()
+    coco_eval = get_eval(PipelinedCOCOEvalCap)
+    coco_eval.evaluate(chunk_size=7, executor=executor)
+    assert coco_eval.eval == expected.eval
+    assert coco_eval.imgToEval == expected.imgToEval
+
+
+def test_pipelined_backpressure(monkeypatch, get_eval) -> None:
+    """The producer never gets more than `max_pending` chunks ahead of the counting."""
+    coco_eval = get_eval(PipelinedCOCOEvalCap)
+    lock = threading.Lock()
+    counts = {"preprocessed": 0, "counted": 0, "ahead": 0}
+    preprocess_chunk = coco_eval._preprocess_chunk
+    build_scorer = Bleu.build_scorer
+
+    def tracked_preprocess_chunk(ground_truths, results):
+        with lock:
+            counts["preprocessed"] += 1
+            counts["ahead"] = max(counts["ahead"], counts["preprocessed"] - counts["counted"])
+        return preprocess_chunk(ground_truths, results)
+
+    def tracked_build_scorer(self, ground_truths, results, scorer=None):
+        with lock:
+            counts["counted"] += 1
+        return build_scorer(self, ground_truths, results, scorer)
+
+    monkeypatch.setattr(coco_eval, "_preprocess_chunk", tracked_preprocess_chunk)
+    monkeypatch.setattr(Bleu, "build_scorer", tracked_build_scorer)
+    coco_eval.evaluate(chunk_size=5, max_pending=2, executor="thread")
+    assert counts["preprocessed"] == counts["counted"] > 2
+    assert counts["ahead"] <= 2
+
+
+def test_pipelined_stream(monkeypatch, get_eval, results_file: str) -> None:
+    """The streamed results are consumed a chunk at a time, with the same scores as `evaluate` in stream order."""
+    annotations = load_json(results_file)
+    expected = get_eval(COCOEvalCap)
+    expected.params["image_id"] = [annotation["image_id"] for annotation in annotations]
+    expected.evaluate()
+
+    consumed = []
+    counted_after = []
+    build_scorer = Bleu.build_scorer
+
+    def stream():
+        for annotation in annotations:
+            consumed.append(annotation["image_id"])
+            yield annotation
+
+    def tracked_build_scorer(self, ground_truths, results, scorer=None):
+        counted_after.append(len(consumed))
+        return build_scorer(self, ground_truths, results, scorer)
+
+    monkeypatch.setattr(Bleu, "build_scorer", tracked_build_scorer)
+    coco_eval = get_eval(PipelinedCOCOEvalCap)
+    coco_eval.evaluate_stream(stream(), chunk_size=100, max_pending=2, executor="thread")
+    assert counted_after[0] <= 300 < len(annotations)
+    assert coco_eval.params["image_id"] == expected.params["image_id"]
+    assert coco_eval.eval == expected.eval
+    assert coco_eval.imgToEval == expected.imgToEval
+
+    with pytest.raises(ValueError, match="Several results"):
+        get_eval(PipelinedCOCOEvalCap).evaluate_stream(annotations[:3] + annotations[:1], executor="thread")
@@ -0,0 +1,67 @@
+import copy
+import json
+
+from multicaptioneval.metrics.cider.cider import Cider
+from multicaptioneval.processing import CaptionGuard, CharacterPipeline, ProcessingPipeline, TokenizationCache
+
+
+def load_captions(annotation_file: str, num_images: int = 50) -> dict[int, list[dict[str, str]]]:
+    annotations = json.load(open(annotation_file))["annotations"]
+    captions = {}
+    for ann in annotations:
+        if ann["image_id"] in captions or len(captions) < num_images:
+            captions.setdefault(ann["image_id"], []).append({"caption": ann["caption"]})
+    return captions
+
+
+def test_tokenization_cache(tmp_path) -> None:
+    """Make sure the cache keeps the most recently used entries."""
+    with TokenizationCache(tmp_path, max_entries=2) as cache:
+        cache.set_many("ns", {"a b": "a b", "c": "c"})
+        assert cache.get_many("ns", ["a b", "d"]) == {"a b": "a b"}
+        assert cache.get_many("other", ["a b"]) == {}
+        cache.set_many("ns", {"e": "e"})
+        assert len(cache) == 2
+        assert cache.get_many("ns", ["a b", "c", "e"]) == {"a b": "a b", "e": "e"}
+        assert cache.stats.hits == 3
+        assert cache.stats.misses == 3
+        assert cache.stats.evictions == 1
+
+
+def test_pipeline_with_cache(tmp_path) -> None:
+    """Make sure the cached tokenization matches the tokenizer output."""
+    captions = load_captions("tests/fixtures/th_captions_val2014.json")
+    expected = ProcessingPipeline(language="th", tokenizer_cfg={"word_segmenter": "char"})(copy.deepcopy(captions))
+
+    with TokenizationCache(tmp_path) as cache:
+        pipeline = ProcessingPipeline(language="th", tokenizer_cfg={"word_segmenter": "char"}, cache=cache)
+        assert pipeline(copy.deepcopy(captions)) == expected
+        assert cache.stats.hits == 0
+        assert pipeline(copy.deepcopy(captions)) == expected
+        assert cache.stats.hits == len(cache)
+
+
+def test_caption_guard() -> None:
+    """Degenerate captions are truncated and reported, the others are left as is."""
+    captions = {
+        1: [{"caption": "a dog " * 5000}],
+        2: [{"caption": "x" * 100_000}],
+        3: [{"caption": "A cat on a mat."}],
+    }
+    pipeline = ProcessingPipeline(guard=CaptionGuard(max_chars=1000, max_tokens=50))
+    processed = pipeline(captions)
+    assert len(processed[1][0].split()) == 50 and processed[2] == ["x" * 1000]
+    assert processed[3] == ProcessingPipeline()({3: [{"caption": "A cat on a mat."}]})[3]
+    assert pipeline.guard_report.truncated_chars == [1, 2]
+    assert pipeline.guard_report.truncated_tokens == [1]
+    # The annotations are not modified
+    assert len(captions[1][0]["caption"]) == 30_000
+
+    pipeline = CharacterPipeline(guard=CaptionGuard(max_tokens=10))
+    assert pipeline({1: [{"caption": "のの の" * 10}], 2: [{"caption": "猫"}]}) == {1: ["の" * 10], 2: ["猫"]}
+    assert pipeline.guard_report.truncated_tokens == [1]
+
+    # Same guard in the metrics
+    scorer = Cider(max_length=8).build_scorer({1: ["a b " * 1000], 2: ["a b"]}, {1: ["a b " * 1000], 2: ["a b"]})
+    assert scorer.data.truncated == [0]
+    assert scorer.data.hypotheses[0][("a", "b")] == 4
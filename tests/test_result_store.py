@@ -0,0 +1,39 @@
+import sqlite3
+
+import pytest
+
+from multicaptioneval.result_store import ResultStore, get_result_key
+
+
+def test_result_store(tmp_path, monkeypatch, get_eval) -> None:
+    expected = get_eval()
+    expected.evaluate()
+
+    store = ResultStore(tmp_path, max_entries=1)
+    get_eval().evaluate(result_store=store)
+    assert store.stats.misses == 1 and len(store) == 1
+
+    # A hit returns the stored scores without preprocessing the captions
+    coco_eval = get_eval()
+    monkeypatch.setattr(coco_eval, "_prepare_data", lambda: pytest.fail("the stored result was not used"))
+    coco_eval.evaluate(result_store=store)
+    assert store.stats.hits == 1
+    assert coco_eval.eval == expected.eval
+    assert coco_eval.imgToEval == expected.imgToEval
+    get_eval().evaluate(result_store=store, verify=True)
+
+    # A corrupted entry is a miss, and verifying a tampered entry fails
+    key = get_result_key(expected.get_inputs_digest(), expected.signature)
+    with sqlite3.connect(store.path) as connection:
+        connection.execute("UPDATE results SET eval = '{}' WHERE key = ?", (key,))
+    assert store.get(key) is None and key not in store
+    tampered = {**expected.eval, "CIDEr": 0.0}
+    store.put(key, expected.signature, tampered, expected.image_scores)
+    with pytest.raises(ValueError, match="CIDEr"):
+        get_eval().evaluate(result_store=store, verify=True)
+
+    # Another configuration is another entry, evicting the least recently used one
+    get_eval(metrics=["bleu"]).evaluate(result_store=store)
+    assert len(store) == 1 and key not in store
+    assert store.stats.evictions == 1
+    store.close()
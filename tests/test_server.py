@@ -0,0 +1,74 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from multicaptioneval.loader import load_json
+from multicaptioneval.processing import CaptionGuard
+from multicaptioneval.server import ScoringClient, ScoringServer, ScoringService, ServiceError
+
+TOKENIZER_CFG = {"word_segmenter": "char"}
+
+
+@pytest.fixture(scope="module")
+def client(annotation_file: str):
+    server = ScoringServer(ScoringService(), port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    client = ScoringClient(server.url)
+    client.add_reference_set("th", annotation_file, language="th", tokenizer_cfg=TOKENIZER_CFG)
+    yield client
+    server.shutdown()
+    server.server_close()
+
+
+def test_server_scores(client: ScoringClient, get_eval, results_file: str) -> None:
+    """Make sure the service gives the same scores as COCOEvalCap, also with concurrent requests."""
+    results = load_json(results_file)
+    coco_eval = get_eval(results=load_json(results_file))
+    coco_eval.evaluate()
+    subset = results[: len(results) // 2]
+    subset_eval = get_eval(results=load_json(results_file)[: len(results) // 2])
+    subset_eval.evaluate()
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        responses = list(pool.map(lambda payload: client.score("th", payload), [results, subset] * 3))
+    for response in responses[::2]:
+        assert response["eval"] == pytest.approx(coco_eval.eval)
+    for response in responses[1::2]:
+        assert response["eval"] == pytest.approx(subset_eval.eval)
+
+    response = client.score("th", results_file, metrics=["cider"], image_scores=True)
+    assert list(response["eval"]) == ["CIDEr"]
+    assert {image["image_id"]: image["CIDEr"] for image in response["evalImgs"]} == pytest.approx(
+        {image_id: image["CIDEr"] for image_id, image in coco_eval.imgToEval.items()}
+    )
+
+
+def test_server_caption_guard(get_eval, annotation_file: str, results_file: str) -> None:
+    caption_guard = CaptionGuard(max_chars=20, max_tokens=8)
+    coco_eval = get_eval(caption_guard=caption_guard)
+    coco_eval.evaluate()
+    service = ScoringService(caption_guard=caption_guard)
+    service.add_reference_set("th", annotation_file, language="th", tokenizer_cfg=TOKENIZER_CFG)
+    response = service.score("th", results_file)
+    assert response["eval"] == pytest.approx(coco_eval.eval)
+    # Only the truncated results are reported, not the references
+    results = coco_eval.cocoRes
+    assert response["guard_report"]["truncated_chars"] == [
+        image_id for image_id in results.getImgIds() if len(results.imgToAnns[image_id][0]["caption"]) > 20
+    ]
+
+
+def test_server_errors(client: ScoringClient, results_file: str) -> None:
+    with pytest.raises(ServiceError, match="Unknown reference set"):
+        client.score("missing", results_file)
+    with pytest.raises(ServiceError, match="unknown images"):
+        client.score("th", [{"image_id": -1, "caption": "test"}])
+    image_id = load_json(results_file)[0]["image_id"]
+    with pytest.raises(ServiceError, match="Several results"):
+        client.score("th", [{"image_id": image_id, "caption": "test"}, {"image_id": image_id, "caption": "test"}])
+    with pytest.raises(ServiceError, match="Unknown metrics"):
+        client.score("th", results_file, metrics=["meteor"])
+    with pytest.raises(ValueError, match="loopback"):
+        ScoringServer(ScoringService(), host="0.0.0.0", port=0)
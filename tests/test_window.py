@@ -0,0 +1,67 @@
+import pytest
+
+from multicaptioneval.eval import COCOEvalCap
+from multicaptioneval.loader import CaptionIndex
+from multicaptioneval.window import SlidingWindowEvaluator
+
+TOKENIZER = {"language": "th", "tokenizer_cfg": {"word_segmenter": "char"}}
+
+
+@pytest.fixture(scope="module")
+def captions(annotation_file: str, results_file: str) -> tuple[CaptionIndex, CaptionIndex]:
+    coco = CaptionIndex.from_file(annotation_file)
+    return coco, coco.loadRes(results_file)
+
+
+def expected_scores(get_eval, image_ids) -> COCOEvalCap:
+    coco_eval = get_eval()
+    coco_eval.params["image_id"] = image_ids
+    coco_eval.evaluate()
+    return coco_eval
+
+
+def add_batch(window: SlidingWindowEvaluator, captions, image_ids, timestamp: float) -> None:
+    coco, coco_result = captions
+    window.add(
+        {image_id: [ann["caption"] for ann in coco_result.imgToAnns[image_id]] for image_id in image_ids},
+        {image_id: [ann["caption"] for ann in coco.imgToAnns[image_id]] for image_id in image_ids},
+        timestamp=timestamp,
+    )
+
+
+def test_sliding_window(captions, get_eval) -> None:
+    """Make sure the window scores match an evaluation of the images left by the count and age limits."""
+    image_ids = captions[1].getImgIds()[:40]
+    window = SlidingWindowEvaluator(max_images=25, max_age=100.0, **TOKENIZER)
+    for batch, timestamp in zip(range(0, 40, 10), [0.0, 10.0, 20.0, 30.0]):
+        add_batch(window, captions, image_ids[batch : batch + 10], timestamp)
+    # The first 15 images were pushed out by the count limit
+    assert window.image_ids == image_ids[15:40]
+    expected = expected_scores(get_eval, image_ids[15:40])
+    assert window.evaluate(now=30.0) == expected.eval
+    assert window.image_scores.to_dict() == expected.imgToEval
+
+    # The images added at 10.0 or before expire at 115.0
+    assert window.evaluate(now=115.0) == expected_scores(get_eval, image_ids[20:40]).eval
+    assert len(window) == 20
+    assert window.evaluate(now=200.0) == {} and not window._cider.document_frequency
+    assert window._bleu_totals == window._bleu_scorer.new_totalstats()
+
+    with pytest.raises(ValueError, match="bounded"):
+        SlidingWindowEvaluator()
+
+
+def test_sliding_window_invalid(captions) -> None:
+    """Images still in the window and batches older than the last one are rejected without changing the window."""
+    image_ids = captions[1].getImgIds()[:10]
+    window = SlidingWindowEvaluator(max_age=100.0, **TOKENIZER)
+    add_batch(window, captions, image_ids[:5], 10.0)
+    with pytest.raises(ValueError, match="already in the window"):
+        add_batch(window, captions, image_ids[4:10], 20.0)
+    with pytest.raises(ValueError, match="older than the last batch"):
+        add_batch(window, captions, image_ids[5:10], 5.0)
+    assert window.image_ids == image_ids[:5]
+
+    # An image can be added again once it expired
+    add_batch(window, captions, image_ids[:1], 200.0)
+    assert window.image_ids == image_ids[:1]